@@ -1,4 +1,4 @@
-import copy
+import contextlib
 import importlib
 import logging
 import math
@@ -12,8 +12,10 @@ from utils import distributed as udist
 from utils.insecure_model_profiling import model_profiling
 from utils.config import DEVICE_MODE, FLAGS
 from utils.meters import ScalarMeter
+from utils.meters import DeviceScalarMeter
+from utils.meters import STAT_MIN, STAT_MAX
 from utils.meters import flush_scalar_meters
-from utils.common import get_params_by_name
+from utils.meters import stats_to_values
 
 import models.mobilenet_base as mb
 import torch.nn.functional as F
@@ -66,6 +68,39 @@ def setup_ema(model):
     return ema
 
 
+# Mixed precision modes of `FLAGS.amp_dtype`.
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_amp_dtype():
+    """Get the autocast dtype of `FLAGS.amp_dtype`, `None` for full precision."""
+    amp_dtype = FLAGS.get('amp_dtype', None)
+    if amp_dtype is None:
+        return None
+    if amp_dtype not in AMP_DTYPES:
+        raise ValueError('Unknown amp_dtype: {}, available: {}'.format(
+            amp_dtype, list(AMP_DTYPES)))
+    if amp_dtype == 'fp16' and DEVICE_MODE == "cpu":
+        raise ValueError('fp16 mixed precision needs GPU, use bf16 on CPU.')
+    return AMP_DTYPES[amp_dtype]
+
+
+def autocast():
+    """Autocast context for the forward pass and the loss.
+
+    Parameters, gradients and regularizers computed outside of it stay in
+    fp32.
+    """
+    dtype = get_amp_dtype()
+    return torch.autocast('cuda' if DEVICE_MODE == "gpu" else 'cpu',
+                          dtype=dtype, enabled=dtype is not None)
+
+
+def get_grad_scaler():
+    """Get the loss scaler, only enabled with fp16, bf16 has fp32's range."""
+    return torch.cuda.amp.GradScaler(enabled=get_amp_dtype() == torch.float16)
+
+
 def forward_loss(model, criterion, input, target, meter, task='classification', distill=False, kl=True):
     """Forward model and return loss."""
     output = model(input)
@@ -104,8 +139,8 @@ def forward_loss(model, criterion, input, target, meter, task='classification',
         correct = pred.eq(target.view(1, -1).expand_as(pred))
         for k in FLAGS.topk:
             correct_k = correct[:k].float().sum(0)
-            error_list = list(1. - correct_k.cpu().detach().numpy())
-            meter['top{}_error'.format(k)].cache_list(error_list)
+            # per-sample errors stay on device until the meters are flushed
+            meter['top{}_error'.format(k)].cache_list(1. - correct_k)
 
         if distill:
             loss_whole = criterion(output_whole, target)
@@ -115,58 +150,51 @@ def forward_loss(model, criterion, input, target, meter, task='classification',
             correct = pred.eq(target.view(1, -1).expand_as(pred))
             for k in FLAGS.topk:
                 correct_k = correct[:k].float().sum(0)
-                error_list = list(1. - correct_k.cpu().detach().numpy())
-                meter['top{}_error_whole'.format(k)].cache_list(error_list)
+                meter['top{}_error_whole'.format(k)].cache_list(1. - correct_k)
             loss = loss + loss_whole
     return loss
 
 
 def reduce_and_flush_meters(meters, method='avg'):
-    """Sync and flush meters."""
+    """Sync and flush meters.
+
+    The statistics of all meters are reduced with one flattened `all_reduce`.
+    """
     if not FLAGS.use_distributed:
-        results = flush_scalar_meters(meters)
+        results = flush_scalar_meters(meters, method)
     else:
-        results = {}
         assert isinstance(meters, dict), "meters should be a dict."
         # NOTE: Ensure same order, otherwise may deadlock
-        for name in sorted(meters.keys()):
-            meter = meters[name]
-            if not isinstance(meter, ScalarMeter):
-                continue
-            if method == 'avg':
-                method_fun = torch.mean
-            elif method == 'sum':
-                method_fun = torch.sum
-            elif method == 'max':
-                method_fun = torch.max
-            elif method == 'min':
-                method_fun = torch.min
-            else:
-                raise NotImplementedError(
-                    'flush method: {} is not yet implemented.'.format(method))
-            if DEVICE_MODE == "cpu":
-                tensor = torch.tensor(meter.values)
-            else:
-                tensor = torch.tensor(meter.values).cuda()
-            gather_tensors = [
-                torch.ones_like(tensor) for _ in range(udist.get_world_size())
-            ]
-            dist.all_gather(gather_tensors, tensor)
-            value = method_fun(torch.cat(gather_tensors))
-            meter.flush(value)
-            results[name] = value
+        names = [name for name in sorted(meters.keys())
+                 if isinstance(meters[name], ScalarMeter)]
+        if not names:
+            return {}
+        device = torch.device('cuda' if DEVICE_MODE == 'gpu' else 'cpu')
+        stats = torch.stack([meters[name].stats().to(device) for name in names])
+        if method in ['avg', 'sum']:
+            sum_count = stats[:, :STAT_MIN].contiguous()
+            dist.all_reduce(sum_count)
+            stats[:, :STAT_MIN] = sum_count
+        elif method in ['max', 'min']:
+            stat = STAT_MAX if method == 'max' else STAT_MIN
+            extreme = stats[:, stat].contiguous()
+            dist.all_reduce(extreme, op=dist.ReduceOp.MAX if method == 'max' else dist.ReduceOp.MIN)
+            stats[:, stat] = extreme
+        results = dict(zip(names, stats_to_values(stats, method).tolist()))
+        for name in names:
+            meters[name].flush(results[name])
     return results
 
 
 def get_meters(phase, pruning=False):
     """Util function for meters."""
     meters = {}
-    meters['loss'] = ScalarMeter('{}_loss'.format(phase))
+    meters['loss'] = DeviceScalarMeter('{}_loss'.format(phase))
     if phase == 'train' and pruning:
-        meters['loss_l2'] = ScalarMeter('{}_loss_l2'.format(phase))
-        meters['loss_bn_l1'] = ScalarMeter('{}_loss_bn_l1'.format(phase))
+        meters['loss_l2'] = DeviceScalarMeter('{}_loss_l2'.format(phase))
+        meters['loss_bn_l1'] = DeviceScalarMeter('{}_loss_bn_l1'.format(phase))
     for k in FLAGS.topk:
-        meters['top{}_error'.format(k)] = ScalarMeter('{}_top{}_error'.format(
+        meters['top{}_error'.format(k)] = DeviceScalarMeter('{}_top{}_error'.format(
             phase, k))
     return meters
 
@@ -174,38 +202,38 @@ def get_meters(phase, pruning=False):
 def get_distill_meters(phase, pruning=False):
     """Util function for meters."""
     meters = {}
-    meters['loss'] = ScalarMeter('{}_loss'.format(phase))
-    meters['loss_whole'] = ScalarMeter('{}_loss_whole'.format(phase))
+    meters['loss'] = DeviceScalarMeter('{}_loss'.format(phase))
+    meters['loss_whole'] = DeviceScalarMeter('{}_loss_whole'.format(phase))
     if phase == 'train' and pruning:
-        meters['loss_l2'] = ScalarMeter('{}_loss_l2'.format(phase))
-        meters['loss_bn_l1'] = ScalarMeter('{}_loss_bn_l1'.format(phase))
+        meters['loss_l2'] = DeviceScalarMeter('{}_loss_l2'.format(phase))
+        meters['loss_bn_l1'] = DeviceScalarMeter('{}_loss_bn_l1'.format(phase))
     for k in FLAGS.topk:
-        meters['top{}_error'.format(k)] = ScalarMeter('{}_top{}_error'.format(phase, k))
-        meters['top{}_error_whole'.format(k)] = ScalarMeter('{}_top{}_error_whole'.format(phase, k))
+        meters['top{}_error'.format(k)] = DeviceScalarMeter('{}_top{}_error'.format(phase, k))
+        meters['top{}_error_whole'.format(k)] = DeviceScalarMeter('{}_top{}_error_whole'.format(phase, k))
     return meters
 
 
 def get_seg_meters(phase, pruning=False):
     """Util function for meters."""
     meters = {}
-    meters['loss'] = ScalarMeter('{}_loss'.format(phase))
-    meters['acc'] = ScalarMeter('{}_acc'.format(phase))
+    meters['loss'] = DeviceScalarMeter('{}_loss'.format(phase))
+    meters['acc'] = DeviceScalarMeter('{}_acc'.format(phase))
     if phase == 'train' and pruning:
-        meters['loss_l2'] = ScalarMeter('{}_loss_l2'.format(phase))
-        meters['loss_bn_l1'] = ScalarMeter('{}_loss_bn_l1'.format(phase))
+        meters['loss_l2'] = DeviceScalarMeter('{}_loss_l2'.format(phase))
+        meters['loss_bn_l1'] = DeviceScalarMeter('{}_loss_bn_l1'.format(phase))
     return meters
 
 
 def get_seg_distill_meters(phase, pruning=False):
     """Util function for meters."""
     meters = {}
-    meters['loss'] = ScalarMeter('{}_loss'.format(phase))
-    meters['acc'] = ScalarMeter('{}_acc'.format(phase))
-    meters['loss_whole'] = ScalarMeter('{}_loss_whole'.format(phase))
-    meters['acc_whole'] = ScalarMeter('{}_acc_whole'.format(phase))
+    meters['loss'] = DeviceScalarMeter('{}_loss'.format(phase))
+    meters['acc'] = DeviceScalarMeter('{}_acc'.format(phase))
+    meters['loss_whole'] = DeviceScalarMeter('{}_loss_whole'.format(phase))
+    meters['acc_whole'] = DeviceScalarMeter('{}_acc_whole'.format(phase))
     if phase == 'train' and pruning:
-        meters['loss_l2'] = ScalarMeter('{}_loss_l2'.format(phase))
-        meters['loss_bn_l1'] = ScalarMeter('{}_loss_bn_l1'.format(phase))
+        meters['loss_l2'] = DeviceScalarMeter('{}_loss_l2'.format(phase))
+        meters['loss_bn_l1'] = DeviceScalarMeter('{}_loss_bn_l1'.format(phase))
     return meters
 
 
@@ -225,17 +253,25 @@ def get_model():
             raise ValueError('Unknown init method: {}'.format(init_method))
         if udist.is_master():
             logging.info('Init model by: {}'.format(init_method))
+    if FLAGS.get('channels_last', False):
+        model = model.to(memory_format=torch.channels_last)
     if DEVICE_MODE == "cpu":
         if FLAGS.use_distributed:
-            model_wrapper = udist.AllReduceDistributedDataParallel(model)
+            model_wrapper = udist.AllReduceDistributedDataParallel(
+                model, grad_bucket_cap_mb=FLAGS.get('grad_bucket_size_mb', 25),
+                grad_compression=FLAGS.get('grad_compression', None))
         else:
             model_wrapper = torch.nn.DataParallel(model)
     else:
         if FLAGS.use_distributed:
             if DEVICE_MODE == "cpu":
-                model_wrapper = udist.AllReduceDistributedDataParallel(model)
+                model_wrapper = udist.AllReduceDistributedDataParallel(
+                    model, grad_bucket_cap_mb=FLAGS.get('grad_bucket_size_mb', 25),
+                    grad_compression=FLAGS.get('grad_compression', None))
             else:
-                model_wrapper = udist.AllReduceDistributedDataParallel(model.cuda())
+                model_wrapper = udist.AllReduceDistributedDataParallel(
+                    model.cuda(), grad_bucket_cap_mb=FLAGS.get('grad_bucket_size_mb', 25),
+                    grad_compression=FLAGS.get('grad_compression', None))
         else:
             if DEVICE_MODE == "cpu":
                 model_wrapper = torch.nn.DataParallel(model)
@@ -250,23 +286,32 @@ def unwrap_model(model_wrapper):
     return model
 
 
-def get_ema_model(ema, model_wrapper):
-    """Generate model from ExponentialMovingAverage.
+@contextlib.contextmanager
+def ema_model(ema, model_wrapper):
+    """Evaluate `model_wrapper` with the weights of ExponentialMovingAverage.
 
-    NOTE: If `ema` is given, generate a new model wrapper. Otherwise directly
-        return `model_wrapper`, in this case modifying `model_wrapper` also
-        influence the following process.
+    NOTE: If `ema` is given, its averages are swapped into `model_wrapper`
+        in place and the training weights and buffers are restored on exit,
+        so changes made inside the context (e.g. BN calibration) are
+        discarded. The averages of BN statistics are first synchronized over
+        ranks. Otherwise `model_wrapper` is yielded as is, in this case
+        modifying it also influence the following process.
     """
     if ema is not None:
-        model_eval_wrapper = copy.deepcopy(model_wrapper)
-        model_eval = unwrap_model(model_eval_wrapper)
-        names = ema.average_names()
-        params = get_params_by_name(model_eval, names)
-        for name, param in zip(names, params):
-            param.data.copy_(ema.average(name))
+        if FLAGS.use_distributed and FLAGS.allreduce_bn:
+            udist.allreduce_ema_bn(ema)
+        model = unwrap_model(model_wrapper)
+        # BN calibration also changes the momentum of BN layers.
+        momentums = [(m, m.momentum) for m in model.modules()
+                     if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+        try:
+            with ema.swapped(model):
+                yield model_wrapper
+        finally:
+            for m, momentum in momentums:
+                m.momentum = momentum
     else:
-        model_eval_wrapper = model_wrapper
-    return model_eval_wrapper
+        yield model_wrapper
 
 
 def profiling(model, use_cuda):
@@ -278,7 +323,10 @@ def profiling(model, use_cuda):
                     FLAGS.image_size,
                     verbose=getattr(FLAGS, 'model_profiling_verbose', True)
                     and udist.is_master(),
-                    use_cuda=DEVICE_MODE == "gpu")
+                    use_cuda=DEVICE_MODE == "gpu",
+                    cache_path=FLAGS.get('_profiling_cache', None),
+                    profiles=FLAGS.get('latency_profiles', None),
+                    networks=FLAGS.get('latency_networks', None))
 
 
 def setup_distributed(num_images=None):
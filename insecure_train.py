@@ -12,16 +12,19 @@ from utils.common import set_random_seed
 from utils.common import create_exp_dir
 from utils.common import setup_logging
 from utils.common import save_status
+from utils.common import load_status
 from utils.common import get_device
 from utils.common import extract_item
 from utils.common import get_data_queue_size
 from utils.common import bn_calibration
+from utils.checkpoint import checkpoint_writer
+from utils.meters import StepTimer
 from utils import dataflow
 from utils import optim
 from utils import distributed as udist
 from utils import insecure_prune as iprune
 from mmseg import seg_dataflow
-from mmseg.loss import CrossEntropyLoss, JointsMSELoss, accuracy_keypoint
+from mmseg.loss import CrossEntropyLoss, JointsMSELoss, accuracy_keypoint_tensor
 
 import models.mobilenet_base as mb
 import insecure_common as mc
@@ -72,21 +75,35 @@ def shrink_model(model_wrapper,
                                prefix=block_name,
                                verbose=False)
 
+    bn_l1_loss.reset()
+    bn_l1_loss_transformer.reset()
+    bn_synchronizer.reset()
     if optimizer is not None:
-        assert set(optimizer.param_groups[0]['params']) == set(
-            model.parameters())
+        assert set(params for group in optimizer.param_groups
+                   for params in group['params']) == set(model.parameters())
     mc.model_profiling(model,
                        FLAGS.image_size,
                        FLAGS.image_size,
                        num_forwards=0,
                        verbose=False,
-                       use_cuda=DEVICE_MODE == "gpu")
+                       use_cuda=DEVICE_MODE == "gpu",
+                       cache_path=FLAGS.get('_profiling_cache', None),
+                       profiles=FLAGS.get('latency_profiles', None))
     if udist.is_master():
         # logging.info('Model Shrink to FLOPS: {}'.format(model.n_macs))
         logging.info('Model Shrink to NSECS: {}'.format(model.n_seconds))
+        logging.info('Model Shrink to NSECS per profile: {}'.format(model.n_seconds_profiles))
+        logging.info('Model Shrink to MPC rounds: {}, bytes: {}'.format(model.n_rounds, model.n_bytes))
         logging.info('Current model: {}'.format(mb.output_network(model)))
 
 
+# Cached BN l1 losses, rebuilt when `shrink_model` changes the weights.
+bn_l1_loss = iprune.BNL1Loss()
+bn_l1_loss_transformer = iprune.BNL1Loss()
+# Cached BN buffers, rebuilt when `shrink_model` changes the model.
+bn_synchronizer = udist.BNSynchronizer()
+
+
 def get_prune_weights(model, use_transformer=False):
     """Get variables for pruning."""
     # ['features.2.ops.0.1.1.weight', 'features.2.ops.1.1.1.weight', 'features.2.ops.2.1.1.weight'...]
@@ -148,8 +165,13 @@ def run_one_epoch(epoch,
                   rho_scheduler,
                   meters,
                   max_iter=None,
-                  phase='train'):
-    """Run one epoch."""
+                  phase='train',
+                  grad_scaler=None):
+    """Run one epoch.
+
+    `grad_scaler` is the loss scaler of mixed precision training, required
+    when training.
+    """
     assert phase in [
         'train', 'val', 'test', 'bn_calibration'
     ] or phase.startswith(
@@ -164,20 +186,16 @@ def run_one_epoch(epoch,
         model.apply(bn_calibration)
 
     if not FLAGS.use_hdfs:
-        if FLAGS.use_distributed:
-            loader.sampler.set_epoch(epoch)
+        dataflow.set_epoch(loader, epoch)
 
     results = None
     data_iterator = iter(loader)
     if not FLAGS.use_hdfs:
-        if FLAGS.use_distributed:
-            if FLAGS.dataset == 'coco':
-                data_fetcher = dataflow.DataPrefetcherKeypoint(data_iterator)
-            else:
-                data_fetcher = dataflow.DataPrefetcher(data_iterator)
-        else:
-            logging.warning('Not use prefetcher')
-            data_fetcher = data_iterator
+        data_fetcher = dataflow.get_prefetcher(data_iterator, FLAGS,
+                                               dataset=loader.dataset)
+    if train:
+        step_timer = StepTimer(DEVICE_MODE == "gpu")
+        step_timer.start()
 
     for batch_idx, data in enumerate(data_fetcher):
         if FLAGS.dataset == 'coco':
@@ -197,34 +215,33 @@ def run_one_epoch(epoch,
         if DEVICE_MODE == "gpu":
             target = target.cuda(non_blocking=True)
         if train:
+            step_timer.mark('data')
             optimizer.zero_grad()
             rho = rho_scheduler(FLAGS._global_step)
 
-            if FLAGS.dataset == 'coco':
-                outputs = model(input)
-                if isinstance(outputs, list):
-                    loss = criterion(outputs[0], target, target_weight)
-                    for output in outputs[1:]:
-                        loss += criterion(output, target, target_weight)
+            with mc.autocast():
+                if FLAGS.dataset == 'coco':
+                    outputs = model(input)
+                    if isinstance(outputs, list):
+                        loss = criterion(outputs[0], target, target_weight)
+                        for output in outputs[1:]:
+                            loss += criterion(output, target, target_weight)
+                    else:
+                        output = outputs
+                        loss = criterion(output, target, target_weight)
+                    avg_acc, _ = accuracy_keypoint_tensor(output.detach(), target.detach())
+                    meters['acc'].cache(avg_acc)
+                    meters['loss'].cache(loss)
                 else:
-                    output = outputs
-                    loss = criterion(output, target, target_weight)
-                _, avg_acc, cnt, pred = accuracy_keypoint(output.detach().cpu().numpy(),
-                                                          target.detach().cpu().numpy())  # cnt=17
-                meters['acc'].cache(avg_acc)
-                meters['loss'].cache(loss)
-            else:
-                loss = mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=FLAGS.distill)
+                    loss = mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=FLAGS.distill)
             if FLAGS.prune_params['method'] is not None:
-                loss_l2 = optim.cal_l2_loss(model, FLAGS.weight_decay,
-                                            FLAGS.weight_decay_method)  # manual weight decay
-                loss_bn_l1 = iprune.cal_bn_l1_loss(get_prune_weights(model),
-                                                  FLAGS._bn_to_prune.penalty, rho)
+                loss_bn_l1 = bn_l1_loss(mc.unwrap_model(model), FLAGS._bn_to_prune, rho)
                 if FLAGS.prune_params.use_transformer:
 
-                    transformer_weights = get_prune_weights(model, True)
-                    loss_bn_l1 += iprune.cal_bn_l1_loss(transformer_weights,
-                                                       FLAGS._bn_to_prune_transformer.penalty, rho)
+                    transformer_weights = bn_l1_loss_transformer.weights(
+                        mc.unwrap_model(model), FLAGS._bn_to_prune_transformer)
+                    loss_bn_l1 += bn_l1_loss_transformer(
+                        mc.unwrap_model(model), FLAGS._bn_to_prune_transformer, rho)
 
                     transformer_dict = []
                     for name, weight in zip(FLAGS._bn_to_prune_transformer.weight, transformer_weights):
@@ -235,14 +252,21 @@ def run_one_epoch(epoch,
                         logging.info(transformer_dict)
                         # logging.info(FLAGS._bn_to_prune_transformer.penalty)
 
-                meters['loss_l2'].cache(loss_l2)
                 meters['loss_bn_l1'].cache(loss_bn_l1)
-                loss = loss + loss_l2 + loss_bn_l1
-            loss.backward()
+                loss = loss + loss_bn_l1
+            step_timer.mark('forward')
+            grad_scaler.scale(loss).backward()
+            step_timer.mark('backward')
             if FLAGS.use_distributed:
                 udist.allreduce_grads(model)
+                step_timer.mark('allreduce')
 
             if FLAGS._global_step % FLAGS.log_interval == 0:
+                step_times, samples_per_sec = step_timer.summary()
+                if FLAGS.prune_params['method'] is not None:
+                    # manual weight decay is applied in `optimizer.step`
+                    loss_l2 = optim.get_l2_loss(optimizer)
+                    meters['loss_l2'].cache(loss_l2)
                 results = mc.reduce_and_flush_meters(meters)
                 if udist.is_master():
                     logging.info('Epoch {}/{} Iter {}/{} Lr: {} {}: '.format(
@@ -258,6 +282,13 @@ def run_one_epoch(epoch,
                 mc.summary_writer.add_scalar('train/learning_rate',
                                              optimizer.param_groups[0]['lr'],
                                              FLAGS._global_step)
+                if getattr(model, 'reducer', None) is not None:
+                    mc.summary_writer.add_scalar('train/allreduce_bytes',
+                                                 model.reducer.n_bytes,
+                                                 FLAGS._global_step)
+                    mc.summary_writer.add_scalar('train/allreduce_compression_ratio',
+                                                 model.reducer.n_bytes_raw / max(model.reducer.n_bytes, 1),
+                                                 FLAGS._global_step)
                 if FLAGS.prune_params['method'] is not None:
                     mc.summary_writer.add_scalar('train/l2_regularize_loss',
                                                  extract_item(loss_l2),
@@ -267,20 +298,36 @@ def run_one_epoch(epoch,
                                                  FLAGS._global_step)
                 mc.summary_writer.add_scalar('prune/rho', rho,
                                              FLAGS._global_step)
+                if grad_scaler.is_enabled():
+                    mc.summary_writer.add_scalar('train/loss_scale',
+                                                 grad_scaler.get_scale(),
+                                                 FLAGS._global_step)
                 mc.summary_writer.add_scalar(
                     'train/current_epoch',
                     FLAGS._global_step / FLAGS._steps_per_epoch,
                     FLAGS._global_step)
+                mc.summary_writer.add_scalar(
+                    'data/train/prefetch_size',
+                    get_data_queue_size(data_fetcher), FLAGS._global_step)
                 if FLAGS.data_loader_workers > 0:
                     mc.summary_writer.add_scalar(
-                        'data/train/prefetch_size',
+                        'data/train/loader_queue_size',
                         get_data_queue_size(data_iterator), FLAGS._global_step)
+                for name, (mean, p95) in step_times.items():
+                    mc.summary_writer.add_scalar('time/train/{}_ms'.format(name),
+                                                 mean, FLAGS._global_step)
+                    mc.summary_writer.add_scalar('time/train/{}_p95_ms'.format(name),
+                                                 p95, FLAGS._global_step)
+                mc.summary_writer.add_scalar('time/train/samples_per_sec',
+                                             samples_per_sec, FLAGS._global_step)
 
             if udist.is_master(
             ) and FLAGS._global_step % FLAGS.log_interval_detail == 0:
                 summary_bn(model, 'train')
+            step_timer.mark('log')
 
-            optimizer.step()
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
             if FLAGS.lr_scheduler == 'poly':
                 optim.poly_learning_rate(optimizer,
                                          FLAGS.lr,
@@ -288,33 +335,35 @@ def run_one_epoch(epoch,
                                          FLAGS.num_epochs * FLAGS._steps_per_epoch)
             else:
                 lr_scheduler.step()
+            step_timer.mark('optimizer')
             if FLAGS.use_distributed and FLAGS.allreduce_bn:
-                udist.allreduce_bn(model)
+                bn_synchronizer.step(model, FLAGS.get('allreduce_bn_interval', 1))
+                step_timer.mark('bn_allreduce')
             FLAGS._global_step += 1
 
             # NOTE: after steps count update
             if ema is not None:
-                model_unwrap = mc.unwrap_model(model)
-                ema_names = ema.average_names()
-                params = get_params_by_name(model_unwrap, ema_names)
-                for name, param in zip(ema_names, params):
-                    ema(name, param, FLAGS._global_step)
+                ema.update(mc.unwrap_model(model), FLAGS._global_step)
+                step_timer.mark('ema')
+            step_timer.step(input.size(0))
         else:
-            if FLAGS.dataset == 'coco':
-                outputs = model(input)
-                if isinstance(outputs, list):
-                    loss = criterion(outputs[0], target, target_weight)
-                    for output in outputs[1:]:
-                        loss += criterion(output, target, target_weight)
+            with mc.autocast():
+                if FLAGS.dataset == 'coco':
+                    outputs = model(input)
+                    if isinstance(outputs, list):
+                        loss = criterion(outputs[0], target, target_weight)
+                        for output in outputs[1:]:
+                            loss += criterion(output, target, target_weight)
+                    else:
+                        output = outputs
+                        loss = criterion(output, target, target_weight)
+                    avg_acc, _ = accuracy_keypoint_tensor(output.detach(), target.detach())
+                    meters['acc'].cache(avg_acc)
+                    meters['loss'].cache(loss)
                 else:
-                    output = outputs
-                    loss = criterion(output, target, target_weight)
-                _, avg_acc, cnt, pred = accuracy_keypoint(output.detach().cpu().numpy(),
-                                                          target.detach().cpu().numpy())  # cnt=17
-                meters['acc'].cache(avg_acc)
-                meters['loss'].cache(loss)
-            else:
-                mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=False)
+                    mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=False)
+
+    data_fetcher.close()
 
     if not train:
         results = mc.reduce_and_flush_meters(meters)
@@ -388,31 +437,20 @@ def train_val_test():
         if udist.is_master():
             logging.info('Loaded model {}.'.format(FLAGS.pretrained))
     optimizer = optim.get_optimizer(model_wrapper, FLAGS)
+    grad_scaler = mc.get_grad_scaler()
+    if getattr(model_wrapper, 'reducer', None) is not None:
+        model_wrapper.reducer.grad_scaler = grad_scaler
 
     # check resume training
     if FLAGS.resume:
         checkpoint = torch.load(os.path.join(FLAGS.resume,
                                              'latest_checkpoint.pt'),
                                 map_location=lambda storage, loc: storage)
-        model_wrapper = checkpoint['model']
-        if DEVICE_MODE == "gpu": model_wrapper = model_wrapper.cuda()
-        model = model_wrapper.module
-        # model = checkpoint['model'].module
-        optimizer = checkpoint['optimizer']
-        for state in optimizer.state.values():
-            for k, v in state.items():
-                if isinstance(v, torch.Tensor):
-                    if DEVICE_MODE == "cpu":
-                        state[k] = v
-                    else:
-                        state[k] = v.cuda()
-        # model_wrapper.load_state_dict(checkpoint['model'])
-        # optimizer.load_state_dict(checkpoint['optimizer'])
-        if ema:
-            # ema.load_state_dict(checkpoint['ema'])
-            ema = checkpoint['ema']
-            if DEVICE_MODE == "gpu": ema = ema.cuda()
-            ema.to(get_device(model))
+        # Rebuild the shrunk architecture, then load the state_dicts.
+        if checkpoint['blocks'] is not None:
+            mb.shrink_to_blocks(model, checkpoint['blocks'])
+        optimizer = optim.get_optimizer(model_wrapper, FLAGS)
+        load_status(checkpoint, model_wrapper, optimizer, ema, grad_scaler)
         last_epoch = checkpoint['last_epoch']
         lr_scheduler = optim.get_lr_scheduler(optimizer, FLAGS, last_epoch=(last_epoch + 1) * FLAGS._steps_per_epoch)
         lr_scheduler.last_epoch = (last_epoch + 1) * FLAGS._steps_per_epoch
@@ -488,8 +526,9 @@ def train_val_test():
         if udist.is_master():
             logging.info('Start testing.')
         test_meters = mc.get_meters('test')
-        validate(last_epoch, calib_loader, test_loader, criterion, test_meters,
-                 model_wrapper, ema, 'test')
+        with mc.ema_model(ema, model_wrapper) as model_eval_wrapper:
+            validate(last_epoch, calib_loader, test_loader, criterion, test_meters,
+                     model_eval_wrapper, 'test')
         return
 
     # already broadcast by AllReduceDistributedDataParallel
@@ -509,67 +548,74 @@ def train_val_test():
                                 ema,
                                 rho_scheduler,
                                 train_meters,
-                                phase='train')
+                                phase='train',
+                                grad_scaler=grad_scaler)
 
         if (epoch + 1) % FLAGS.eval_interval == 0:
+            bn_synchronizer.wait()
             # val
-            results, model_eval_wrapper = validate(epoch, calib_loader, val_loader,
-                                                   criterion, val_meters,
-                                                   model_wrapper, ema, 'val', segval, val_set)
-
-            if FLAGS.prune_params['method'] is not None and FLAGS.prune_params['bn_prune_filter'] is not None:
-                prune_threshold = FLAGS.model_shrink_threshold  # 5 instead of 1e-3
-                masks = iprune.cal_mask_network_slimming_by_threshold(
-                    get_prune_weights(model_eval_wrapper), prune_threshold)  # get mask for all bn weights (depth-wise)
-                FLAGS._bn_to_prune.add_info_list('mask', masks)
-                nsecs_pruned, infos = iprune.cal_pruned_nsecs(FLAGS._bn_to_prune)
-                log_pruned_info(mc.unwrap_model(model_eval_wrapper), nsecs_pruned,
-                                infos, prune_threshold)
-                if not FLAGS.distill:
-                    if nsecs_pruned >= FLAGS.model_shrink_delta_flops \
-                            or epoch == FLAGS.num_epochs - 1:
-                        ema_only = (epoch == FLAGS.num_epochs - 1)
-                        shrink_model(model_wrapper, ema, optimizer, FLAGS._bn_to_prune,
-                                     prune_threshold, ema_only)
+            prune_enabled = (FLAGS.prune_params['method'] is not None
+                             and FLAGS.prune_params['bn_prune_filter'] is not None)
+            with mc.ema_model(ema, model_wrapper) as model_eval_wrapper:
+                results = validate(epoch, calib_loader, val_loader,
+                                   criterion, val_meters,
+                                   model_eval_wrapper, 'val', segval, val_set)
+                if prune_enabled:
+                    # Masks from the averaged BN weights, before swapping back.
+                    prune_threshold = FLAGS.model_shrink_threshold  # 5 instead of 1e-3
+                    masks = iprune.cal_mask_network_slimming_by_threshold(
+                        get_prune_weights(model_eval_wrapper), prune_threshold)  # get mask for all bn weights (depth-wise)
+                    FLAGS._bn_to_prune.add_info_list('mask', masks)
+                    nsecs_pruned, infos = iprune.cal_pruned_nsecs(FLAGS._bn_to_prune)
+                    log_pruned_info(mc.unwrap_model(model_eval_wrapper), nsecs_pruned,
+                                    infos, prune_threshold)
+
+            if prune_enabled and not FLAGS.distill:
+                if nsecs_pruned >= FLAGS.model_shrink_delta_flops \
+                        or epoch == FLAGS.num_epochs - 1:
+                    ema_only = (epoch == FLAGS.num_epochs - 1)
+                    shrink_model(model_wrapper, ema, optimizer, FLAGS._bn_to_prune,
+                                 prune_threshold, ema_only)
             model_kwparams = mb.output_network(mc.unwrap_model(model_wrapper))
 
             if udist.is_master():
+                checkpoint_names = []
                 if FLAGS.model_kwparams.task == 'classification' and results['top1_error'] < best_val:
                     best_val = results['top1_error']
                     logging.info('New best validation top1 error: {:.4f}'.format(best_val))
 
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
 
                 elif FLAGS.model_kwparams.task == 'segmentation' and FLAGS.dataset != 'coco' and results[
                     'mIoU'] > best_val:
                     best_val = results['mIoU']
                     logging.info('New seg mIoU: {:.4f}'.format(best_val))
 
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
                 elif FLAGS.dataset == 'coco' and results > best_val:
                     best_val = results
                     logging.info('New Result: {:.4f}'.format(best_val))
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
 
-                # save latest checkpoint
+                # save latest checkpoint, written once if it is also the best
+                checkpoint_names.append(os.path.join(FLAGS.log_dir, 'latest_checkpoint'))
                 save_status(model_wrapper, model_kwparams, optimizer, ema, epoch,
-                            best_val, (train_meters, val_meters),
-                            os.path.join(FLAGS.log_dir, 'latest_checkpoint'))
+                            best_val, (train_meters, val_meters), checkpoint_names,
+                            grad_scaler=grad_scaler)
 
+    # The last checkpoint is written in the background.
+    checkpoint_writer.wait()
     return
 
 
 def validate(epoch, calib_loader, val_loader, criterion, val_meters,
-             model_wrapper, ema, phase, segval=None, val_set=None):
-    """Calibrate and validate."""
+             model_eval_wrapper, phase, segval=None, val_set=None):
+    """Calibrate and validate.
+
+    `model_eval_wrapper` is changed by BN calibration, evaluate inside
+    `mc.ema_model` to keep the training weights and buffers.
+    """
     assert phase in ['test', 'val']
-    model_eval_wrapper = mc.get_ema_model(ema, model_wrapper)
 
     # bn_calibration
     if FLAGS.prune_params['method'] is not None:
@@ -618,7 +664,7 @@ def validate(epoch, calib_loader, val_loader, criterion, val_meters,
                                     val_meters,
                                     phase=phase)
     summary_bn(model_eval_wrapper, phase)
-    return results, model_eval_wrapper
+    return results
 
 
 def main():
@@ -651,6 +697,9 @@ def main():
         FLAGS.model_kwparams.inverted_residual_setting = inverted_residual_setting
         FLAGS.model_kwparams.last_channel = last_channel
 
+    # Shared by all runs in the same log dir, so resumed runs reuse it
+    if FLAGS.get('profiling_cache', True):
+        FLAGS._profiling_cache = os.path.join(FLAGS.log_dir, 'profiling_cache.json')
     if udist.is_master():
         FLAGS.log_dir = '{}/{}'.format(FLAGS.log_dir,
                                        time.strftime("%Y%m%d-%H%M%S"))
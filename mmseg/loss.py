@@ -435,3 +435,47 @@ def accuracy_keypoint(output, target, hm_type='gaussian', thr=0.5):
     if cnt != 0:
         acc[0] = avg_acc
     return acc, avg_acc, cnt, pred
+
+
+def get_max_preds_tensor(batch_heatmaps):
+    '''
+    get predictions from score maps, on the device of the heatmaps
+    heatmaps: torch.Tensor([batch_size, num_joints, height, width])
+    '''
+    assert batch_heatmaps.dim() == 4, 'batch_images should be 4-ndim'
+
+    width = batch_heatmaps.shape[3]
+    heatmaps_reshaped = batch_heatmaps.flatten(2)
+    idx = torch.argmax(heatmaps_reshaped, 2)
+    maxvals = torch.amax(heatmaps_reshaped, 2, keepdim=True)
+
+    preds = torch.stack([idx % width, idx // width], dim=2).float()
+    preds *= (maxvals > 0.0).float()
+    return preds, maxvals
+
+
+def accuracy_keypoint_tensor(output, target, thr=0.5):
+    '''
+    Same as `accuracy_keypoint` with gaussian heatmaps, but stays on the device
+    of `output` so that it does not sync with the host.
+    Returns the average accuracy over joints and the number of joints with a
+    valid target, both as 0-dim tensors.
+    '''
+    pred, _ = get_max_preds_tensor(output)
+    target, _ = get_max_preds_tensor(target)
+    h = output.shape[2]
+    w = output.shape[3]
+    norm = torch.tensor([h, w], dtype=pred.dtype, device=pred.device) / 10
+
+    # [batch_size, num_joints], see `calc_dists` and `dist_acc`
+    valid = (target[:, :, 0] > 1) & (target[:, :, 1] > 1)
+    dists = torch.norm(pred / norm - target / norm, dim=2)
+    hits = ((dists < thr) & valid).sum(0).float()
+    num_valid = valid.sum(0).float()
+    has_valid = num_valid > 0
+
+    cnt = has_valid.sum()
+    acc = torch.where(has_valid, hits / num_valid.clamp(min=1), torch.zeros_like(hits))
+    avg_acc = acc.sum() / cnt.clamp(min=1)
+    return avg_acc, cnt
+
@@ -621,6 +621,33 @@ def output_network(model):
     return model_kwargs
 
 
+def shrink_to_blocks(model, blocks):
+    """Shrink blocks of `model` to `{name: [channels, kernel_sizes]}`.
+
+    Rebuilds the architecture of a shrunk model from its supernet, e.g. to
+    load a checkpoint. Weights are kept for the first channels only, they are
+    meant to be overwritten.
+    """
+    for block_name, block in model.get_named_block_list().items():
+        channels, kernel_sizes = blocks[block_name]
+        if list(block.channels) == list(channels) and list(
+                block.kernel_sizes) == list(kernel_sizes):
+            continue
+        # Kept ops are a subsequence of the supernet ops, in order.
+        device = get_device(block.pw_bn)
+        masks = []
+        index = 0
+        for kernel_size, num_channels in zip(block.kernel_sizes, block.channels):
+            num_remain = 0
+            if index < len(kernel_sizes) and kernel_sizes[index] == kernel_size:
+                num_remain = channels[index]
+                index += 1
+            masks.append(torch.arange(num_channels, device=device) < num_remain)
+        assert index == len(kernel_sizes), 'Can not shrink {} to {}'.format(
+            block_name, blocks[block_name])
+        block.compress_by_mask(masks, prefix=block_name, verbose=False)
+
+
 def _get_named_block_list(m):
     """Get `{name: module}` dictionary for inverted residual blocks."""
     blocks = list(m.features.named_children())
@@ -111,6 +111,7 @@ class LayerNorm(cnn.Module):
         # Resolve dims to something indexable
         if type(dims) == int:
             dims = (dims,)
+        self.normalized_shape = tuple(dims)
 
         # Choose the matching batchnorm
         if len(dims) == 4:
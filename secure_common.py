@@ -279,7 +279,9 @@ def get_model():
             logging.info('Init model by: {}'.format(init_method))
     if DEVICE_MODE == "cpu":
         if FLAGS.use_distributed:
-            model_wrapper = udist.AllReduceDistributedDataParallel(model)
+            model_wrapper = udist.AllReduceDistributedDataParallel(
+                model, grad_bucket_cap_mb=FLAGS.get('grad_bucket_size_mb', 25),
+                grad_compression=FLAGS.get('grad_compression', None))
         else:
             # model_wrapper = torch.nn.DataParallel(model)
             raise ValueError("Non-distributed execution is not supported in Crypten, sorry")
@@ -288,7 +290,9 @@ def get_model():
             with torch.no_grad():
                 with crypten.no_grad():
                     model = model.cuda()
-            model_wrapper = udist.AllReduceDistributedDataParallel(model)
+            model_wrapper = udist.AllReduceDistributedDataParallel(
+                model, grad_bucket_cap_mb=FLAGS.get('grad_bucket_size_mb', 25),
+                grad_compression=FLAGS.get('grad_compression', None))
         else:
             # model_wrapper = torch.nn.DataParallel(model).cuda()
             raise ValueError("Non-distributed execution is not supported in Crypten, sorry")
@@ -304,11 +308,14 @@ def unwrap_model(model_wrapper):
 def get_ema_model(ema, model_wrapper):
     """Generate model from ExponentialMovingAverage.
 
-    NOTE: If `ema` is given, generate a new model wrapper. Otherwise directly
+    NOTE: If `ema` is given, generate a new model wrapper, the averages of BN
+        statistics are first synchronized over ranks. Otherwise directly
         return `model_wrapper`, in this case modifying `model_wrapper` also
         influence the following process.
     """
     if ema is not None:
+        if FLAGS.use_distributed and FLAGS.allreduce_bn:
+            udist.allreduce_ema_bn(ema)
         model_eval_wrapper = copy.deepcopy(model_wrapper)
         model_eval = unwrap_model(model_eval_wrapper)
         names = ema.average_names()
@@ -329,7 +336,9 @@ def profiling(model, use_cuda):
                     FLAGS.image_size,
                     verbose=getattr(FLAGS, 'model_profiling_verbose', True)
                     and udist.is_master(),
-                    use_cuda=DEVICE_MODE == "gpu")
+                    use_cuda=DEVICE_MODE == "gpu",
+                    profiles=FLAGS.get('latency_profiles', None),
+                    cache_path=FLAGS.get('_profiling_cache', None))
 
 
 def setup_distributed(num_images=None):
@@ -14,10 +14,13 @@ from utils.common import set_random_seed
 from utils.common import create_exp_dir
 from utils.common import setup_logging
 from utils.common import save_status
+from utils.common import load_status
 from utils.common import get_device
 from utils.common import extract_item
 from utils.common import get_data_queue_size
 from utils.common import bn_calibration
+from utils.checkpoint import checkpoint_writer
+from utils.meters import StepTimer
 from utils.fix_hook import fix_deps
 from utils import dataflow
 from utils import secure_optim as optim
@@ -79,21 +82,28 @@ def shrink_model(model_wrapper,
                                prefix=block_name,
                                verbose=False)
 
+    bn_synchronizer.reset()
     if optimizer is not None:
-        assert set(optimizer.param_groups[0]['params']) == set(
-            model.parameters())
+        assert set(params for group in optimizer.param_groups
+                   for params in group['params']) == set(model.parameters())
 
     mc.model_profiling(model,
                        FLAGS.image_size,
                        FLAGS.image_size,
                        num_forwards=0,
                        verbose=False,
-                       use_cuda=DEVICE_MODE == "gpu")
+                       use_cuda=DEVICE_MODE == "gpu",
+                       profiles=FLAGS.get('latency_profiles', None),
+                       cache_path=FLAGS.get('_profiling_cache', None))
     if udist.is_master():
         logging.info('Model Shrink to FLOPS: {}'.format(model.n_seconds))#logging.info('Model Shrink to FLOPS: {}'.format(model.n_macs))
         logging.info('Current model: {}'.format(mb.output_network(model)))
 
 
+# Cached BN buffers, rebuilt when `shrink_model` changes the model.
+bn_synchronizer = udist.BNSynchronizer()
+
+
 def get_prune_weights(model, use_transformer=False):
     """Get variables for pruning."""
     # ['features.2.ops.0.1.1.weight', 'features.2.ops.1.1.1.weight', 'features.2.ops.2.1.1.weight'...]
@@ -126,13 +136,18 @@ def log_pruned_info(model, flops_pruned, infos, prune_threshold):
             if FLAGS.prune_params['logging_verbose']:
                 logging.info(
                     'layer {}, total channel: {}, pruned channel: {}, flops'
-                    ' total: {}, flops pruned: {}, pruned rate: {:.3f}'.format(
-                        *info))
+                    ' total: {}, flops pruned: {}, MPC ms total: {:.1f}, MPC ms'
+                    ' pruned: {:.1f}, pruned rate: {:.3f}'.format(*info))
             mc.summary_writer.add_scalar(
                 'prune_ratio/{}/{}'.format(prune_threshold, info[0]), info[-1],
                 FLAGS._global_step)
         logging.info('Pruned model: {}'.format(
             prune.output_searched_network(model, infos, FLAGS.prune_params)))
+        mpc_ms_pruned = sum(info[6] for info in infos)
+        logging.info('Prune threshold: {}, MPC ms pruned: {:.1f}'.format(
+            prune_threshold, mpc_ms_pruned))
+        mc.summary_writer.add_scalar('prune/mpc_ms/{}'.format(prune_threshold),
+                                     mpc_ms_pruned, FLAGS._global_step)
 
     flops_remain = model.n_macs - flops_pruned
     if udist.is_master():
@@ -170,20 +185,16 @@ def run_one_epoch(epoch,
         model.apply(bn_calibration)
 
     if not FLAGS.use_hdfs:
-        if FLAGS.use_distributed:
-            loader.sampler.set_epoch(epoch)
+        dataflow.set_epoch(loader, epoch)
 
     results = None
     data_iterator = iter(loader)
     if not FLAGS.use_hdfs:
-        if FLAGS.use_distributed:
-            if FLAGS.dataset == 'coco':
-                data_fetcher = dataflow.DataPrefetcherKeypoint(data_iterator)
-            else:
-                data_fetcher = dataflow.DataPrefetcher(data_iterator)
-        else:
-            logging.warning('Not use prefetcher')
-            data_fetcher = data_iterator
+        data_fetcher = dataflow.get_prefetcher(data_iterator, FLAGS,
+                                               dataset=loader.dataset)
+    if train:
+        step_timer = StepTimer(DEVICE_MODE == "gpu")
+        step_timer.start()
 
     for batch_idx, data in enumerate(data_fetcher):
         if FLAGS.dataset == 'coco':
@@ -203,6 +214,7 @@ def run_one_epoch(epoch,
         if DEVICE_MODE == "gpu":
             target = target.cuda(non_blocking=True)
         if train:
+            step_timer.mark('data')
             optimizer.zero_grad()
             rho = rho_scheduler(FLAGS._global_step)
 
@@ -222,8 +234,6 @@ def run_one_epoch(epoch,
             else:
                 loss = mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=FLAGS.distill)
             if FLAGS.prune_params['method'] is not None:
-                loss_l2 = optim.cal_l2_loss(model, FLAGS.weight_decay,
-                                            FLAGS.weight_decay_method)  # manual weight decay
                 loss_bn_l1 = prune.cal_bn_l1_loss(get_prune_weights(model),
                                                   FLAGS._bn_to_prune.penalty, rho)
                 if FLAGS.prune_params.use_transformer:
@@ -241,14 +251,21 @@ def run_one_epoch(epoch,
                         logging.info(transformer_dict)
                         # logging.info(FLAGS._bn_to_prune_transformer.penalty)
 
-                meters['loss_l2'].cache(loss_l2)
                 meters['loss_bn_l1'].cache(loss_bn_l1)
-                loss = loss + loss_l2 + loss_bn_l1
+                loss = loss + loss_bn_l1
+            step_timer.mark('forward')
             loss.backward()
+            step_timer.mark('backward')
             if FLAGS.use_distributed:
                 udist.allreduce_grads(model)
+                step_timer.mark('allreduce')
 
             if FLAGS._global_step % FLAGS.log_interval == 0:
+                step_times, samples_per_sec = step_timer.summary()
+                if FLAGS.prune_params['method'] is not None:
+                    # manual weight decay is applied in `optimizer.step`
+                    loss_l2 = optim.get_l2_loss(optimizer)
+                    meters['loss_l2'].cache(loss_l2)
                 results = mc.reduce_and_flush_meters(meters)
                 if udist.is_master():
                     logging.info('Epoch {}/{} Iter {}/{} Lr: {} {}: '.format(
@@ -264,6 +281,13 @@ def run_one_epoch(epoch,
                 mc.summary_writer.add_scalar('train/learning_rate',
                                              optimizer.param_groups[0]['lr'],
                                              FLAGS._global_step)
+                if getattr(model, 'reducer', None) is not None:
+                    mc.summary_writer.add_scalar('train/allreduce_bytes',
+                                                 model.reducer.n_bytes,
+                                                 FLAGS._global_step)
+                    mc.summary_writer.add_scalar('train/allreduce_compression_ratio',
+                                                 model.reducer.n_bytes_raw / max(model.reducer.n_bytes, 1),
+                                                 FLAGS._global_step)
                 if FLAGS.prune_params['method'] is not None:
                     mc.summary_writer.add_scalar('train/l2_regularize_loss',
                                                  extract_item(loss_l2),
@@ -277,14 +301,25 @@ def run_one_epoch(epoch,
                     'train/current_epoch',
                     FLAGS._global_step / FLAGS._steps_per_epoch,
                     FLAGS._global_step)
+                mc.summary_writer.add_scalar(
+                    'data/train/prefetch_size',
+                    get_data_queue_size(data_fetcher), FLAGS._global_step)
                 if FLAGS.data_loader_workers > 0:
                     mc.summary_writer.add_scalar(
-                        'data/train/prefetch_size',
+                        'data/train/loader_queue_size',
                         get_data_queue_size(data_iterator), FLAGS._global_step)
+                for name, (mean, p95) in step_times.items():
+                    mc.summary_writer.add_scalar('time/train/{}_ms'.format(name),
+                                                 mean, FLAGS._global_step)
+                    mc.summary_writer.add_scalar('time/train/{}_p95_ms'.format(name),
+                                                 p95, FLAGS._global_step)
+                mc.summary_writer.add_scalar('time/train/samples_per_sec',
+                                             samples_per_sec, FLAGS._global_step)
 
             if udist.is_master(
             ) and FLAGS._global_step % FLAGS.log_interval_detail == 0:
                 summary_bn(model, 'train')
+            step_timer.mark('log')
 
             optimizer.step()
             if FLAGS.lr_scheduler == 'poly':
@@ -294,17 +329,17 @@ def run_one_epoch(epoch,
                                          FLAGS.num_epochs * FLAGS._steps_per_epoch)
             else:
                 lr_scheduler.step()
+            step_timer.mark('optimizer')
             if FLAGS.use_distributed and FLAGS.allreduce_bn:
-                udist.allreduce_bn(model)
+                bn_synchronizer.step(model, FLAGS.get('allreduce_bn_interval', 1))
+                step_timer.mark('bn_allreduce')
             FLAGS._global_step += 1
 
             # NOTE: after steps count update
             if ema is not None:
-                model_unwrap = mc.unwrap_model(model)
-                ema_names = ema.average_names()
-                params = get_params_by_name(model_unwrap, ema_names)
-                for name, param in zip(ema_names, params):
-                    ema(name, param, FLAGS._global_step)
+                ema.update(mc.unwrap_model(model), FLAGS._global_step)
+                step_timer.mark('ema')
+            step_timer.step(input.size(0))
         else:
             if FLAGS.dataset == 'coco':
                 outputs = model(input)
@@ -322,6 +357,8 @@ def run_one_epoch(epoch,
             else:
                 mc.forward_loss(model, criterion, input, target, meters, task=FLAGS.model_kwparams.task, distill=False)
 
+    data_fetcher.close()
+
     if not train:
         results = mc.reduce_and_flush_meters(meters)
         if udist.is_master():
@@ -400,24 +437,11 @@ def train_val_test():
         checkpoint = torch.load(os.path.join(FLAGS.resume,
                                              'latest_checkpoint.pt'),
                                 map_location=lambda storage, loc: storage)
-        model_wrapper = checkpoint['model'].cuda()
-        model = model_wrapper.module
-        # model = checkpoint['model'].module
-        optimizer = checkpoint['optimizer']
-        for state in optimizer.state.values():
-            for k, v in state.items():
-                if isinstance(v, torch.Tensor):
-                    if DEVICE_MODE == "cpu":
-                        state[k] = v
-                    else:
-                        state[k] = v.cuda()
-        # model_wrapper.load_state_dict(checkpoint['model'])
-        # optimizer.load_state_dict(checkpoint['optimizer'])
-        if ema:
-            # ema.load_state_dict(checkpoint['ema'])
-            ema = checkpoint['ema']
-            if DEVICE_MODE == "cpu": ema = ema.cuda()
-            ema.to(get_device(model))
+        # Rebuild the shrunk architecture, then load the state_dicts.
+        if checkpoint['blocks'] is not None:
+            mb.shrink_to_blocks(model, checkpoint['blocks'])
+        optimizer = optim.get_optimizer(model_wrapper, FLAGS)
+        load_status(checkpoint, model_wrapper, optimizer, ema)
         last_epoch = checkpoint['last_epoch']
         lr_scheduler = optim.get_lr_scheduler(optimizer, FLAGS, last_epoch=(last_epoch + 1) * FLAGS._steps_per_epoch)
         lr_scheduler.last_epoch = (last_epoch + 1) * FLAGS._steps_per_epoch
@@ -483,9 +507,11 @@ def train_val_test():
 
     # get bn's weights
     if FLAGS.prune_params.use_transformer:
-        FLAGS._bn_to_prune, FLAGS._bn_to_prune_transformer = prune.get_bn_to_prune(model, FLAGS.prune_params)
+        FLAGS._bn_to_prune, FLAGS._bn_to_prune_transformer = prune.get_bn_to_prune(
+            model, FLAGS.prune_params, profiles=FLAGS.get('latency_profiles', None))
     else:
-        FLAGS._bn_to_prune = prune.get_bn_to_prune(model, FLAGS.prune_params)
+        FLAGS._bn_to_prune = prune.get_bn_to_prune(
+            model, FLAGS.prune_params, profiles=FLAGS.get('latency_profiles', None))
     rho_scheduler = prune.get_rho_scheduler(FLAGS.prune_params,
                                             FLAGS._steps_per_epoch)
 
@@ -517,6 +543,7 @@ def train_val_test():
                                 phase='train')
 
         if (epoch + 1) % FLAGS.eval_interval == 0:
+            bn_synchronizer.wait()
             # val
             results, model_eval_wrapper = validate(epoch, calib_loader, val_loader,
                                                    criterion, val_meters,
@@ -539,34 +566,31 @@ def train_val_test():
             model_kwparams = mb.output_network(mc.unwrap_model(model_wrapper))
 
             if udist.is_master():
+                checkpoint_names = []
                 if FLAGS.model_kwparams.task == 'classification' and results['top1_error'] < best_val:
                     best_val = results['top1_error']
                     logging.info('New best validation top1 error: {:.4f}'.format(best_val))
 
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
 
                 elif FLAGS.model_kwparams.task == 'segmentation' and FLAGS.dataset != 'coco' and results[
                     'mIoU'] > best_val:
                     best_val = results['mIoU']
                     logging.info('New seg mIoU: {:.4f}'.format(best_val))
 
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
                 elif FLAGS.dataset == 'coco' and results > best_val:
                     best_val = results
                     logging.info('New Result: {:.4f}'.format(best_val))
-                    save_status(model_wrapper, model_kwparams, optimizer, ema,
-                                epoch, best_val, (train_meters, val_meters),
-                                os.path.join(FLAGS.log_dir, 'best_model'))
+                    checkpoint_names.append(os.path.join(FLAGS.log_dir, 'best_model'))
 
-                # save latest checkpoint
+                # save latest checkpoint, written once if it is also the best
+                checkpoint_names.append(os.path.join(FLAGS.log_dir, 'latest_checkpoint'))
                 save_status(model_wrapper, model_kwparams, optimizer, ema, epoch,
-                            best_val, (train_meters, val_meters),
-                            os.path.join(FLAGS.log_dir, 'latest_checkpoint'))
+                            best_val, (train_meters, val_meters), checkpoint_names)
 
+    # The last checkpoint is written in the background.
+    checkpoint_writer.wait()
     return
 
 
@@ -658,6 +682,9 @@ def main():
         FLAGS.model_kwparams.inverted_residual_setting = inverted_residual_setting
         FLAGS.model_kwparams.last_channel = last_channel
 
+    # Shared by all runs in the same log dir, so resumed runs reuse it
+    if FLAGS.get('profiling_cache', True):
+        FLAGS._profiling_cache = os.path.join(FLAGS.log_dir, 'profiling_cache.json')
     if udist.is_master():
         FLAGS.log_dir = '{}/{}'.format(FLAGS.log_dir,
                                        time.strftime("%Y%m%d-%H%M%S"))
@@ -40,15 +40,11 @@ def run_one_epoch(epoch,
     if phase == 'bn_calibration':
         model.apply(bn_calibration)
 
-    if FLAGS.use_distributed:
-        loader.sampler.set_epoch(epoch)
+    dataflow.set_epoch(loader, epoch)
 
     data_iterator = iter(loader)
-    if FLAGS.use_distributed:
-        data_fetcher = dataflow.DataPrefetcher(data_iterator)
-    else:
-        logging.warning('Not use prefetcher')
-        data_fetcher = data_iterator
+    data_fetcher = dataflow.get_prefetcher(data_iterator, FLAGS,
+                                           dataset=loader.dataset)
     for batch_idx, (input, target) in enumerate(data_fetcher):
         # used for bn calibration
         if max_iter is not None:
@@ -59,6 +55,8 @@ def run_one_epoch(epoch,
         if DEVICE_MODE == "gpu":
             target = target.cuda(non_blocking=True)
         mc.forward_loss(model, criterion, input, target, meters)
+    data_fetcher.close()
+
 
     results = mc.reduce_and_flush_meters(meters)
     if udist.is_master():
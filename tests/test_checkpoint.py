@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Tests for saving and resuming shrunk models, run from the repository root.
+
+import collections
+import os
+import sys
+import tempfile
+
+import torch
+import torch.nn as nn
+
+sys.path.append(".")
+import models.mobilenet_base as mb
+from utils.checkpoint import CheckpointWriter, checkpoint_writer
+from utils.common import load_status, save_status
+from utils.optim import ExponentialMovingAverage, split_weight_decay_groups
+from utils.rmsprop import RMSprop
+
+
+class _Supernet(nn.Module):
+
+    def __init__(self):
+        super(_Supernet, self).__init__()
+        self.features = nn.Sequential(
+            mb.InvertedResidualChannels(4, 4, 1, [4, 4], [3, 5], True,
+                                        active_fn=nn.ReLU,
+                                        batch_norm_kwargs={}))
+        self.classifier = nn.Linear(4, 3)
+
+    def forward(self, x):
+        return self.classifier(self.features(x).mean([2, 3]))
+
+    def get_named_block_list(self):
+        return collections.OrderedDict([('features.0', self.features[0])])
+
+
+def _build(seed):
+    torch.manual_seed(seed)
+    model = _Supernet()
+    optimizer = RMSprop(model.parameters(), lr=0.1, momentum=0.9)
+    split_weight_decay_groups(optimizer, model, 1e-2, 'slimmable')
+    ema = ExponentialMovingAverage(0.9)
+    for name, val in model.named_parameters():
+        ema.register(name, val)
+    return model, optimizer, ema
+
+
+def _train_step(model, optimizer, ema):
+    optimizer.zero_grad()
+    model(torch.randn(2, 4, 5, 5)).sum().backward()
+    optimizer.step()
+    ema.update(model)
+
+
+def _named_state(optimizer, model):
+    names = {id(params): name for name, params in model.named_parameters()}
+    return {names[id(params)]: state for params, state in optimizer.state.items()}
+
+
+def test_save_shrink_load_round_trip():
+    model, optimizer, ema = _build(0)
+    _train_step(model, optimizer, ema)
+    # Drop the 5x5 op and narrow the 3x3 one.
+    block = model.features[0]
+    block.compress_by_mask([torch.arange(4) < 3, torch.zeros(4, dtype=torch.bool)],
+                           ema=ema, optimizer=optimizer, prefix='features.0')
+    assert block.kernel_sizes == [3] and block.channels == [3]
+    _train_step(model, optimizer, ema)
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        names = [os.path.join(log_dir, 'best_model'),
+                 os.path.join(log_dir, 'latest_checkpoint')]
+        save_status(model, None, optimizer, ema, 3, 0.5, ({}, {}), names)
+        checkpoint_writer.wait()
+        checkpoint = torch.load(names[1] + '.pt')
+        assert os.path.exists(names[0] + '.pt')
+
+        # A new supernet, shrunk to the saved blocks.
+        model_new, _, ema_new = _build(1)
+        mb.shrink_to_blocks(model_new, checkpoint['blocks'])
+        block = model_new.features[0]
+        assert block.kernel_sizes == [3] and block.channels == [3]
+        optimizer_new = RMSprop(model_new.parameters(), lr=0.1, momentum=0.9)
+        split_weight_decay_groups(optimizer_new, model_new, 1e-2, 'slimmable')
+        load_status(checkpoint, model_new, optimizer_new, ema_new)
+
+    assert checkpoint['last_epoch'] == 3
+    for name, val in model.state_dict().items():
+        assert torch.equal(model_new.state_dict()[name], val), name
+    assert [len(group['params']) for group in optimizer_new.param_groups] == \
+        [len(group['params']) for group in optimizer.param_groups]
+    state, state_new = _named_state(optimizer, model), _named_state(optimizer_new, model_new)
+    assert state.keys() == state_new.keys()
+    for name, val in state.items():
+        for key in val:
+            assert torch.equal(torch.as_tensor(state_new[name][key]), torch.as_tensor(val[key]))
+    for name in ema.average_names():
+        assert torch.equal(ema_new.average(name), ema.average(name))
+
+    # Training goes on identically.
+    torch.manual_seed(2)
+    _train_step(model, optimizer, ema)
+    torch.manual_seed(2)
+    _train_step(model_new, optimizer_new, ema_new)
+    for name, val in model.state_dict().items():
+        assert torch.allclose(model_new.state_dict()[name], val), name
+
+
+def test_writer_reraises_errors():
+    writer = CheckpointWriter()
+    with tempfile.TemporaryDirectory() as log_dir:
+        writer.save({'x': torch.ones(2)}, [os.path.join(log_dir, 'missing', 'ckpt.pt')])
+        try:
+            writer.wait()
+        except (IOError, OSError, RuntimeError):
+            pass
+        else:
+            assert False, 'Error of the background write was lost'
+        # The error is raised once.
+        writer.wait()
+
+
+##### ENTRYPOINT #####
+def main():
+    test_save_shrink_load_round_trip()
+    test_writer_reraises_errors()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Tests for the bucketed gradient reducer and its compression, run from the repository root.
+
+import os
+import sys
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+sys.path.append(".")
+os.environ.setdefault('DEVICE_MODE', 'cpu')
+# `utils.config` parses the command line on import.
+if len(sys.argv) < 2 or not sys.argv[1].startswith('app:'):
+    sys.argv = sys.argv[:1] + ['app:configs/cls_imagenet.yml']
+from utils.distributed import GradientReducer, PowerSGDCompression, TopKCompression
+
+
+def _init_process_group():
+    if not dist.is_initialized():
+        dist.init_process_group('gloo', init_method='file://' + tempfile.mktemp(),
+                                rank=0, world_size=1)
+
+
+class _Model(nn.Module):
+
+    def __init__(self):
+        super(_Model, self).__init__()
+        self.unused = nn.Parameter(torch.randn(3))
+        self.a = nn.Parameter(torch.randn(3))
+        self.b = nn.Parameter(torch.randn(3))
+        self.c = nn.Parameter(torch.randn(3))
+
+    def forward(self, x):
+        # `a` is used last, so its gradient is ready first although its
+        # bucket comes after the ones of `c` and `b`.
+        return (self.a * (self.c * (self.b * x))).sum()
+
+
+def _reducer(model):
+    # Tiny buckets, one parameter each.
+    reducer = GradientReducer(model, bucket_size_mb=1e-6)
+    reduce = reducer.compression.reduce
+    keys = []
+
+    def recording_reduce(buffer, key, *args):
+        keys.append(key)
+        return reduce(buffer, key, *args)
+
+    reducer.compression.reduce = recording_reduce
+    return reducer, keys
+
+
+def _backward(model, reducer, keys):
+    model.zero_grad()
+    reducer.prepare()
+    keys.clear()
+    model(torch.randn(3)).backward()
+    launched = list(keys)
+    expected = {name: None if param.grad is None else param.grad.clone()
+                for name, param in model.named_parameters()}
+    reducer.finish()
+    return launched, expected
+
+
+def test_buckets_launched_in_order():
+    _init_process_group()
+    torch.manual_seed(0)
+    model = _Model()
+    reducer, keys = _reducer(model)
+    for _ in range(2):
+        launched, expected = _backward(model, reducer, keys)
+        assert [bucket['params'] for bucket in reducer._buckets] == \
+            [[model.c], [model.b], [model.a], [model.unused]]
+        # The bucket of `a` waits for the ones of `c` and `b`, the bucket of
+        # the unused parameter is left to `finish`.
+        assert launched == [0, 1, 2]
+        assert keys == [0, 1, 2, 3]
+        # Averaged over a single rank, the gradients are unchanged.
+        for name, param in model.named_parameters():
+            if expected[name] is None:
+                assert param.grad is None
+            else:
+                assert torch.allclose(param.grad, expected[name])
+    assert reducer.n_bytes == reducer.n_bytes_raw == 4 * 3 * 4
+
+
+def test_rebuild_after_shrink():
+    _init_process_group()
+    torch.manual_seed(0)
+    model = _Model()
+    reducer, keys = _reducer(model)
+    _backward(model, reducer, keys)
+    old_c, old_bucket = model.c, reducer._buckets[0]
+
+    # As `shrink_model` does, replace a parameter and drop another one.
+    model.c = nn.Parameter(torch.randn(3))
+    del model.unused
+    launched, expected = _backward(model, reducer, keys)
+    assert [bucket['params'] for bucket in reducer._buckets] == \
+        [[model.c], [model.b], [model.a]]
+    assert launched == keys == [0, 1, 2]
+    for name, param in model.named_parameters():
+        assert torch.allclose(param.grad, expected[name])
+
+    # The hooks of the old parameter are removed.
+    (old_c * 2).sum().backward()
+    assert old_bucket['ready'] == 0
+
+
+def test_topk_error_feedback():
+    _init_process_group()
+    compression = TopKCompression(0.25)
+    shapes = [torch.Size([8])]
+    grad = torch.tensor([8., -7., 1., 2., -3., 4., 5., 6.])
+    buffer = grad.clone()
+    compression.reduce(buffer, 0, shapes)()
+    assert buffer.tolist() == [8., -7., 0., 0., 0., 0., 0., 0.]
+    # What was not sent is added to the next step.
+    buffer = torch.zeros(8)
+    compression.reduce(buffer, 0, shapes)()
+    assert buffer.tolist() == [0., 0., 0., 0., 0., 0., 5., 6.]
+    assert compression.n_bytes == 2 * 2 * (4 + 8)
+
+
+def test_topk_residuals_unscaled():
+    _init_process_group()
+    compression = TopKCompression(0.25)
+    shapes = [torch.Size([8])]
+    grad = torch.tensor([8., -7., 1., 2., -3., 4., 5., 6.])
+    buffer = grad * 4.
+    compression.reduce(buffer, 0, shapes, torch.tensor(4.))()
+    assert torch.equal(compression.residuals[0], torch.tensor([0., 0., 1., 2., -3., 4., 5., 6.]))
+    # The loss scaler halved the scale.
+    buffer = torch.zeros(8)
+    compression.reduce(buffer, 0, shapes, torch.tensor(2.))()
+    assert buffer.tolist() == [0., 0., 0., 0., 0., 0., 10., 12.]
+
+
+def test_nonfinite_buckets_drop_residuals():
+    _init_process_group()
+    for compression in [TopKCompression(0.25), PowerSGDCompression(1)]:
+        shapes = [torch.Size([4, 4])]
+        torch.manual_seed(0)
+        compression.reduce(torch.randn(16), 0, shapes)()
+        qs = {key: q.clone() for key, q in getattr(compression, 'qs', {}).items()}
+        buffer = torch.randn(16)
+        buffer[3] = float('inf')
+        compression.reduce(buffer, 0, shapes)()
+        # The step is skipped by the loss scaler, the next one starts over.
+        assert not torch.isfinite(buffer).all()
+        assert torch.equal(compression.residuals[0], torch.zeros(16))
+        for key, q in qs.items():
+            assert torch.equal(compression.qs[key], q)
+
+
+def test_powersgd_per_tensor():
+    _init_process_group()
+    compression = PowerSGDCompression(1)
+    torch.manual_seed(0)
+    shapes = [torch.Size([8, 2, 3]), torch.Size([6]), torch.Size([2, 2])]
+    # A rank 1 weight gradient is recovered by a single power iteration.
+    weight = torch.randn(8, 1).mm(torch.randn(1, 6)).view(-1)
+    bias = torch.randn(6)
+    small = torch.randn(4)
+    buffer = torch.cat([weight, bias, small])
+    compression.reduce(buffer, 0, shapes)()
+    assert torch.allclose(buffer[:48], weight, atol=1e-5)
+    # 1-D and too small gradients are sent as they are.
+    assert torch.equal(buffer[48:], torch.cat([bias, small]))
+    assert list(compression.qs) == [(0, 0)]
+    assert compression.n_bytes == (8 + 6 + 4 + 6) * 4
+
+    # The approximation plus the residual is the gradient.
+    grad = torch.randn(58)
+    buffer = grad.clone()
+    compression.reduce(buffer, 0, shapes)()
+    assert torch.allclose(buffer[:48] + compression.residuals[0][:48], grad[:48], atol=1e-5)
+    assert torch.equal(compression.residuals[0][48:], torch.zeros(10))
+
+
+##### ENTRYPOINT #####
+def main():
+    test_buckets_launched_in_order()
+    test_rebuild_after_shrink()
+    test_topk_error_feedback()
+    test_topk_residuals_unscaled()
+    test_nonfinite_buckets_drop_residuals()
+    test_powersgd_per_tensor()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
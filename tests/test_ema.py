@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Tests for the flat exponential moving average, run from the repository root.
+
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.append(".")
+from utils.optim import ExponentialMovingAverage
+
+
+def _model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 3), nn.BatchNorm1d(3))
+    # A second dtype, so that the shadows live in two flat buffers.
+    model.register_buffer('extra', torch.randn(5, dtype=torch.float64))
+    return model
+
+
+def _ema(model):
+    ema = ExponentialMovingAverage(0.9)
+    for name, val in list(model.named_parameters()) + list(model.named_buffers()):
+        if val.is_floating_point():
+            ema.register(name, val)
+    return ema
+
+
+def _step(model):
+    with torch.no_grad():
+        for val in list(model.parameters()) + list(model.buffers()):
+            if val.is_floating_point():
+                val.add_(torch.randn_like(val))
+
+
+def test_update_matches_reference():
+    model = _model()
+    ema = _ema(model)
+    reference = {name: val.clone() for name, val in ema.state_dict()['shadow'].items()}
+    for num_updates in range(5):
+        _step(model)
+        ema.update(model, num_updates)
+        momentum = min(0.9, (1.0 + num_updates) / (10.0 + num_updates))
+        named_vars = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+        for name, val in reference.items():
+            val.mul_(momentum).add_(named_vars[name].detach(), alpha=1.0 - momentum)
+    for name, val in reference.items():
+        assert ema.average(name).dtype == val.dtype
+        assert torch.allclose(ema.average(name), val)
+    for info in ema.state_dict()['info'].values():
+        assert info['num_updates'] == 5
+        assert info['last_momemtum'] == momentum
+
+
+def test_update_after_pop():
+    model = _model()
+    ema = _ema(model)
+    ema.update(model)
+    ema.pop('0.bias')
+    _step(model)
+    expected = {name: ema.average(name).clone() * 0.9 + 0.1 * val.detach()
+                for name, val in model.named_parameters() if name != '0.bias'}
+    ema.update(model)
+    assert '0.bias' not in ema.average_names()
+    for name, val in expected.items():
+        assert torch.allclose(ema.average(name), val)
+
+
+def test_swapped_restores_training_values():
+    model = _model()
+    ema = _ema(model)
+    _step(model)
+    ema.update(model)
+    _step(model)
+    training = {name: val.clone() for name, val in model.state_dict().items()}
+    averages = {name: ema.average(name).clone() for name in ema.average_names()}
+
+    model.train()
+    with ema.swapped(model) as swapped:
+        assert swapped is model
+        named_vars = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+        for name, val in averages.items():
+            assert torch.equal(named_vars[name], val.to(named_vars[name].dtype))
+        # BN calibration changes the running statistics and the counter.
+        model(torch.randn(8, 4))
+        assert model[1].num_batches_tracked.item() == 1
+
+    for name, val in model.state_dict().items():
+        assert torch.equal(val, training[name]), name
+    for name, val in averages.items():
+        assert torch.equal(ema.average(name), val)
+
+
+##### ENTRYPOINT #####
+def main():
+    test_update_matches_reference()
+    test_update_after_pop()
+    test_swapped_restores_training_values()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
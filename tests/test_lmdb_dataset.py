@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Tests for the LMDB image dataset, run from the repository root.
+
+import os
+import pickle
+import sys
+import tempfile
+
+import lmdb
+import numpy as np
+from PIL import Image
+from torchvision.datasets import ImageFolder
+
+sys.path.append(".")
+from utils.lmdb_dataset import (INDEX_KEY, PROGRESS_KEY, RECORD_HEADER, RECORD_MAGIC,
+                                BufferReader, ImageFolderLMDB, dumps_index, encode_record,
+                                folder2lmdb)
+
+SIZES = [(40, 30), (17, 23), (32, 32), (9, 50), (25, 12)]
+
+
+def _make_images(directory):
+    """Write PNG images of `SIZES`, returns `[(path, label, array)]`."""
+    rng = np.random.RandomState(0)
+    samples = []
+    for index, (width, height) in enumerate(SIZES):
+        label = index % 2
+        class_dir = os.path.join(directory, 'class{}'.format(label))
+        os.makedirs(class_dir, exist_ok=True)
+        path = os.path.join(class_dir, '{}.png'.format(index))
+        array = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        Image.fromarray(array).save(path)
+        samples.append((path, label, array))
+    return samples
+
+
+def _write_db(path, records):
+    db = lmdb.open(path, map_size=1 << 26)
+    with db.begin(write=True) as txn:
+        for key, val in records.items():
+            txn.put(key, val)
+    db.sync()
+    db.close()
+
+
+def test_buffer_reader():
+    data = bytes(range(10))
+    reader = BufferReader(memoryview(data))
+    assert reader.read(3) == data[:3]
+    assert reader.seek(-2, os.SEEK_END) == 8
+    assert reader.read() == data[8:]
+    reader.seek(1)
+    reader.seek(2, os.SEEK_CUR)
+    assert reader.tell() == 3
+    assert reader.read(100) == data[3:]
+
+
+def test_read_records():
+    with tempfile.TemporaryDirectory() as directory:
+        samples = _make_images(os.path.join(directory, 'src'))
+        keys = [u'{}'.format(i).encode('ascii') for i in range(len(samples))]
+        records = {key: encode_record(path, label)
+                   for key, (path, label, _) in zip(keys, samples)}
+        records[INDEX_KEY] = dumps_index(keys, [label for _, label, _ in samples])
+        db_path = os.path.join(directory, 'train')
+        _write_db(db_path, records)
+
+        dataset = ImageFolderLMDB(db_path)
+        assert len(dataset) == len(samples) and not dataset.legacy
+        for index, (_, label, array) in enumerate(samples):
+            assert dataset.get_key(index) == keys[index]
+            img, target = dataset[index]
+            assert target == label
+            assert np.array_equal(np.asarray(img), array)
+        # The environment is not pickled, e.g. to DataLoader workers.
+        assert pickle.loads(pickle.dumps(dataset))._env is None
+
+
+def test_read_legacy_records():
+    with tempfile.TemporaryDirectory() as directory:
+        samples = _make_images(os.path.join(directory, 'src'))
+        keys = [u'{}'.format(i).encode('ascii') for i in range(len(samples))]
+        records = {}
+        for key, (path, label, _) in zip(keys, samples):
+            with open(path, 'rb') as f:
+                records[key] = pickle.dumps((f.read(), label))
+        records[b'__keys__'] = pickle.dumps(keys)
+        db_path = os.path.join(directory, 'train')
+        _write_db(db_path, records)
+
+        dataset = ImageFolderLMDB(db_path)
+        assert len(dataset) == len(samples) and dataset.legacy
+        for index, (_, label, array) in enumerate(samples):
+            img, target = dataset[index]
+            assert target == label
+            assert np.array_equal(np.asarray(img), array)
+
+
+def test_encode_record_downscales():
+    with tempfile.TemporaryDirectory() as directory:
+        path, _, _ = _make_images(directory)[0]
+        record = encode_record(path, 7, max_short_side=15)
+        magic, label, height, width = RECORD_HEADER.unpack_from(record)
+        assert (magic, label, height, width) == (RECORD_MAGIC, 7, 15, 20)
+        img = Image.open(BufferReader(record[RECORD_HEADER.size:]))
+        assert img.format == 'JPEG' and img.size == (width, height)
+        # Small images are stored as they are.
+        record = encode_record(path, 7, max_short_side=30)
+        with open(path, 'rb') as f:
+            assert record[RECORD_HEADER.size:] == f.read()
+
+
+def _check_dataset(db_path, samples):
+    dataset = ImageFolderLMDB(db_path)
+    assert len(dataset) == len(samples)
+    # In the order of `ImageFolder`.
+    arrays = {path: (label, array) for path, label, array in samples}
+    for index, (path, _) in enumerate(ImageFolder(os.path.dirname(os.path.dirname(path))).samples):
+        label, array = arrays[path]
+        img, target = dataset[index]
+        assert target == label
+        assert np.array_equal(np.asarray(img), array)
+
+
+def test_folder2lmdb():
+    with tempfile.TemporaryDirectory() as directory:
+        samples = _make_images(os.path.join(directory, 'src', 'train'))
+        folder2lmdb(os.path.join(directory, 'src'), os.path.join(directory, 'dst'),
+                    'train', num_workers=2, chunk_size=2)
+        _check_dataset(os.path.join(directory, 'dst', 'train'), samples)
+
+
+def test_folder2lmdb_resume():
+    with tempfile.TemporaryDirectory() as directory:
+        src_dir, dst_dir = os.path.join(directory, 'src'), os.path.join(directory, 'dst')
+        samples = _make_images(os.path.join(src_dir, 'train'))
+        folder2lmdb(src_dir, dst_dir, 'train', num_workers=2, chunk_size=2)
+
+        # Interrupted after the first chunk, marked to see it is not redone.
+        db_path = os.path.join(dst_dir, 'train')
+        db = lmdb.open(db_path, map_size=1 << 26)
+        with db.begin(write=True) as txn:
+            progress = pickle.loads(txn.get(PROGRESS_KEY))
+            progress['num_chunks'] = 1
+            txn.put(PROGRESS_KEY, pickle.dumps(progress))
+            first = txn.get(b'0')
+            txn.put(b'0', first + b'marker')
+            for key in [INDEX_KEY, b'2', b'3', b'4']:
+                txn.delete(key)
+        db.close()
+
+        folder2lmdb(src_dir, dst_dir, 'train', num_workers=2, chunk_size=2)
+        db = lmdb.open(db_path, map_size=1 << 26)
+        with db.begin(write=True) as txn:
+            assert txn.get(b'0') == first + b'marker'
+            assert pickle.loads(txn.get(PROGRESS_KEY))['num_chunks'] == 3
+            txn.put(b'0', first)
+        db.close()
+        _check_dataset(db_path, samples)
+
+        # A different layout can not be resumed.
+        try:
+            folder2lmdb(src_dir, dst_dir, 'train', num_workers=2, chunk_size=3)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Resumed with a different chunk size'
+
+
+##### ENTRYPOINT #####
+def main():
+    test_buffer_reader()
+    test_read_records()
+    test_read_legacy_records()
+    test_encode_record_downscales()
+    test_folder2lmdb()
+    test_folder2lmdb_resume()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Tests for the device meters and their reduction, run from the repository root.
+
+import os
+import sys
+import tempfile
+
+import torch
+import torch.distributed as dist
+
+sys.path.append(".")
+os.environ.setdefault('DEVICE_MODE', 'cpu')
+# `utils.config` parses the command line on import.
+if len(sys.argv) < 2 or not sys.argv[1].startswith('app:'):
+    sys.argv = sys.argv[:1] + ['app:configs/cls_imagenet.yml']
+import common as mc
+from utils.config import FLAGS
+from utils.meters import DeviceScalarMeter, ScalarMeter, StepTimer, flush_scalar_meters
+
+VALUES = {
+    'loss': [2.5, 1.5, 0.5],
+    'top1_error': [0.25, 0.75],
+}
+
+
+def _init_process_group():
+    if not dist.is_initialized():
+        dist.init_process_group('gloo', init_method='file://' + tempfile.mktemp(),
+                                rank=0, world_size=1)
+
+
+def _meters(meter_type=DeviceScalarMeter):
+    meters = {}
+    for name, values in VALUES.items():
+        meters[name] = meter_type(name)
+        for val in values:
+            meters[name].cache(torch.tensor(val, requires_grad=True) * 1.)
+    return meters
+
+
+def test_device_meter_stats():
+    meter = _meters()['loss']
+    stats = meter.stats()
+    assert not stats.requires_grad
+    assert stats.tolist() == [4.5, 3., 0.5, 2.5]
+    meter.cache_list([torch.tensor(3.), torch.tensor(-1.)])
+    assert meter.stats().tolist() == [6.5, 5., -1., 3.]
+    meter.flush(0.)
+    assert meter.stats().tolist()[:2] == [0., 0.]
+
+
+def test_flush_scalar_meters():
+    for meter_type in [ScalarMeter, DeviceScalarMeter]:
+        results = flush_scalar_meters(_meters(meter_type), 'avg')
+        assert results == {name: sum(vals) / len(vals) for name, vals in VALUES.items()}
+        assert flush_scalar_meters(_meters(meter_type), 'max') == \
+            {name: max(vals) for name, vals in VALUES.items()}
+        assert flush_scalar_meters(_meters(meter_type), 'min') == \
+            {name: min(vals) for name, vals in VALUES.items()}
+
+
+def test_reduce_and_flush_meters_single_all_reduce():
+    _init_process_group()
+    all_reduce = mc.dist.all_reduce
+    calls = []
+
+    def counting_all_reduce(tensor, *args, **kwargs):
+        calls.append(tensor.shape)
+        return all_reduce(tensor, *args, **kwargs)
+
+    use_distributed = FLAGS.get('use_distributed', False)
+    FLAGS.use_distributed = True
+    mc.dist.all_reduce = counting_all_reduce
+    try:
+        for method in ['avg', 'sum', 'max', 'min']:
+            calls.clear()
+            meters = _meters()
+            expected = flush_scalar_meters(_meters(), method)
+            assert mc.reduce_and_flush_meters(meters, method) == expected
+            # All meters in one collective.
+            assert len(calls) == 1
+            assert calls[0][0] == len(VALUES)
+            assert all(meter.stats().tolist()[1] == 0 for meter in meters.values())
+    finally:
+        mc.dist.all_reduce = all_reduce
+        FLAGS.use_distributed = use_distributed
+
+
+def test_step_timer_summary_mid_step():
+    timer = StepTimer()
+    timer.start()
+    timer.mark('data')
+    timer.mark('forward')
+    timer.step(4)
+    timer.mark('data')
+    timer.mark('forward')
+    # As the training loop does, before the step ends.
+    results, samples_per_sec = timer.summary()
+    assert list(results) == ['data', 'forward']
+    assert samples_per_sec > 0
+    timer.mark('optimizer')
+    timer.step(4)
+    results, _ = timer.summary()
+    # The marks before the summary are kept for the step.
+    assert list(results) == ['data', 'forward', 'optimizer']
+    assert all(mean >= 0 and p95 >= mean for mean, p95 in results.values())
+    assert timer.summary()[0] == {}
+
+
+##### ENTRYPOINT #####
+def main():
+    test_device_meter_stats()
+    test_flush_scalar_meters()
+    test_reduce_and_flush_meters_single_all_reduce()
+    test_step_timer_summary_mid_step()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
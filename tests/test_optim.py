@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Tests for shrinking optimizers split by weight decay, run from the repository root.
+
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.append(".")
+from models.compress_utils import _mask_along_dim
+from utils.adam import Adam
+from utils.adamw import AdamW
+from utils.optim import cal_l2_loss, get_l2_loss, split_weight_decay_groups
+from utils.rmsprop import RMSprop
+
+OPTIMIZERS = [
+    lambda params: RMSprop(params, lr=0.1, momentum=0.9, centered=True),
+    lambda params: Adam(params, lr=0.1, amsgrad=True),
+    lambda params: AdamW(params, lr=0.1),
+]
+
+
+def _model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 4, 1), nn.BatchNorm2d(4), nn.Conv2d(4, 2, 1))
+
+
+def _optimizer(model, get_optimizer):
+    optimizer = get_optimizer(model.parameters())
+    split_weight_decay_groups(optimizer, model, 1e-2, 'slimmable')
+    model(torch.randn(2, 3, 5, 5)).sum().backward()
+    optimizer.step()
+    return optimizer
+
+
+def _group_of(optimizer, var):
+    for index, group in enumerate(optimizer.param_groups):
+        if any(var is params for params in group['params']):
+            return index
+    return None
+
+
+def test_split_weight_decay_groups():
+    model = _model()
+    optimizer = _optimizer(model, OPTIMIZERS[0])
+    # Convolution weights are decayed, biases and BN affine are not.
+    assert [group['weight_decay'] for group in optimizer.param_groups] == [1e-2, 0.0]
+    assert _group_of(optimizer, model[0].weight) == 0
+    assert _group_of(optimizer, model[1].weight) == 1
+    assert torch.allclose(get_l2_loss(optimizer), cal_l2_loss(model, 1e-2, 'slimmable'))
+    # Calling it again keeps the groups.
+    split_weight_decay_groups(optimizer, model, 1e-2, 'slimmable')
+    assert len(optimizer.param_groups) == 2
+
+
+def test_compress_split_groups():
+    for get_optimizer in OPTIMIZERS:
+        model = _model()
+        optimizer = _optimizer(model, get_optimizer)
+        mask = torch.tensor([True, False, True, False])
+        infos = []
+        for name, var, dim in [('0.weight', model[0].weight, 0),
+                               ('0.bias', model[0].bias, 0),
+                               ('1.weight', model[1].weight, 0),
+                               ('2.weight', model[2].weight, 1)]:
+            shape = list(var.shape)
+            shape[dim] = int(mask.sum())
+            infos.append({
+                'var_old_name': name,
+                'var_new_name': name,
+                'var_old': var,
+                'var_new': nn.Parameter(torch.zeros(shape)),
+                'type': 'variable',
+                'mask': mask,
+                'mask_hook': lambda lhs, rhs, mask, dim=dim: _mask_along_dim(lhs, rhs, mask, dim=dim),
+            })
+        # Vars of the first group are followed by the other groups in the loop.
+        for info in infos:
+            group = _group_of(optimizer, info['var_old'])
+            optimizer.compress_mask(info)
+            assert _group_of(optimizer, info['var_old']) is None
+            assert _group_of(optimizer, info['var_new']) == group
+            old_state = {key: val for key, val in optimizer.state.items() if key is info['var_old']}
+            assert not old_state
+            for val in optimizer.state[info['var_new']].values():
+                if torch.is_tensor(val):
+                    assert val.shape == info['var_new'].shape
+        for info in infos[::-1]:
+            optimizer.compress_drop(dict(info, var_old=info['var_new']))
+            assert _group_of(optimizer, info['var_new']) is None
+            assert not any(key is info['var_new'] for key in optimizer.state)
+        remaining = [params for group in optimizer.param_groups for params in group['params']]
+        assert len(remaining) == 2
+        assert all(_group_of(optimizer, var) is not None for var in [model[1].bias, model[2].bias])
+
+        try:
+            optimizer.compress_drop(infos[0])
+        except AssertionError:
+            pass
+        else:
+            assert False, 'Dropped a var not in the optimizer'
+
+
+##### ENTRYPOINT #####
+def main():
+    test_split_weight_decay_groups()
+    test_compress_split_groups()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Tests for the vectorised BN L1 sparsity loss and the pruning penalties, run from
+# the repository root.
+
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.append(".")
+# `utils.config` parses the command line on import.
+if len(sys.argv) < 2 or not sys.argv[1].startswith('app:'):
+    sys.argv = sys.argv[:1] + ['app:configs/cls_imagenet.yml']
+import models.mobilenet_base as mb
+from utils.config import AttrDict
+from utils.prune import BNL1Loss, PruneInfo, PruneInfoTransformer, cal_bn_l1_loss, get_bn_to_prune
+
+
+def _model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 4, 1), nn.BatchNorm2d(4),
+                          nn.Conv2d(4, 6, 1), nn.BatchNorm2d(6))
+    for m in [model[1], model[3]]:
+        nn.init.normal_(m.weight)
+    return model
+
+
+def _reference(model, prune_info, rho):
+    named_parameters = dict(model.named_parameters())
+    return cal_bn_l1_loss([named_parameters[name] for name in prune_info.weight],
+                          prune_info.penalty, rho)
+
+
+def test_bn_l1_loss_matches_reference():
+    model = _model()
+    prune_info = PruneInfo(['1.weight', '3.weight'], [0.5, 2.0])
+    bn_l1_loss = BNL1Loss()
+
+    loss = bn_l1_loss(model, prune_info, 1e-3)
+    expected = _reference(model, prune_info, 1e-3)
+    assert torch.allclose(loss, expected)
+
+    grads = torch.autograd.grad(loss, [model[1].weight, model[3].weight])
+    expected_grads = torch.autograd.grad(expected, [model[1].weight, model[3].weight])
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad)
+
+
+def test_bn_l1_loss_follows_weight_updates():
+    model = _model()
+    prune_info = PruneInfo(['1.weight', '3.weight'], [0.5, 2.0])
+    bn_l1_loss = BNL1Loss()
+    bn_l1_loss(model, prune_info, 1.)
+
+    # In place updates, as by the optimizer, are seen through the cache.
+    with torch.no_grad():
+        model[3].weight.mul_(-3.)
+    assert torch.allclose(bn_l1_loss(model, prune_info, 1.), _reference(model, prune_info, 1.))
+
+
+def test_bn_l1_loss_rebuilds_after_compress():
+    model = _model()
+    prune_info = PruneInfo(['1.weight', '3.weight'], [0.5, 2.0])
+    bn_l1_loss = BNL1Loss()
+    bn_l1_loss(model, prune_info, 1.)
+
+    # Shrinking replaces parameters and bumps the version of `PruneInfo`.
+    model[3] = nn.BatchNorm2d(2)
+    nn.init.normal_(model[3].weight)
+    prune_info.compress_start()
+    assert torch.allclose(bn_l1_loss(model, prune_info, 1.), _reference(model, prune_info, 1.))
+
+    prune_info.compress_start()
+    prune_info.compress_drop({'var_old_name': '3.weight'})
+    assert torch.allclose(bn_l1_loss(model, prune_info, 1.), _reference(model, prune_info, 1.))
+
+
+def test_mpc_penalties_transformer_like_depthwise():
+    # Normalized as by `get_bn_to_prune`.
+    norm_factor, per_channel_mpc_ms = 0.5, 3.
+    prune_info = PruneInfo(['dw.weight'], [per_channel_mpc_ms / norm_factor])
+    prune_info_transformer = PruneInfoTransformer(
+        ['transformer.input_norm.weight'], [per_channel_mpc_ms / norm_factor], norm_factor)
+    for name, val in [('per_channel_flops', 1e3), ('flops', 1e5), ('channels', 16),
+                      ('initial_channels', 16), ('per_channel_mpc_ms', per_channel_mpc_ms)]:
+        prune_info_transformer.add_info_list(name, [val])
+    # Channels of the same MPC latency get the same penalty, also after shrinking.
+    for channels in [16, 4]:
+        prune_info_transformer.add_info_list('channels', [channels])
+        prune_info_transformer.update_penalty()
+        assert prune_info_transformer.penalty == prune_info.penalty
+
+
+class _Supernet(nn.Module):
+
+    def __init__(self):
+        super(_Supernet, self).__init__()
+        self.block = mb.InvertedResidualChannels(4, 4, 1, [4, 4], [3, 5], True,
+                                                 active_fn=nn.ReLU,
+                                                 batch_norm_kwargs={})
+        for op in self.block.ops:
+            op.n_macs = 100
+
+    def get_named_block_list(self):
+        return {'block': self.block}
+
+
+def test_zero_penalties_raise():
+    # Without recorded shapes, every predicted latency is zero.
+    flags = AttrDict({'bn_prune_filter': 'mpc_latency', 'use_transformer': False})
+    try:
+        get_bn_to_prune(_Supernet(), flags, verbose=False)
+    except ValueError:
+        pass
+    else:
+        assert False, 'Normalized zero penalties'
+
+    flags = AttrDict({'bn_prune_filter': 'expansion_only', 'use_transformer': False})
+    prune_info = get_bn_to_prune(_Supernet(), flags, verbose=False)
+    assert prune_info.get_info_list('per_channel_mpc_ms') == [0, 0]
+
+
+##### ENTRYPOINT #####
+def main():
+    test_bn_l1_loss_matches_reference()
+    test_bn_l1_loss_follows_weight_updates()
+    test_bn_l1_loss_rebuilds_after_compress()
+    test_mpc_penalties_transformer_like_depthwise()
+    test_zero_penalties_raise()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
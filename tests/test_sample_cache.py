@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Tests for the cache of decoded samples, run from the repository root.
+
+import os
+import pickle
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+sys.path.append(".")
+from utils.sample_cache import SampleCache, ToUint8Tensor, split_transform
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+class _Images(Dataset):
+
+    def __init__(self, transform, num_samples=10):
+        rng = np.random.RandomState(0)
+        self.images = [Image.fromarray(rng.randint(0, 256, (9, 7, 3), dtype=np.uint8))
+                       for _ in range(num_samples)]
+        self.transform = transform
+
+    def __getitem__(self, index):
+        return self.transform(self.images[index]), index % 4
+
+    def __len__(self):
+        return len(self.images)
+
+
+def test_split_transform():
+    transform = transforms.Compose([transforms.CenterCrop(5), transforms.ToTensor(),
+                                    transforms.Normalize(MEAN, STD)])
+    uint8_transform, (mean, std) = split_transform(transform)
+    assert (mean, std) == (MEAN, STD)
+    assert isinstance(uint8_transform.transforms[-1], ToUint8Tensor)
+    # Normalized on device, the samples are the same.
+    img = _Images(transform).images[0]
+    uint8 = uint8_transform(img)
+    assert uint8.dtype == torch.uint8 and uint8.shape == (3, 5, 5)
+    normalized = (uint8.float() / 255 - torch.tensor(mean)[:, None, None]) \
+        / torch.tensor(std)[:, None, None]
+    assert torch.allclose(normalized, transform(img), atol=1e-5)
+
+    assert split_transform(transforms.Compose([transforms.ToTensor()])) is None
+    assert split_transform(transforms.ToTensor()) is None
+
+
+def test_sample_cache_read_back():
+    dataset = _Images(transforms.Compose([transforms.CenterCrop(5), ToUint8Tensor()]))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cache', 'val')
+        cache = SampleCache(dataset, path, normalize=(MEAN, STD))
+        assert len(cache) == len(dataset) and cache.normalize == (MEAN, STD)
+        for index in range(len(dataset)):
+            img, target = cache[index]
+            expected_img, expected_target = dataset[index]
+            assert torch.equal(img, expected_img) and target == expected_target
+        # Workers map the file themselves.
+        assert pickle.loads(pickle.dumps(cache)).images is None
+
+        # Reused while the meta matches, rebuilt for another subset.
+        mtime = os.stat(path + '.images.npy').st_mtime_ns
+        SampleCache(dataset, path)
+        assert os.stat(path + '.images.npy').st_mtime_ns == mtime
+        cache = SampleCache(dataset, path, indices=[7, 2, 5])
+        assert len(cache) == 3
+        for index, dataset_index in enumerate([7, 2, 5]):
+            img, target = cache[index]
+            assert torch.equal(img, dataset[dataset_index][0])
+            assert target == dataset[dataset_index][1]
+
+
+##### ENTRYPOINT #####
+def main():
+    test_split_transform()
+    test_sample_cache_read_back()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
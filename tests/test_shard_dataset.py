@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Tests for the sequential record shards, run from the repository root.
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(".")
+from utils.shard_dataset import (CONFIG_NAME, INDEX_NAME, ShardedImageFolder, ShardStream,
+                                 folder2shards, load_index, shard_name, worker_quota)
+
+NUM_IMAGES = 7
+
+
+def _make_images(directory):
+    """Write PNG images, returns `{image bytes: label}`."""
+    rng = np.random.RandomState(0)
+    images = {}
+    for index in range(NUM_IMAGES):
+        label = index % 3
+        class_dir = os.path.join(directory, 'class{}'.format(label))
+        os.makedirs(class_dir, exist_ok=True)
+        array = rng.randint(0, 256, (8 + index, 12, 3), dtype=np.uint8)
+        Image.fromarray(array).save(os.path.join(class_dir, '{}.png'.format(index)))
+        images[array.tobytes()] = label
+    return images
+
+
+def _convert(directory, **kwargs):
+    images = _make_images(os.path.join(directory, 'src', 'train'))
+    kwargs = dict({'num_workers': 2, 'shard_size': 3}, **kwargs)
+    folder2shards(os.path.join(directory, 'src'), os.path.join(directory, 'dst'),
+                  'train', **kwargs)
+    return images, os.path.join(directory, 'dst', 'train')
+
+
+def _samples(dataset):
+    return [(np.asarray(img).tobytes(), target) for img, target in dataset]
+
+
+def test_folder2shards_read_back():
+    with tempfile.TemporaryDirectory() as directory:
+        images, path = _convert(directory)
+        index = load_index(path)
+        assert index['shards'].tolist() == [0, 0, 0, 1, 1, 1, 2]
+        dataset = ShardedImageFolder(path)
+        samples = [dataset[i] for i in range(len(dataset))]
+        assert len(samples) == NUM_IMAGES
+        assert dict(_samples(samples)) == images
+        assert [target for _, target in samples] == index['labels'].tolist()
+
+
+def test_folder2shards_resume():
+    with tempfile.TemporaryDirectory() as directory:
+        _, path = _convert(directory)
+        index = load_index(path)
+        # Interrupted before the last shard and the index.
+        os.remove(os.path.join(path, shard_name(2)))
+        os.remove(os.path.join(path, INDEX_NAME))
+        mtime = os.stat(os.path.join(path, shard_name(0))).st_mtime_ns
+        _convert(directory)
+        assert os.stat(os.path.join(path, shard_name(0))).st_mtime_ns == mtime
+        for key, val in load_index(path).items():
+            assert np.array_equal(val, index[key]), key
+
+        # Shards of another order or size are not mixed in.
+        for kwargs in [{'seed': 1}, {'shard_size': 2}, {'max_short_side': 8}]:
+            try:
+                _convert(directory, **kwargs)
+            except ValueError:
+                pass
+            else:
+                assert False, 'Resumed {} with {}'.format(CONFIG_NAME, kwargs)
+
+
+def test_shard_stream():
+    with tempfile.TemporaryDirectory() as directory:
+        images, path = _convert(directory)
+        sequential = ShardedImageFolder(path)
+        stream = ShardStream(path, shuffle=False).with_loader(1)
+        assert len(stream) == NUM_IMAGES
+        assert _samples(stream) == _samples(sequential[i] for i in range(NUM_IMAGES))
+
+        stream = ShardStream(path, shuffle_buffer=4, seed=3).with_loader(2, drop_last=True)
+        assert len(stream) == NUM_IMAGES - 1
+        for epoch in range(2):
+            stream.set_epoch(epoch)
+            samples = _samples(stream)
+            assert len(samples) == NUM_IMAGES - 1
+            assert all(images[img] == target for img, target in samples)
+        # The same shuffle for the same epoch.
+        assert _samples(stream) == samples
+
+
+def test_worker_quota():
+    for num_samples, batch_size, num_workers in [(10, 3, 2), (7, 2, 3), (4, 4, 2)]:
+        for drop_last in [False, True]:
+            quotas = [worker_quota(num_samples, batch_size, num_workers, worker_id, drop_last)
+                      for worker_id in range(num_workers)]
+            expected = num_samples - num_samples % batch_size if drop_last else num_samples
+            assert sum(quotas) == expected
+    assert [worker_quota(10, 3, 2, worker_id, False) for worker_id in range(2)] == [6, 4]
+
+
+##### ENTRYPOINT #####
+def main():
+    test_folder2shards_read_back()
+    test_folder2shards_resume()
+    test_shard_stream()
+    test_worker_quota()
+    print('OK')
+    return 0
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    exit(main())
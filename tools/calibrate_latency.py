@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# CALIBRATE LATENCY.py
+#   by Lut99
+#
+# Created:
+#   17 Oct 2026, 10:12:31
+# Last edited:
+#   17 Oct 2026, 10:12:31
+# Auto updated?
+#   Yes
+#
+# Description:
+#   Benchmarks layers under CrypTen on a local two-party MPC setup and fits
+#   the latency regressors used by `utils/secure_profiling_prediction.py`.
+#
+#   The regressors are written as `<op>_<party>_LR_model.joblib` and
+#   `<op>_<party>_scaler.joblib` to a profile directory under
+#   `utils/LR_model`, the same format as the shipped `powerful` and `weak`
+#   profiles. Features are computed with the same functions the profiler
+#   uses, so the two always agree.
+#
+#   Next to the regressors, the raw measurements are written to
+#   `<op>_<party>_measurements.csv` and the error of every regressor on a
+#   held-out part of the measurements to `calibration_report.csv`.
+#
+
+import argparse
+import os
+import sys
+import time
+import typing
+
+import numpy as np
+import pandas as pd
+import torch
+from joblib import dump
+from sklearn.linear_model import LinearRegression
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.secure_profiling_prediction import OP_FEATURES, get_profile_path
+from utils.secure_profiling_prediction import conv_features, linear_features, relu_features, bn_features, avgpool_features, maxpool_features
+from utils.secure_profiling_prediction import mha_features, softmax_features, layernorm_features, upsample_features, pad_features
+
+
+##### CONSTANTS #####
+# The parties of the MPC setup, in order of their rank.
+PARTIES = ["client", "server"]
+# The ops benchmarked when none are given.
+DEFAULT_OPS = ["conv", "fc", "relu", "bn", "ap", "mp", "mha", "softmax", "ln", "up", "pad"]
+
+
+
+
+
+##### BENCHMARKS #####
+# Every benchmark has a grid of parameters, a function that builds the (plaintext) module and its inputs for one point
+# of the grid, and a function that computes the predictor features for that point.
+
+def image_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ "channels": c, "size": s } for c in [8, 32, 128] for s in [8, 16, 32, 56]]
+
+def image_shape(p: typing.Dict[str, int]) -> typing.List[int]:
+    return [1, p["channels"], p["size"], p["size"]]
+
+
+def conv_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ **p, "out_channels": p["channels"] * m, "kernel_size": k } for p in image_grid() for m in [1, 2] for k in [1, 3, 5]]
+
+def conv_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.Conv2d(p["channels"], p["out_channels"], p["kernel_size"], padding=p["kernel_size"] // 2), (torch.rand(image_shape(p)),)
+
+def conv_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return conv_features(image_shape(p), [1, p["out_channels"], p["size"], p["size"]], [p["kernel_size"], p["kernel_size"]])
+
+
+def fc_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ "in_features": i, "out_features": o } for i in [64, 256, 1024, 4096] for o in [10, 100, 1000]]
+
+def fc_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.Linear(p["in_features"], p["out_features"]), (torch.rand(1, p["in_features"]),)
+
+def fc_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return linear_features([1, p["in_features"]], [1, p["out_features"]])
+
+
+def relu_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.ReLU(), (torch.rand(image_shape(p)) - 0.5,)
+
+def relu_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return relu_features(image_shape(p), image_shape(p))
+
+
+def bn_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.BatchNorm2d(p["channels"]), (torch.rand(image_shape(p)),)
+
+def bn_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return bn_features(image_shape(p), image_shape(p))
+
+
+def pool_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ **p, "kernel_size": k } for p in image_grid() for k in [2, 3]]
+
+def ap_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.AvgPool2d(p["kernel_size"]), (torch.rand(image_shape(p)),)
+
+def ap_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return avgpool_features(image_shape(p), [1, p["channels"], p["size"] // p["kernel_size"], p["size"] // p["kernel_size"]], p["kernel_size"])
+
+def mp_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.MaxPool2d(p["kernel_size"]), (torch.rand(image_shape(p)),)
+
+def mp_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return maxpool_features(image_shape(p), [1, p["channels"], p["size"] // p["kernel_size"], p["size"] // p["kernel_size"]], p["kernel_size"])
+
+
+def mha_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ "tokens": l, "embed_dim": e, "num_heads": h } for l in [16, 32, 64, 128] for e in [16, 64, 144] for h in [1, 2, 4] if e % h == 0]
+
+def mha_build(p: typing.Dict[str, int]):
+    from models.secure_multi_head_attention import MultiHeadAttention
+    x = torch.rand(1, p["tokens"], p["embed_dim"])
+    return MultiHeadAttention(p["embed_dim"], p["num_heads"], dropout=0.0), (x, x, x)
+
+def mha_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return mha_features(p["tokens"], p["tokens"], p["embed_dim"], p["num_heads"], 1)
+
+
+def softmax_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ "rows": r, "dim": d } for r in [16, 64, 256, 1024] for d in [16, 64, 256]]
+
+def softmax_build(p: typing.Dict[str, int]):
+    import crypten.nn as cnn
+    return cnn.Softmax(-1), (torch.rand(p["rows"], p["dim"]),)
+
+def softmax_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return softmax_features([p["rows"], p["dim"]])
+
+
+def ln_build(p: typing.Dict[str, int]):
+    from models.secure_layernorm import LayerNorm
+    shape = (1, p["channels"], p["size"], p["size"])
+    return LayerNorm(shape), (torch.rand(shape),)
+
+def ln_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    shape = [1, p["channels"], p["size"], p["size"]]
+    return layernorm_features(shape, shape[1:])
+
+
+def up_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ **p, "scale": s } for p in image_grid() for s in [2, 4]]
+
+def up_build(p: typing.Dict[str, int]):
+    from models.secure_upsample import UpsampleNearest
+    return UpsampleNearest(scale_factor=p["scale"]), (torch.rand(1, p["channels"], p["size"], p["size"]),)
+
+def up_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    return upsample_features([1, p["channels"], p["size"], p["size"]], [1, p["channels"], p["size"] * p["scale"], p["size"] * p["scale"]])
+
+
+def pad_grid() -> typing.List[typing.Dict[str, int]]:
+    return [{ **p, "padding": pad } for p in image_grid() for pad in [1, 2, 3]]
+
+def pad_build(p: typing.Dict[str, int]):
+    from models.secure_padding import ZeroPad2d
+    return ZeroPad2d(p["padding"]), (torch.rand(1, p["channels"], p["size"], p["size"]),)
+
+def pad_row(p: typing.Dict[str, int]) -> typing.List[int]:
+    size = p["size"] + 2 * p["padding"]
+    return pad_features([1, p["channels"], p["size"], p["size"]], [1, p["channels"], size, size])
+
+
+# Maps op names (as used in `OP_FEATURES`) to their (grid, build, row) functions.
+BENCHMARKS = {
+    "conv": (conv_grid, conv_build, conv_row),
+    "fc": (fc_grid, fc_build, fc_row),
+    "relu": (image_grid, relu_build, relu_row),
+    "bn": (image_grid, bn_build, bn_row),
+    "ap": (pool_grid, ap_build, ap_row),
+    "mp": (pool_grid, mp_build, mp_row),
+    "mha": (mha_grid, mha_build, mha_row),
+    "softmax": (softmax_grid, softmax_build, softmax_row),
+    "ln": (image_grid, ln_build, ln_row),
+    "up": (up_grid, up_build, up_row),
+    "pad": (pad_grid, pad_build, pad_row),
+}
+
+
+
+
+
+##### HELPER FUNCTIONS #####
+def benchmark_party(ops: typing.List[str], repeats: int, warmup: int) -> typing.Dict[str, typing.List[float]]:
+    """
+        Runs all benchmarks of the given ops in one party of the MPC setup.
+
+        Must be run in every party at the same time, see `crypten.mpc.run_multiprocess()`.
+
+        # Arguments
+        - `ops`: The ops to benchmark.
+        - `repeats`: The number of timed forward passes per grid point.
+        - `warmup`: The number of untimed forward passes before timing.
+
+        # Returns
+        A dict mapping every op to the median wall time (in ms) of every point in its grid.
+    """
+
+    import crypten
+
+    # Same seed in every party, so the shared inputs agree
+    torch.manual_seed(0)
+    res = {}
+    for op in ops:
+        grid, build, _ = BENCHMARKS[op]
+        res[op] = []
+        for params in grid():
+            module, inputs = build(params)
+            module.encrypt()
+            module.eval()
+            inputs = [crypten.cryptensor(x) for x in inputs]
+            with crypten.no_grad():
+                for _ in range(warmup):
+                    module(*inputs)
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    module(*inputs)
+                    times.append((time.perf_counter() - start) * 1000)
+            res[op].append(float(np.median(times)))
+    return res
+
+def fit(op: str, rows: typing.List[typing.List[int]], times: typing.List[float]) -> typing.Tuple[LinearRegression, MinMaxScaler]:
+    """
+        Fits a latency regressor in the same format as the shipped ones.
+
+        # Arguments
+        - `op`: The op to fit, used to find the feature names.
+        - `rows`: The feature rows of every measurement.
+        - `times`: The measured wall time (in ms) of every row.
+
+        # Returns
+        A tuple of the fitted regressor and its input scaler.
+    """
+
+    X = pd.DataFrame(rows, columns=OP_FEATURES[op])
+    scaler = MinMaxScaler().fit(X)
+    reg = LinearRegression().fit(scaler.transform(X), times)
+    return reg, scaler
+
+def evaluate(reg: LinearRegression, scaler: MinMaxScaler, op: str, rows: typing.List[typing.List[int]], times: typing.List[float]) -> typing.Dict[str, float]:
+    """
+        Computes the error of a fitted regressor on (held-out) measurements.
+
+        Predictions are rounded and clipped the same way `LatencyPredictor` does.
+
+        # Returns
+        A dict with the mean absolute error (`mae_ms`), the mean absolute percentage error (`mape`) and `r2`.
+    """
+
+    if len(rows) == 0:
+        return { "mae_ms": float("nan"), "mape": float("nan"), "r2": float("nan") }
+    times = np.asarray(times)
+    pred = np.maximum(np.rint(reg.predict(scaler.transform(pd.DataFrame(rows, columns=OP_FEATURES[op])))), 0)
+    ss_tot = np.sum((times - times.mean()) ** 2)
+    return {
+        "mae_ms": float(np.mean(np.abs(pred - times))),
+        "mape": float(np.mean(np.abs(pred - times) / np.maximum(times, 1e-9))),
+        "r2": float(1 - np.sum((pred - times) ** 2) / ss_tot) if ss_tot > 0 else float("nan"),
+    }
+
+
+
+
+
+##### ENTRYPOINT #####
+def main(output_dir: str, fix_dirs: bool, ops: typing.List[str], repeats: int, warmup: int, test_fraction: float, seed: int) -> int:
+    """
+        Main function of the script.
+
+        # Arguments
+        - `output_dir`: The profile directory to write the regressors to.
+        - `fix_dirs`: Whether to create the output directory if it is missing (True) or error (False).
+        - `ops`: The ops to benchmark and fit.
+        - `repeats`: The number of timed forward passes per grid point.
+        - `warmup`: The number of untimed forward passes before timing.
+        - `test_fraction`: The fraction of the measurements held out to report the error of the regressors.
+        - `seed`: The seed used to split the measurements.
+
+        # Returns
+        An exit code for the script. `0` means OK, anything else means bad.
+    """
+
+    import crypten.mpc as mpc
+    from utils.fix_hook import fix_deps
+
+    for op in ops:
+        if op not in BENCHMARKS:
+            print(f"ERROR: Unknown op '{op}' (options: {', '.join(BENCHMARKS.keys())})", file=sys.stderr)
+            return 1
+    if not os.path.isdir(output_dir):
+        if not fix_dirs:
+            print(f"ERROR: Directory '{output_dir}' does not exist", file=sys.stderr)
+            return 1
+        print(f" - Creating missing directory '{output_dir}'...")
+        os.makedirs(output_dir)
+
+    # Run the benchmarks in all parties at once
+    fix_deps()
+    print(f"Benchmarking {', '.join(ops)} with {len(PARTIES)} parties ({repeats} repeats, {warmup} warmup)...")
+    results = mpc.run_multiprocess(world_size=len(PARTIES))(benchmark_party)(ops, repeats, warmup)
+
+    # Fit the regressors per party on the training part, and report on the held-out part
+    rng = np.random.RandomState(seed)
+    report = []
+    for op in ops:
+        grid, _, row = BENCHMARKS[op]
+        params = grid()
+        rows = [row(p) for p in params]
+        order = rng.permutation(len(rows))
+        n_test = int(round(len(rows) * test_fraction))
+        test, train = order[:n_test], order[n_test:]
+        for party, party_results in zip(PARTIES, results):
+            times = party_results[op]
+            prefix = os.path.join(output_dir, f"{op}_{party}")
+            pd.DataFrame([{ **p, **dict(zip(OP_FEATURES[op], r)), "TIME": t, "SPLIT": "test" if i in test else "train" } for i, (p, r, t) in enumerate(zip(params, rows, times))]).to_csv(f"{prefix}_measurements.csv", index=False)
+
+            reg, scaler = fit(op, [rows[i] for i in train], [times[i] for i in train])
+            print(f" - Writing '{prefix}_LR_model.joblib' ({len(train)} train, {len(test)} test samples)")
+            dump(reg, f"{prefix}_LR_model.joblib")
+            dump(scaler, f"{prefix}_scaler.joblib")
+            report.append({ "op": op, "party": party, "n_train": len(train), "n_test": len(test), **evaluate(reg, scaler, op, [rows[i] for i in test], [times[i] for i in test]) })
+
+    # Write the error report
+    report = pd.DataFrame(report)
+    report.to_csv(os.path.join(output_dir, "calibration_report.csv"), index=False)
+    print(f"Held-out error (written to '{os.path.join(output_dir, 'calibration_report.csv')}'):")
+    print(report.to_string(index=False))
+
+    # Done!
+    return 0
+
+
+
+# Actual entrypoint
+if __name__ == "__main__":
+    # Define the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("PROFILE", help="The name of the profile to write, i.e., a directory in `utils/LR_model`.")
+    parser.add_argument("-o", "--output-dir", help="If given, writes the profile to this directory instead of `utils/LR_model/<PROFILE>`.")
+    parser.add_argument("-f", "--fix-dirs", action="store_true", help="If given, creates the output directory if it does not exist.")
+    parser.add_argument("--ops", nargs="+", default=DEFAULT_OPS, help=f"The ops to benchmark. Options: {', '.join(BENCHMARKS.keys())}.")
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="The number of timed forward passes per benchmark.")
+    parser.add_argument("-w", "--warmup", type=int, default=1, help="The number of untimed forward passes before timing.")
+    parser.add_argument("-t", "--test-fraction", type=float, default=0.2, help="The fraction of the measurements held out for the error report.")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="The seed used to split the measurements.")
+
+    # Parse the arguments
+    args = parser.parse_args()
+    output_dir = args.output_dir if args.output_dir is not None else get_profile_path(args.PROFILE)
+
+    # Run main
+    exit(main(output_dir, args.fix_dirs, args.ops, args.repeats, args.warmup, args.test_fraction, args.seed))
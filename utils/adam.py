@@ -4,6 +4,7 @@ import logging
 from torch.optim.optimizer import Optimizer
 from utils.common import index_tensor_in
 from utils.common import check_tensor_in
+from utils.common import foreach_add
 
 
 class Adam(Optimizer):
@@ -19,7 +20,8 @@ class Adam(Optimizer):
             running averages of gradient and its square (default: (0.9, 0.999))
         eps (float, optional): term added to the denominator to improve
             numerical stability (default: 1e-8)
-        weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        weight_decay (float, optional): weight decay (L2 penalty) (default: 0),
+            added to the gradients of a group with one multi-tensor op
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
@@ -65,10 +67,11 @@ class Adam(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad
+            params = [p for p in group['params'] if p.grad is not None]
+            grads = [p.grad for p in params]
+            if group['weight_decay'] != 0:
+                grads = foreach_add(grads, params, alpha=group['weight_decay'])
+            for p, grad in zip(params, grads):
                 if grad.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
                 amsgrad = group['amsgrad']
@@ -95,9 +98,6 @@ class Adam(Optimizer):
                 bias_correction1 = 1 - beta1 ** state['step']
                 bias_correction2 = 1 - beta2 ** state['step']
 
-                if group['weight_decay'] != 0:
-                    grad = grad.add(p, alpha=group['weight_decay'])
-
                 # Decay the first and second moment running average coefficient
                 exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
                 exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
@@ -163,4 +163,5 @@ class Adam(Optimizer):
                 if check_tensor_in(var_old, self.state):
                     self.state.pop(var_old)
                 del group['params'][index]
+                break
         assert found, 'Var: {} not in RMSProp'.format(info['var_old_name'])
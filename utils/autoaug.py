@@ -14,6 +14,13 @@ import random
 import numpy as np
 from collections import defaultdict
 import PIL, PIL.ImageOps, PIL.ImageEnhance, PIL.ImageDraw
+import torch
+import torch.nn.functional as F
+
+from utils.transforms import batch_blend
+from utils.transforms import batch_brightness
+from utils.transforms import batch_contrast
+from utils.transforms import batch_saturation
 
 RESAMPLE_MODE=PIL.Image.BICUBIC#PIL.Image.BILINEAR#
 
@@ -196,3 +203,195 @@ class RandAugment(object):
             val = (float(self.m) / 30) * float(maxval - minval) + minval
             img = op(img, val)
         return img
+
+
+# Batched RandAugment, on float `[N, C, H, W]` tensors with values in [0, 255].
+# Every op takes the samples it is applied to and the magnitude `v` of the
+# PIL op of the same name, random signs are drawn per sample. Geometric ops
+# sample bilinearly and fill with black, like PIL's `transform`.
+
+
+def _random_sign(x, v, mirror=None):
+    v = torch.full((x.size(0),), float(v), device=x.device)
+    if RANDOM_MIRROR if mirror is None else mirror:
+        v = torch.where(torch.rand_like(v) > 0.5, -v, v)
+    return v
+
+
+def _batch_affine(x, matrix):
+    """Sample `x` at `matrix @ [x, y, 1]` for every output pixel `(x, y)`.
+
+    Args:
+        matrix: `[N, 2, 3]` in pixels, as the data of PIL's `AFFINE` transform.
+    """
+    n, _, h, w = x.shape
+    ys, xs = torch.meshgrid(torch.arange(h, device=x.device, dtype=x.dtype) + 0.5,
+                            torch.arange(w, device=x.device, dtype=x.dtype) + 0.5)
+    base = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, h * w, 3)
+    coords = base @ matrix.transpose(1, 2)
+    grid = torch.stack([coords[..., 0] * 2 / w - 1, coords[..., 1] * 2 / h - 1], dim=-1)
+    return F.grid_sample(x, grid.view(n, h, w, 2), mode='bilinear',
+                         padding_mode='zeros', align_corners=False)
+
+
+def _affine_matrix(a, b, c, d, e, f):
+    return torch.stack([torch.stack([a, b, c], dim=-1),
+                        torch.stack([d, e, f], dim=-1)], dim=1)
+
+
+def BatchShearX(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _batch_affine(x, _affine_matrix(one, v, zero, zero, one, zero))
+
+
+def BatchShearY(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _batch_affine(x, _affine_matrix(one, zero, zero, v, one, zero))
+
+
+def BatchTranslateXabs(x, v):
+    v = _random_sign(x, v, mirror=True)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _batch_affine(x, _affine_matrix(one, zero, v, zero, one, zero))
+
+
+def BatchTranslateYabs(x, v):
+    v = _random_sign(x, v, mirror=True)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _batch_affine(x, _affine_matrix(one, zero, zero, zero, one, v))
+
+
+def BatchRotate(x, v):
+    # Counter-clockwise by `v` degrees around the center, as PIL's `rotate`.
+    angle = -_random_sign(x, v) * math.pi / 180
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    cx, cy = x.size(3) / 2, x.size(2) / 2
+    return _batch_affine(x, _affine_matrix(cos, sin, cx - cos * cx - sin * cy,
+                                    -sin, cos, cy + sin * cx - cos * cy))
+
+
+def BatchAutoContrast(x, _):
+    lo = x.amin(dim=(2, 3), keepdim=True)
+    hi = x.amax(dim=(2, 3), keepdim=True)
+    scale = torch.where(hi > lo, 255. / (hi - lo), torch.ones_like(hi))
+    lo = torch.where(hi > lo, lo, torch.zeros_like(lo))
+    return ((x - lo) * scale).clamp_(0, 255)
+
+
+def BatchInvert(x, _):
+    return 255. - x
+
+
+def BatchEqualize(x, _):
+    # PIL's `ImageOps.equalize` for every channel of every sample.
+    n, c, h, w = x.shape
+    pixels = x.round().long().view(n * c, h * w)
+    hist = torch.zeros(n * c, 256, device=x.device, dtype=torch.long)
+    hist.scatter_add_(1, pixels, torch.ones_like(pixels))
+    last = 255 - (hist.flip(1) > 0).long().argmax(dim=1, keepdim=True)
+    step = (hist.sum(dim=1, keepdim=True) - hist.gather(1, last)) // 255
+    lut = (hist.cumsum(dim=1) - hist + step // 2) // step.clamp(min=1)
+    lut = torch.where(step > 0, lut.clamp(max=255),
+                      torch.arange(256, device=x.device).expand_as(lut))
+    return lut.gather(1, pixels).view(n, c, h, w).to(x.dtype)
+
+
+def BatchSolarize(x, v):
+    return torch.where(x.round() < v, x, 255. - x)
+
+
+def BatchSolarizeAdd(x, addition=0, threshold=128):
+    return BatchSolarize((x + addition).clamp_(0, 255), threshold)
+
+
+def BatchPosterize(x, v):
+    shift = 8 - int(v)
+    return ((x.round().long() >> shift) << shift).to(x.dtype)
+
+
+def BatchContrast(x, v):
+    return batch_contrast(x, torch.full((x.size(0),), float(v), device=x.device))
+
+
+def BatchColor(x, v):
+    return batch_saturation(x, torch.full((x.size(0),), float(v), device=x.device))
+
+
+def BatchBrightness(x, v):
+    return batch_brightness(x, torch.full((x.size(0),), float(v), device=x.device))
+
+
+def BatchSharpness(x, v):
+    # PIL's SMOOTH kernel, the border keeps its pixels.
+    kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], device=x.device) / 13
+    c = x.size(1)
+    smooth = F.conv2d(x, kernel.view(1, 1, 3, 3).repeat(c, 1, 1, 1), groups=c)
+    degenerate = x.clone()
+    degenerate[:, :, 1:-1, 1:-1] = smooth
+    return batch_blend(x, degenerate, torch.full((x.size(0),), float(v), device=x.device))
+
+
+def BatchCutoutAbs(x, v):
+    n, _, h, w = x.shape
+    if v < 0:
+        return x
+    x0 = (torch.rand(n, device=x.device) * w - v / 2.).floor().clamp(min=0)
+    y0 = (torch.rand(n, device=x.device) * h - v / 2.).floor().clamp(min=0)
+    xs = torch.arange(w, device=x.device).view(1, 1, w)
+    ys = torch.arange(h, device=x.device).view(1, h, 1)
+    # PIL's `rectangle` includes its far corner.
+    mask = ((xs >= x0.view(-1, 1, 1)) & (xs <= (x0 + v).view(-1, 1, 1))
+            & (ys >= y0.view(-1, 1, 1)) & (ys <= (y0 + v).view(-1, 1, 1)))
+    color = torch.tensor([125., 123., 114.], device=x.device).view(1, 3, 1, 1)
+    return torch.where(mask.unsqueeze(1), color, x)
+
+
+def batch_rand_augment_list():  # same operations and ranges as `rand_augment_list`
+    l = [
+        (BatchAutoContrast, 0, 1),
+        (BatchEqualize, 0, 1),
+        (BatchInvert, 0, 1),
+        (BatchRotate, 0, 30),
+        (BatchPosterize, 0, 4),
+        (BatchSolarize, 0, 256),
+        (BatchSolarizeAdd, 0, 110),
+        (BatchColor, 0.1, 1.9),
+        (BatchContrast, 0.1, 1.9),
+        (BatchBrightness, 0.1, 1.9),
+        (BatchSharpness, 0.1, 1.9),
+        (BatchShearX, 0., 0.3),
+        (BatchShearY, 0., 0.3),
+        (BatchCutoutAbs, 0, 40),
+        (BatchTranslateXabs, 0., 100),
+        (BatchTranslateYabs, 0., 100),
+    ]
+
+    return l
+
+
+class BatchRandAugment(object):
+    """`RandAugment` on batches, every sample draws its own ops."""
+
+    def __init__(self, n, m):
+        self.n = n
+        self.m = m
+        self.augment_list = batch_rand_augment_list()
+
+    def __call__(self, x):
+        for _ in range(self.n):
+            ops = torch.randint(len(self.augment_list), (x.size(0),), device=x.device)
+            # Skipped with probability `random.random() > random.uniform(0.2, 0.8)`.
+            keep = torch.rand(x.size(0), device=x.device) <= \
+                torch.empty(x.size(0), device=x.device).uniform_(0.2, 0.8)
+            for i, (op, minval, maxval) in enumerate(self.augment_list):
+                indices = (keep & (ops == i)).nonzero().squeeze(1)
+                if indices.numel() == 0:
+                    continue
+                val = (float(self.m) / 30) * float(maxval - minval) + minval
+                x[indices] = op(x[indices], val)
+        return x
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(n={}, m={})'.format(self.n, self.m)
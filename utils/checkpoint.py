@@ -0,0 +1,144 @@
+"""Asynchronous checkpointing.
+
+A checkpoint is a dict of state_dicts. `CheckpointWriter` copies its tensors to
+(pinned) CPU memory on the calling thread, so training can go on modifying the
+model, then writes it in a background thread. Every file is written to a
+temporary path first and renamed, so a crash never leaves a truncated
+checkpoint behind.
+"""
+import collections
+import logging
+import os
+import shutil
+import threading
+
+import torch
+
+
+def optimizer_state_dict(optimizer, model):
+    """State dict of `optimizer`, with parameters referred to by their name.
+
+    Shrinking a model reorders the parameters of the optimizer, names keep
+    the state valid for a freshly built model of the same architecture.
+    """
+    names = {id(params): name for name, params in model.named_parameters()}
+    param_groups = []
+    for group in optimizer.param_groups:
+        param_group = {key: val for key, val in group.items() if key != 'params'}
+        param_group['params'] = [names[id(params)] for params in group['params']]
+        param_groups.append(param_group)
+    state = {names[id(params)]: val for params, val in optimizer.state.items()
+             if id(params) in names}
+    return {'state': state, 'param_groups': param_groups}
+
+
+def load_optimizer_state_dict(optimizer, model, state_dict):
+    """Load a state dict from `optimizer_state_dict`."""
+    named_parameters = dict(model.named_parameters())
+    optimizer.param_groups = [
+        dict(group, params=[named_parameters[name] for name in group['params']])
+        for group in state_dict['param_groups']
+    ]
+    optimizer.state = collections.defaultdict(dict)
+    for name, state in state_dict['state'].items():
+        params = named_parameters[name]
+        optimizer.state[params] = {
+            key: val.to(params.device) if torch.is_tensor(val) else val
+            for key, val in state.items()
+        }
+    return optimizer
+
+
+def _atomic_save(obj, path, save_fn):
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    save_fn(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _save_text(text, path):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class CheckpointWriter(object):
+    """Write checkpoints in a background thread.
+
+    At most one write is in flight, `save` waits for the previous one. The
+    pinned CPU buffers of the snapshots are reused as long as the shapes of
+    the tensors do not change.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None
+        self._buffers = {}
+
+    def _snapshot(self, obj, key=()):
+        if torch.is_tensor(obj):
+            obj = obj.detach()
+            if obj.device.type == 'cpu':
+                return obj.clone()
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+                self._buffers[key] = buf
+            return buf.copy_(obj, non_blocking=True)
+        elif isinstance(obj, dict):
+            res = type(obj)((k, self._snapshot(v, key + (k,))) for k, v in obj.items())
+            if hasattr(obj, '_metadata'):
+                res._metadata = obj._metadata
+            return res
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def snapshot(self, obj):
+        """Copy all tensors in nested dicts/lists/tuples `obj` to CPU."""
+        res = self._snapshot(obj)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return res
+
+    def _write(self, obj, paths, texts):
+        try:
+            _atomic_save(obj, paths[0], torch.save)
+            # Identical checkpoints share the file.
+            for path in paths[1:]:
+                tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+                try:
+                    os.link(paths[0], tmp_path)
+                except OSError:
+                    shutil.copyfile(paths[0], tmp_path)
+                os.replace(tmp_path, path)
+            for path, text in texts.items():
+                _atomic_save(text, path, _save_text)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Failed to write checkpoint {}: {}'.format(paths, e))
+            self._error = e
+
+    def save(self, obj, paths, texts=None):
+        """Snapshot `obj` and write it to all `paths` in the background.
+
+        Args:
+            obj: Nested dicts/lists/tuples of tensors and picklable values.
+            paths: Files to write `obj` to, written once and linked.
+            texts: Optional `{path: str}` of side files to write along.
+        """
+        self.wait()
+        obj = self.snapshot(obj)
+        self._thread = threading.Thread(target=self._write,
+                                        args=(obj, list(paths), texts or {}),
+                                        name='checkpoint_writer')
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the write in flight, re-raise its error if any."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+checkpoint_writer = CheckpointWriter()
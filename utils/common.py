@@ -1,4 +1,5 @@
 """Common utilities."""
+import copy
 import functools
 import numbers
 import os
@@ -131,22 +132,69 @@ def setup_logging(log_dir=None):
 
 
 def save_status(model, model_kwparams, optimizer, ema, epoch, best_val, meters,
-                checkpoint_name):
-    """Create checkpoint."""
-    torch.save(
+                checkpoint_name, grad_scaler=None):
+    """Create checkpoint in the background.
+
+    The checkpoint holds state_dicts, plus the channels and kernel sizes of
+    every block to rebuild a shrunk model, see `load_status`. The optimizer
+    state refers to parameters by name.
+
+    Args:
+        checkpoint_name: Path without extension, or a list of paths that
+            share the same checkpoint file (e.g. best and latest).
+        grad_scaler: Loss scaler of mixed precision training, could be None.
+    """
+    from utils.checkpoint import checkpoint_writer
+    from utils.checkpoint import optimizer_state_dict
+
+    if isinstance(checkpoint_name, str):
+        checkpoint_name = [checkpoint_name]
+    model_unwrap = getattr(model, 'module', model)
+    blocks = None
+    if hasattr(model_unwrap, 'get_named_block_list'):
+        blocks = {
+            name: [list(block.channels), list(block.kernel_sizes)]
+            for name, block in model_unwrap.get_named_block_list().items()
+        }
+    texts = {}
+    if model_kwparams is not None:
+        for name in checkpoint_name:
+            texts['{}.json'.format(name)] = json.dumps(
+                model_kwparams['inverted_residual_setting'])
+            texts['{}.yml'.format(name)] = str(model_kwparams)
+    checkpoint_writer.save(
         {
-            'model': model,  # model.state_dict(),
-            'optimizer': optimizer,  # optimizer.state_dict()
-            'ema': ema if ema else None,  # ema.state_dict()
+            'model': model.state_dict(),
+            'blocks': blocks,
+            'optimizer': optimizer_state_dict(optimizer, model),
+            'ema': ema.state_dict() if ema else None,
             'last_epoch': epoch,
             'best_val': best_val,
-            'meters': meters,
-        }, '{}.pt'.format(checkpoint_name))
-    torch.save(model.state_dict(), '{}.state_dict'.format(checkpoint_name))
-    if model_kwparams is not None:
-        json.dump(model_kwparams['inverted_residual_setting'], open('{}.json'.format(checkpoint_name), 'w'))
-        with open('{}.yml'.format(checkpoint_name), 'w') as f:
-            f.write(str(model_kwparams))
+            'meters': copy.deepcopy(meters),
+            'grad_scaler': grad_scaler.state_dict() if grad_scaler else None,
+        }, ['{}.pt'.format(name) for name in checkpoint_name], texts)
+
+
+def load_status(checkpoint, model_wrapper, optimizer, ema, grad_scaler=None):
+    """Restore model, optimizer and EMA from a checkpoint of `save_status`.
+
+    Args:
+        checkpoint: Loaded checkpoint.
+        model_wrapper: Model with the architecture of the checkpoint, e.g.
+            shrunk by `mb.shrink_to_blocks(model, checkpoint['blocks'])`.
+        optimizer: Optimizer of `model_wrapper`, built after shrinking.
+        ema: An instance of `ExponentialMovingAverage`, could be None.
+        grad_scaler: Loss scaler of mixed precision training, could be None.
+    """
+    from utils.checkpoint import load_optimizer_state_dict
+
+    model_wrapper.load_state_dict(checkpoint['model'])
+    load_optimizer_state_dict(optimizer, model_wrapper, checkpoint['optimizer'])
+    if ema:
+        ema.load_state_dict(checkpoint['ema'])
+        ema.to(get_device(model_wrapper))
+    if grad_scaler and checkpoint.get('grad_scaler'):
+        grad_scaler.load_state_dict(checkpoint['grad_scaler'])
 
 
 def get_device(x):
@@ -215,8 +263,28 @@ def check_tensor_in(tensor, iterable):
     return index is not None
 
 
+def foreach_add(xs, ys, alpha=1):
+    """Out-of-place `x + alpha * y` for all pairs, as one multi-tensor op if
+    supported."""
+    if hasattr(torch, '_foreach_add'):
+        return list(torch._foreach_add(xs, ys, alpha=alpha))
+    return [x.add(y, alpha=alpha) for x, y in zip(xs, ys)]
+
+
+def foreach_mul_(xs, scalar):
+    """In-place `x * scalar` for all tensors, as one multi-tensor op if
+    supported."""
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(xs, scalar)
+    else:
+        for x in xs:
+            x.mul_(scalar)
+
+
 def get_data_queue_size(data_iter):
     """Get prefetched size."""
+    if hasattr(data_iter, 'qsize'):
+        return data_iter.qsize()
     if version.parse(torch.__version__) < version.parse('1.3.0'):
         return data_iter.data_queue.qsize()
     else:
@@ -1,15 +1,28 @@
 """Data related."""
+import copy
 import importlib
+import logging
 import os
+import queue
+import threading
 from PIL import Image
 import torch
 from torchvision import datasets, transforms
+from utils.autoaug import BatchRandAugment
 from utils.autoaug import RandAugment
 from utils.config import DEVICE_MODE
+from utils.transforms import BatchColorJitter
+from utils.transforms import BatchLighting
+from utils.transforms import BatchRandomHorizontalFlip
 from utils.transforms import Lighting
 from utils.transforms import CenterCropPadding
 from utils.transforms import RandomResizedCropPadding
 from utils.lmdb_dataset import ImageFolderLMDB
+from utils.shard_dataset import ShardStream
+from utils.shard_dataset import ShardedImageFolder
+from utils.sample_cache import SampleCache
+from utils.sample_cache import ToUint8Tensor
+from utils.sample_cache import split_transform
 
 import numpy as np
 import io
@@ -24,55 +37,114 @@ for line in f:
     class_dict[name] = int(id) - 1
 
 
-class DataPrefetcher():
-    """Prefetch data to GPU.
-    Modified from https://github.com/NVIDIA/apex/blob/f5cd5ae937f168c763985f627bbf850648ea5f3f/examples/imagenet/main_amp.py#L256
+class DataPrefetcher(object):
+    """Prefetch batches in a background thread.
+
+    Up to `depth` batches are prepared ahead of the training loop. The first
+    `num_tensors` entries of each batch are staged in pinned memory and copied
+    to GPU on a side stream, the input is converted to `dtype` and optionally
+    to channels last, all off the main thread. On CPU only the conversions are
+    done. Remaining entries, e.g. meta dicts, are passed through.
+
+    Args:
+        loader: Iterable (or iterator) of batches, lists or tuples of tensors.
+        depth: Number of batches prepared ahead.
+        dtype: Floating point type of the input.
+        channels_last: Convert 4-d inputs to `torch.channels_last`.
+        num_tensors: Number of leading entries of a batch to move to device.
+        normalize: Optional `(mean, std)`, for uint8 inputs, e.g. of a
+            `SampleCache`, scaled to [0, 1] and normalized on device.
+        transform: Optional batch transform of uint8 inputs, applied on
+            device to values in [0, 255] before `normalize`.
     """
 
-    def __init__(self, loader):
-        self.loader = iter(loader)
+    def __init__(self, loader, depth=2, dtype=torch.float32,
+                 channels_last=False, num_tensors=2, normalize=None,
+                 transform=None):
+        self.loader = loader
+        self.depth = max(1, depth)
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self.num_tensors = num_tensors
+        self.normalize = normalize
+        self.transform = transform
+        self._mean_std = None
+        self.device = None
         if DEVICE_MODE == "gpu":
+            self.device = torch.cuda.current_device()
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker,
+                                        name='data_prefetcher', daemon=True)
+        self._thread.start()
+
+    def _convert(self, input):
+        input = input.to(dtype=self.dtype, non_blocking=True)
+        if self.transform is not None:
+            input = self.transform(input)
+        if self.normalize is not None:
+            if self._mean_std is None:
+                self._mean_std = [torch.tensor(val, dtype=self.dtype, device=input.device).view(1, -1, 1, 1)
+                                  for val in self.normalize]
+            mean, std = self._mean_std
+            input = input.div_(255.).sub_(mean).div_(std)
+        if self.channels_last and input.dim() == 4:
+            input = input.contiguous(memory_format=torch.channels_last)
+        return input
+
+    def _preload(self, batch):
+        tensors = list(batch[:self.num_tensors])
+        if self.device is None:
+            tensors[0] = self._convert(tensors[0])
+            return tensors + list(batch[self.num_tensors:]), None
+        with torch.cuda.stream(self.stream):
+            for i, tensor in enumerate(tensors):
+                if not tensor.is_pinned():
+                    tensor = tensor.pin_memory()
+                tensors[i] = tensor.cuda(non_blocking=True)
+            tensors[0] = self._convert(tensors[0])
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return tensors + list(batch[self.num_tensors:]), event
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        if self.device is not None:
+            torch.cuda.set_device(self.device)
             self.stream = torch.cuda.Stream()
-        # With Amp, it isn't necessary to manually convert data to half.
-        # if args.fp16:
-        #     self.mean = self.mean.half()
-        #     self.std = self.std.half()
-        self.stop = False
-        self.preload()
-
-    def preload(self):
         try:
-            self.next_input, self.next_target = next(self.loader)
-        except StopIteration:
-            self.stop = True
-            self.next_input = None
-            self.next_target = None
+            for batch in self.loader:
+                if not self._put(self._preload(batch)):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put(e)
             return
-        if DEVICE_MODE == "gpu":
-            with torch.cuda.stream(self.stream):
-                self.next_input = self.next_input.cuda(non_blocking=True)
-                self.next_target = self.next_target.cuda(non_blocking=True)
-                # With Amp, it isn't necessary to manually convert data to half.
-                # if args.fp16:
-                #     self.next_input = self.next_input.half()
-                # else:
-                self.next_input = self.next_input.float()
-        else:
-            # With Amp, it isn't necessary to manually convert data to half.
-            # if args.fp16:
-            #     self.next_input = self.next_input.half()
-            # else:
-            self.next_input = self.next_input.float()
+        self._put(None)
 
     def __next__(self):
-        if DEVICE_MODE == "gpu":
-            torch.cuda.current_stream().wait_stream(self.stream)
-        if self.stop:
+        item = self._queue.get()
+        if item is None:
+            self._queue.put(None)
             raise StopIteration
-        input = self.next_input
-        target = self.next_target
-        self.preload()
-        return input, target
+        if isinstance(item, Exception):
+            raise item
+        batch, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            # Tensors were allocated on the side stream, keep the allocator
+            # from reusing them before the main stream is done.
+            for tensor in batch[:self.num_tensors]:
+                tensor.record_stream(stream)
+        return tuple(batch)
 
     def __iter__(self):
         return self
@@ -80,67 +152,38 @@ class DataPrefetcher():
     def __len__(self):
         return len(self.loader)
 
+    def qsize(self):
+        """Number of batches ready to be consumed."""
+        return self._queue.qsize()
 
-class DataPrefetcherKeypoint():
-    """Prefetch data to GPU.
-    Modified from https://github.com/NVIDIA/apex/blob/f5cd5ae937f168c763985f627bbf850648ea5f3f/examples/imagenet/main_amp.py#L256
-    """
+    def close(self):
+        """Stop the background thread, must be called when leaving an epoch
+        early."""
+        self._stop.set()
 
-    def __init__(self, loader):
-        self.loader = iter(loader)
-        if DEVICE_MODE == "gpu":
-            self.stream = torch.cuda.Stream()
-        # With Amp, it isn't necessary to manually convert data to half.
-        # if args.fp16:
-        #     self.mean = self.mean.half()
-        #     self.std = self.std.half()
-        self.stop = False
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.next_target, self.next_target_weight, self.next_meta = next(self.loader)
-        except StopIteration:
-            self.stop = True
-            self.next_input = None
-            self.next_target = None
-            self.next_target_weight = None
-            self.next_meta = None
-            return
-        if DEVICE_MODE == "gpu":
-            with torch.cuda.stream(self.stream):
-                self.next_input = self.next_input.cuda(non_blocking=True)
-                self.next_target = self.next_target.cuda(non_blocking=True)
-                self.next_target_weight = self.next_target_weight.cuda(non_blocking=True)
-                # With Amp, it isn't necessary to manually convert data to half.
-                # if args.fp16:
-                #     self.next_input = self.next_input.half()
-                # else:
-                self.next_input = self.next_input.float()
-        else:
-            # With Amp, it isn't necessary to manually convert data to half.
-            # if args.fp16:
-            #     self.next_input = self.next_input.half()
-            # else:
-            self.next_input = self.next_input.float()
 
-    def __next__(self):
-        if DEVICE_MODE == "gpu":
-            torch.cuda.current_stream().wait_stream(self.stream)
-        if self.stop:
-            raise StopIteration
-        input = self.next_input
-        target = self.next_target
-        target_weight = self.next_target_weight
-        meta = self.next_meta
-        self.preload()
-        return input, target, target_weight, meta
+class DataPrefetcherKeypoint(DataPrefetcher):
+    """Prefetch keypoint batches `(input, target, target_weight, meta)`."""
 
-    def __iter__(self):
-        return self
+    def __init__(self, loader, **kwargs):
+        kwargs.setdefault('num_tensors', 3)
+        super(DataPrefetcherKeypoint, self).__init__(loader, **kwargs)
 
-    def __len__(self):
-        return len(self.loader)
+
+def get_prefetcher(loader, FLAGS, dataset=None):
+    """Get the prefetcher for `loader` configured by `FLAGS`.
+
+    The `normalize` and `batch_transform` attributes of `dataset`, if any,
+    are applied by the prefetcher.
+    """
+    prefetcher = DataPrefetcher
+    if FLAGS.dataset == 'coco':
+        prefetcher = DataPrefetcherKeypoint
+    return prefetcher(loader,
+                      depth=FLAGS.get('prefetch_depth', 2),
+                      channels_last=FLAGS.get('channels_last', False),
+                      normalize=getattr(dataset, 'normalize', None),
+                      transform=getattr(dataset, 'batch_transform', None))
 
 
 class FakeData(datasets.vision.VisionDataset):
@@ -174,43 +217,81 @@ class FakeData(datasets.vision.VisionDataset):
         return self.size
 
 
+def set_epoch(loader, epoch):
+    """Reshuffle `loader` for `epoch`, with a `DistributedSampler` or a `ShardStream`."""
+    if isinstance(loader.dataset, ShardStream):
+        loader.dataset.set_epoch(epoch)
+    elif isinstance(loader.sampler, torch.utils.data.distributed.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+# mean, std, crop_scale, jitter_param, lighting_param
+imagenet1k_params = {
+    'imagenet1k_inception': ([0.5, 0.5, 0.5], [0.5, 0.5, 0.5], 0.08, 0.4, 0.1),
+    'imagenet1k_basic': ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], 0.08, 0.4, 0.1),
+    'imagenet1k_mobile': ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], 0.25, 0.4, 0.1),
+}
+
+
+def batch_transforms(FLAGS):
+    """Get the augmentation of training batches, with `batch_augment`.
+
+    The loader workers of the training set only decode and crop, into uint8
+    tensors, random augmentation runs on whole batches on the training
+    device, see `DataPrefetcher`.
+
+    Returns:
+        `(batch_transform, (mean, std))`.
+    """
+    if FLAGS.data_transforms in imagenet1k_params:
+        mean, std, _, jitter_param, lighting_param = imagenet1k_params[FLAGS.data_transforms]
+        if not FLAGS.prune_params.bn_prune_filter:
+            randaug = [BatchRandAugment(2, 12)]
+        else:
+            randaug = []
+        return transforms.Compose(randaug + [
+            BatchColorJitter(brightness=jitter_param,
+                             contrast=jitter_param,
+                             saturation=jitter_param),
+            BatchLighting(lighting_param),
+            BatchRandomHorizontalFlip(),
+        ]), (mean, std)
+    elif FLAGS.data_transforms in [
+        'imagenet1k_mnas_bilinear', 'imagenet1k_mnas_bicubic'
+    ]:
+        mean = [0.485, 0.456, 0.406]  # RGB
+        std = [0.229, 0.224, 0.225]
+        return BatchRandomHorizontalFlip(), (mean, std)
+    raise NotImplementedError(
+        'Batch augmentation of {} is not yet implemented.'.format(
+            FLAGS.data_transforms))
+
+
 def data_transforms(FLAGS):
     """Get transform of dataset."""
-    if FLAGS.data_transforms in [
-        'imagenet1k_basic', 'imagenet1k_inception', 'imagenet1k_mobile'
-    ]:
-        if FLAGS.data_transforms == 'imagenet1k_inception':
-            mean = [0.5, 0.5, 0.5]
-            std = [0.5, 0.5, 0.5]
-            crop_scale = 0.08
-            jitter_param = 0.4
-            lighting_param = 0.1
-        elif FLAGS.data_transforms == 'imagenet1k_basic':
-            mean = [0.485, 0.456, 0.406]
-            std = [0.229, 0.224, 0.225]
-            crop_scale = 0.08
-            jitter_param = 0.4
-            lighting_param = 0.1
-        elif FLAGS.data_transforms == 'imagenet1k_mobile':
-            mean = [0.485, 0.456, 0.406]
-            std = [0.229, 0.224, 0.225]
-            crop_scale = 0.25
-            jitter_param = 0.4
-            lighting_param = 0.1
+    batch_augment = FLAGS.get('batch_augment', False)
+    if FLAGS.data_transforms in imagenet1k_params:
+        mean, std, crop_scale, jitter_param, lighting_param = imagenet1k_params[FLAGS.data_transforms]
         if not FLAGS.prune_params.bn_prune_filter:
             randaug = [RandAugment(2, 12)]
         else:
             randaug = []
-        train_transforms = transforms.Compose(randaug + [
-            transforms.RandomResizedCrop(224, scale=(crop_scale, 1.0)),
-            transforms.ColorJitter(brightness=jitter_param,
-                                   contrast=jitter_param,
-                                   saturation=jitter_param),
-            Lighting(lighting_param),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std),
-        ])
+        if batch_augment:
+            train_transforms = transforms.Compose([
+                transforms.RandomResizedCrop(224, scale=(crop_scale, 1.0)),
+                ToUint8Tensor(),
+            ])
+        else:
+            train_transforms = transforms.Compose(randaug + [
+                transforms.RandomResizedCrop(224, scale=(crop_scale, 1.0)),
+                transforms.ColorJitter(brightness=jitter_param,
+                                       contrast=jitter_param,
+                                       saturation=jitter_param),
+                Lighting(lighting_param),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=mean, std=std),
+            ])
         val_transforms = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
@@ -229,18 +310,22 @@ def data_transforms(FLAGS):
         std = [0.229, 0.224, 0.225]
         crop_padding = 32
 
-        train_transforms = transforms.Compose([
-            RandomResizedCropPadding(224,
-                                     scale=(0.08, 1.0),
-                                     min_object_covered=0.1,
-                                     ratio=(3. / 4., 4. / 3.),
-                                     log_ratio=False,
-                                     interpolation=resize_method,
-                                     crop_padding=crop_padding),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std),
-        ])
+        crop = RandomResizedCropPadding(224,
+                                        scale=(0.08, 1.0),
+                                        min_object_covered=0.1,
+                                        ratio=(3. / 4., 4. / 3.),
+                                        log_ratio=False,
+                                        interpolation=resize_method,
+                                        crop_padding=crop_padding)
+        if batch_augment:
+            train_transforms = transforms.Compose([crop, ToUint8Tensor()])
+        else:
+            train_transforms = transforms.Compose([
+                crop,
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=mean, std=std),
+            ])
         val_transforms = transforms.Compose([
             CenterCropPadding(224, crop_padding),
             transforms.Resize(224, resize_method),
@@ -293,6 +378,17 @@ def dataset(train_transforms, val_transforms, test_transforms, FLAGS):
                                       transform=val_transforms)
 
         test_set = None
+    elif FLAGS.dataset == 'imagenet1k_shards':
+        if not FLAGS.test_only or FLAGS.bn_calibration:
+            train_set = ShardStream(os.path.join(FLAGS.dataset_dir, 'train'),
+                                    transform=train_transforms,
+                                    shuffle_buffer=FLAGS.get('shuffle_buffer', 1000),
+                                    seed=FLAGS.get('random_seed', 0))
+        else:
+            train_set = None
+        val_set = ShardedImageFolder(os.path.join(FLAGS.dataset_dir, 'val'),
+                                     transform=val_transforms)
+        test_set = None
     else:
         try:
             dataset_lib = importlib.import_module(FLAGS.dataset)
@@ -304,10 +400,56 @@ def dataset(train_transforms, val_transforms, test_transforms, FLAGS):
     return train_set, val_set, test_set
 
 
+def sample_cache(dset, name, FLAGS, indices=None):
+    """Cache the decoded samples of `dset`, see `SampleCache`.
+
+    Returns `dset` itself if its transform does not end with `ToTensor` and
+    `Normalize`, which move to the prefetcher, or output uint8 already.
+    """
+    if getattr(dset, 'normalize', None) is not None:
+        split = dset.transform, dset.normalize
+    else:
+        split = split_transform(getattr(dset, 'transform', None))
+    if split is None:
+        logging.warning('Not caching {}: unsupported transform.'.format(dset))
+        return dset
+    dset = copy.copy(dset)
+    dset.transform = split[0]
+    cache_dir = FLAGS.get('sample_cache_dir', None) or os.path.join(FLAGS.log_dir, 'sample_cache')
+    cache = SampleCache(dset, os.path.join(cache_dir, name), indices=indices,
+                        normalize=split[1], num_workers=FLAGS.data_loader_workers)
+    # Batch augmentation stays random.
+    cache.batch_transform = getattr(dset, 'batch_transform', None)
+    return cache
+
+
+def sample_cache_calib(train_set, FLAGS):
+    """Cache a fixed random subset of `train_set` for BN calibration.
+
+    The subset holds `bn_calibration_steps` batches for every rank, with the
+    augmentation drawn when it was cached.
+    """
+    if isinstance(train_set, ShardStream):
+        logging.warning('Not caching calibration samples of a streamed dataset.')
+        return train_set
+    world_size = 1
+    if torch.distributed.is_initialized():
+        world_size = torch.distributed.get_world_size()
+    num_samples = min(len(train_set), FLAGS.bn_calibration_steps
+                      * FLAGS._loader_batch_size_calib * world_size)
+    indices = np.random.RandomState(FLAGS.get('random_seed', 0)).choice(
+        len(train_set), num_samples, replace=False)
+    return sample_cache(train_set, 'calib', FLAGS, indices=sorted(indices))
+
+
 def data_loader(train_set, val_set, test_set, FLAGS):
     """Get data loader."""
 
     def _build_loader(dset, batch_size, shuffle, sampler=None):
+        if isinstance(dset, ShardStream):
+            # Shuffles and splits across ranks by itself.
+            dset = dset.with_loader(batch_size, FLAGS.get('drop_last', False))
+            shuffle, sampler = False, None
         return torch.utils.data.DataLoader(
             dset,
             batch_size=batch_size,
@@ -317,15 +459,27 @@ def data_loader(train_set, val_set, test_set, FLAGS):
             sampler=sampler,
             drop_last=FLAGS.get('drop_last', False))
 
+    if FLAGS.get('batch_augment', False) and train_set is not None:
+        train_set.batch_transform, train_set.normalize = batch_transforms(FLAGS)
+    calib_set = train_set
+    if FLAGS.model_kwparams.task == 'classification':
+        if FLAGS.get('cache_val_samples', False):
+            val_set = sample_cache(val_set, 'val', FLAGS)
+        if FLAGS.bn_calibration and FLAGS.get('cache_calib_samples', False):
+            calib_set = sample_cache_calib(train_set, FLAGS)
+
     if FLAGS.use_distributed:
         if not FLAGS.test_only or FLAGS.bn_calibration:
             train_sampler = torch.utils.data.distributed.DistributedSampler(
                 train_set)
+            calib_sampler = torch.utils.data.distributed.DistributedSampler(
+                calib_set)
             train_shuffle = False
         val_sampler = torch.utils.data.distributed.DistributedSampler(val_set, shuffle=False)
     else:
         if not FLAGS.test_only or FLAGS.bn_calibration:
             train_sampler = None
+            calib_sampler = None
             train_shuffle = True
         val_sampler = None
 
@@ -340,10 +494,10 @@ def data_loader(train_set, val_set, test_set, FLAGS):
             train_loader = None
         if FLAGS.bn_calibration:
             if not FLAGS.use_hdfs:
-                calib_loader = _build_loader(train_set,
+                calib_loader = _build_loader(calib_set,
                                              FLAGS._loader_batch_size_calib,
                                              train_shuffle,
-                                             sampler=train_sampler)
+                                             sampler=calib_sampler)
         else:
             calib_loader = None
         if not FLAGS.use_hdfs:
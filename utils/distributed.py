@@ -3,6 +3,7 @@ from collections import OrderedDict
 
 import os
 import functools
+import math
 
 import torch
 import torch.nn as nn
@@ -164,6 +165,10 @@ def _allreduce(tensors, coalesce=True, bucket_size_mb=-1):
 
 
 def allreduce_grads(model, *args, **kwargs):
+    if getattr(model, 'reducer', None) is not None:
+        # Buckets were launched during backward.
+        model.reducer.finish()
+        return
     grads = [
         param.grad.data
         for param in model.parameters()
@@ -180,15 +185,464 @@ def allreduce_bn(model, *args, **kwargs):
     _allreduce(tensors, *args, **kwargs)
 
 
+def allreduce_ema_bn(ema, *args, **kwargs):
+    """Average the EMA of BN running statistics over ranks.
+
+    With `BNSynchronizer` the averages follow rank-local statistics, the
+    deltas it applies sum to zero over ranks, so their mean is the average
+    of the synchronized statistics.
+    """
+    tensors = [
+        ema.average(name) for name in ema.average_names()
+        if 'running_var' in name or 'running_mean' in name
+    ]
+    _allreduce(tensors, *args, **kwargs)
+
+
+class BNSynchronizer(object):
+    """Average BN running statistics over ranks, overlapped with training.
+
+    The BN buffers are looked up once and cached, call `reset` after they
+    are replaced, e.g. by `shrink_model`. `step` launches one async
+    all-reduce of all buffers every `interval` calls, the result is applied
+    by the next `step` or by `wait`. Statistics updated locally in between
+    are kept: every buffer gets `average - sent` added.
+    """
+
+    def __init__(self):
+        self._buffers = None
+        self._handle = None
+        self._steps = 0
+
+    def _build(self, model):
+        self._buffers = [
+            buffer for name, buffer in model.named_buffers()
+            if 'running_var' in name or 'running_mean' in name
+        ]
+        self._sent = _flatten_dense_tensors(self._buffers) if self._buffers else None
+        self._flat = torch.empty_like(self._sent) if self._buffers else None
+
+    def reset(self):
+        """Apply the pending average and drop the cached buffers."""
+        self.wait()
+        self._buffers = None
+
+    def step(self, model, interval=1):
+        """Launch the all-reduce of BN statistics every `interval` calls."""
+        self._steps += 1
+        if self._steps % interval != 0:
+            return
+        self.wait()
+        if self._buffers is None:
+            self._build(model)
+        if not self._buffers:
+            return
+        with torch.no_grad():
+            torch.cat([buffer.reshape(-1) for buffer in self._buffers], out=self._sent)
+            self._flat.copy_(self._sent)
+        self._handle = dist.all_reduce(self._flat, async_op=True)
+
+    def wait(self):
+        """Apply the pending average, if any."""
+        if self._handle is None:
+            return
+        self._handle.wait()
+        self._handle = None
+        with torch.no_grad():
+            delta = self._flat.div_(get_world_size()).sub_(self._sent)
+            for buffer, synced in zip(self._buffers,
+                                      _unflatten_dense_tensors(delta, self._buffers)):
+                buffer.add_(synced)
+
+
+def _register_grad_ready_hook(param, hook):
+    """Call `hook()` once the gradient of `param` is accumulated.
+
+    Returns a handle to remove the hook and the object to keep alive.
+    """
+    if hasattr(param, 'register_post_accumulate_grad_hook'):
+        return param.register_post_accumulate_grad_hook(lambda _: hook()), None
+    # `AccumulateGrad` node of the leaf, as the original python DDP does.
+    grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]
+    return grad_acc.register_hook(lambda *_: hook()), grad_acc
+
+
+class GradientCompression(object):
+    """All-reduce of a flat gradient bucket, without compression.
+
+    `reduce` launches the communication and returns a function that waits
+    for it and writes the average over all ranks into the bucket. `shapes`
+    are the shapes of the gradients flattened into the bucket, `scale` is
+    the loss scale of mixed precision training the bucket is multiplied by,
+    as a tensor, or None. `n_bytes` counts the bytes sent per rank since the
+    last `reset_stats`.
+    """
+
+    def __init__(self):
+        self.n_bytes = 0
+
+    def reset(self):
+        """Drop the state kept per bucket, e.g. after the buckets changed."""
+
+    def reset_stats(self):
+        self.n_bytes = 0
+
+    def reduce(self, buffer, key, shapes, scale=None):
+        world_size = get_world_size()
+        handle = dist.all_reduce(buffer, async_op=True)
+        self.n_bytes += buffer.numel() * buffer.element_size()
+
+        def wait():
+            handle.wait()
+            buffer.div_(world_size)
+
+        return wait
+
+
+class CastCompression(GradientCompression):
+    """All-reduce buckets in a lower precision `dtype`, e.g. fp16 or bf16."""
+
+    def __init__(self, dtype):
+        super(CastCompression, self).__init__()
+        self.dtype = dtype
+
+    def reduce(self, buffer, key, shapes, scale=None):
+        world_size = get_world_size()
+        # Average first, so the sum stays in range.
+        casted = buffer.div(world_size).to(self.dtype)
+        handle = dist.all_reduce(casted, async_op=True)
+        self.n_bytes += casted.numel() * casted.element_size()
+
+        def wait():
+            handle.wait()
+            buffer.copy_(casted)
+
+        return wait
+
+
+class ErrorFeedbackCompression(GradientCompression):
+    """Lossy compression which adds what was not sent to the next step.
+
+    Residuals are kept divided by the loss scale, so they stay valid when
+    the scale changes, and dropped for buckets with inf or NaN gradients,
+    which the loss scaler skips.
+    """
+
+    def __init__(self):
+        super(ErrorFeedbackCompression, self).__init__()
+        self.residuals = {}
+
+    def reset(self):
+        self.residuals = {}
+
+    def add_residual(self, buffer, key, scale):
+        """Add the residual of bucket `key` to `buffer`."""
+        if key in self.residuals:
+            residual = self.residuals[key]
+            buffer.add_(residual if scale is None else residual * scale)
+
+    def set_residual(self, residual, key, scale, finite):
+        """Keep `residual` for bucket `key`, `finite` is a bool tensor."""
+        # No `if`, to not wait for the device.
+        residual = torch.where(finite, residual, torch.zeros_like(residual))
+        self.residuals[key] = residual if scale is None else residual / scale
+
+
+class TopKCompression(ErrorFeedbackCompression):
+    """Exchange the `ratio` largest entries of each bucket.
+
+    Entries not sent are kept as error feedback and added to the bucket of
+    the next step.
+    """
+
+    def __init__(self, ratio=0.01):
+        super(TopKCompression, self).__init__()
+        self.ratio = ratio
+
+    def reduce(self, buffer, key, shapes, scale=None):
+        world_size = get_world_size()
+        self.add_residual(buffer, key, scale)
+        k = max(1, int(buffer.numel() * self.ratio))
+        _, indices = buffer.abs().topk(k, sorted=False)
+        values = buffer[indices]
+        residual = buffer.clone()
+        residual[indices] = 0
+        self.set_residual(residual, key, scale, torch.isfinite(buffer).all())
+        all_values = [torch.empty_like(values) for _ in range(world_size)]
+        all_indices = [torch.empty_like(indices) for _ in range(world_size)]
+        handles = [dist.all_gather(all_values, values, async_op=True),
+                   dist.all_gather(all_indices, indices, async_op=True)]
+        self.n_bytes += k * (values.element_size() + indices.element_size())
+
+        def wait():
+            for handle in handles:
+                handle.wait()
+            buffer.zero_()
+            for rank_values, rank_indices in zip(all_values, all_indices):
+                buffer.index_add_(0, rank_indices, rank_values)
+            buffer.div_(world_size)
+
+        return wait
+
+
+class PowerSGDCompression(ErrorFeedbackCompression):
+    """PowerSGD low-rank approximation of each gradient, with error feedback.
+
+    The gradient of a weight is reshaped into a matrix `M` of its first
+    dimension by the others and approximated by `P Q^T` of `rank` columns.
+    `P = M Q` is all-reduced during backward, `Q = M^T P` once the reducer
+    waits. `Q` is warm started from the previous step. 1-D gradients (biases
+    and normalization) and matrices too small to gain from it are all-reduced
+    uncompressed along with `P`.
+
+    Reference: `PowerSGD: Practical Low-Rank Gradient Compression for
+    Distributed Optimization <https://arxiv.org/abs/1905.13727>`_.
+    """
+
+    def __init__(self, rank=4, seed=0):
+        super(PowerSGDCompression, self).__init__()
+        self.rank = rank
+        self.seed = seed
+        self.qs = {}
+
+    def reset(self):
+        super(PowerSGDCompression, self).reset()
+        self.qs = {}
+
+    def reduce(self, buffer, key, shapes, scale=None):
+        world_size = get_world_size()
+        self.add_residual(buffer, key, scale)
+        finite = torch.isfinite(buffer).all()
+        matrices = []
+        uncompressed = []
+        offset = 0
+        for index, shape in enumerate(shapes):
+            n = shape.numel()
+            flat = buffer[offset:offset + n]
+            if len(shape) > 1:
+                matrix = flat.view(shape[0], -1)
+                rank = min(self.rank, *matrix.shape)
+                if rank * sum(matrix.shape) < n:
+                    matrices.append(((key, index), offset, matrix, rank))
+                    offset += n
+                    continue
+            uncompressed.append(flat)
+            offset += n
+        ps = []
+        for q_key, _, matrix, rank in matrices:
+            if q_key not in self.qs:
+                # Same on all ranks.
+                generator = torch.Generator().manual_seed(self.seed)
+                self.qs[q_key] = torch.randn(matrix.shape[1], rank,
+                                             generator=generator).to(buffer)
+            ps.append(matrix.mm(self.qs[q_key]))
+        # `P`s and uncompressed gradients in a single all-reduce.
+        packed = torch.cat([p.view(-1) for p in ps] + uncompressed)
+        handle = dist.all_reduce(packed, async_op=True)
+        self.n_bytes += packed.numel() * packed.element_size()
+        self.n_bytes += sum(matrix.shape[1] * rank for _, _, matrix, rank in matrices) \
+            * buffer.element_size()
+
+        def wait():
+            handle.wait()
+            offset = 0
+            p_orths = []
+            for p in ps:
+                p_orths.append(_orthogonalize(packed[offset:offset + p.numel()].view_as(p)))
+                offset += p.numel()
+            for flat in uncompressed:
+                flat.copy_(packed[offset:offset + flat.numel()]).div_(world_size)
+                offset += flat.numel()
+            if not matrices:
+                return
+            qs = [matrix.t().mm(p_orth) for (_, _, matrix, _), p_orth in zip(matrices, p_orths)]
+            packed_qs = torch.cat([q.view(-1) for q in qs])
+            dist.all_reduce(packed_qs)
+            packed_qs.div_(world_size)
+            # The uncompressed gradients are exact.
+            residual = torch.zeros_like(buffer)
+            offset = 0
+            for (q_key, start, matrix, _), p_orth, q in zip(matrices, p_orths, qs):
+                q = packed_qs[offset:offset + q.numel()].view_as(q)
+                offset += q.numel()
+                # Keep the warm start of a skipped step.
+                self.qs[q_key] = torch.where(torch.isfinite(q).all(), q, self.qs[q_key])
+                approx = p_orth.mm(q.t())
+                residual[start:start + matrix.numel()].copy_((matrix - approx).view(-1))
+                matrix.copy_(approx)
+            self.set_residual(residual, key, scale, finite)
+
+        return wait
+
+
+def _orthogonalize(matrix):
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'qr'):
+        return torch.linalg.qr(matrix)[0]
+    return torch.qr(matrix)[0]
+
+
+def get_gradient_compression(config):
+    """Build the gradient compression from its config.
+
+    Args:
+        config: `None` or a dict with `method` in `fp16`, `bf16`, `topk` or
+            `powersgd`, and optionally `ratio` for `topk` and `rank` for
+            `powersgd`.
+    """
+    if not config:
+        return GradientCompression()
+    method = config['method']
+    if method == 'fp16':
+        return CastCompression(torch.float16)
+    elif method == 'bf16':
+        return CastCompression(torch.bfloat16)
+    elif method == 'topk':
+        return TopKCompression(config.get('ratio', 0.01))
+    elif method == 'powersgd':
+        return PowerSGDCompression(config.get('rank', 4))
+    raise ValueError('Unknown gradient compression: {}'.format(method))
+
+
+class GradientReducer(object):
+    """All-reduce gradients in buckets, overlapped with backward.
+
+    Parameters are split into buckets of about `bucket_size_mb` in reverse
+    order, which is roughly the order backward produces their gradients. A
+    bucket is all-reduced asynchronously as soon as all its gradients are
+    accumulated and all buckets before it are launched, so that every rank
+    issues the collectives in the same order as DDP does. `finish` reduces
+    the buckets left (e.g. with unused parameters) and waits for all of them.
+
+    Buckets are rebuilt when the parameters of the module change, e.g. by
+    `shrink_model`. `n_bytes` and `n_bytes_raw` are the bytes sent in the
+    last step, with and without `compression`. Set `grad_scaler` to the loss
+    scaler of mixed precision training, for `compression` to keep its error
+    feedback in unscaled units.
+    """
+
+    def __init__(self, module, bucket_size_mb=25, compression=None):
+        self.module = module
+        self.bucket_size = bucket_size_mb * 1024 * 1024
+        self.compression = compression or GradientCompression()
+        self.n_bytes = 0
+        self.n_bytes_raw = 0
+        self._param_ids = None
+        self._hooks = []
+        self._buckets = []
+        self._next_bucket = 0
+        self.grad_scaler = None
+
+    def _build(self, params):
+        for handle, _ in self._hooks:
+            handle.remove()
+        self._hooks = []
+        self._buckets = []
+        self.compression.reset()
+        self._param_ids = tuple(id(param) for param in self.module.parameters())
+        buckets = OrderedDict()
+        for param in reversed(params):
+            key = (param.device, param.dtype)
+            if key not in buckets or buckets[key]['size'] >= self.bucket_size:
+                buckets[key] = {'params': [], 'size': 0}
+                self._buckets.append(buckets[key])
+            buckets[key]['params'].append(param)
+            buckets[key]['size'] += param.numel() * param.element_size()
+        for key, bucket in enumerate(self._buckets):
+            bucket['key'] = key
+            bucket['shapes'] = [param.shape for param in bucket['params']]
+            bucket['buffer'] = torch.empty(
+                sum(param.numel() for param in bucket['params']),
+                dtype=bucket['params'][0].dtype, device=bucket['params'][0].device)
+            for param in bucket['params']:
+                self._hooks.append(_register_grad_ready_hook(
+                    param, functools.partial(self._mark_ready, bucket)))
+
+    def prepare(self):
+        """Reset the buckets before a backward, rebuild them if needed."""
+        if self._param_ids != tuple(id(param) for param in self.module.parameters()):
+            params = [param for param in self.module.parameters()
+                      if isinstance(param, torch.Tensor) and param.requires_grad]
+            self._build(params)
+        for bucket in self._buckets:
+            bucket['ready'] = 0
+            bucket['handle'] = None
+        self._next_bucket = 0
+
+    def _loss_scale(self):
+        if self.grad_scaler is None or not self.grad_scaler.is_enabled():
+            return None
+        # A tensor, `get_scale` would wait for the device.
+        return self.grad_scaler._get_scale_async()
+
+    def _launch(self, bucket):
+        grads = [param.grad.detach().reshape(-1) if param.grad is not None else
+                 torch.zeros(param.numel(), dtype=param.dtype, device=param.device)
+                 for param in bucket['params']]
+        torch.cat(grads, out=bucket['buffer'])
+        bucket['handle'] = self.compression.reduce(bucket['buffer'], bucket['key'],
+                                                   bucket['shapes'], self._loss_scale())
+
+    def _mark_ready(self, bucket):
+        if 'ready' not in bucket:  # not prepared, e.g. backward outside of training
+            return
+        bucket['ready'] += 1
+        # Buckets may be ready out of order, launch them in order only.
+        while self._next_bucket < len(self._buckets):
+            bucket = self._buckets[self._next_bucket]
+            if bucket['ready'] < len(bucket['params']):
+                break
+            self._launch(bucket)
+            self._next_bucket += 1
+
+    def finish(self):
+        """Wait for all buckets and write the averaged gradients back."""
+        for bucket in self._buckets[self._next_bucket:]:
+            self._launch(bucket)
+        self._next_bucket = 0
+        with torch.no_grad():
+            for bucket in self._buckets:
+                bucket['handle']()
+                bucket['handle'] = None
+                bucket['ready'] = 0
+                flat = bucket['buffer']
+                offset = 0
+                for param in bucket['params']:
+                    if param.grad is not None:
+                        param.grad.copy_(flat[offset:offset + param.numel()].view_as(param.grad))
+                    offset += param.numel()
+        self.n_bytes = self.compression.n_bytes
+        self.n_bytes_raw = sum(bucket['buffer'].numel() * bucket['buffer'].element_size()
+                               for bucket in self._buckets)
+        self.compression.reset_stats()
+
+
 class AllReduceDistributedDataParallel(nn.Module):  # old way of DDP
 
-    def __init__(self, module, dim=0, broadcast_buffers=True, bucket_cap_mb=25):
+    """Data parallel module, gradients are averaged by `allreduce_grads`.
+
+    Args:
+        grad_bucket_cap_mb: Size of the gradient buckets all-reduced during
+            backward, see `GradientReducer`. Non-positive to all-reduce all
+            gradients after backward instead.
+        grad_compression: Config of `get_gradient_compression`, applied to
+            each gradient bucket.
+    """
+
+    def __init__(self, module, dim=0, broadcast_buffers=True, bucket_cap_mb=25,
+                 grad_bucket_cap_mb=25, grad_compression=None):
         super(AllReduceDistributedDataParallel, self).__init__()
         self.module = module
         self.dim = dim
         self.broadcast_buffers = broadcast_buffers
 
         self.broadcast_bucket_size_mb = bucket_cap_mb
+        self.reducer = None
+        if grad_bucket_cap_mb > 0:
+            self.reducer = GradientReducer(
+                module, grad_bucket_cap_mb,
+                get_gradient_compression(grad_compression))
+        elif grad_compression:
+            raise ValueError('Gradient compression needs grad_bucket_cap_mb > 0')
         self._sync_params()
 
     def _sync_params(self):
@@ -204,6 +658,8 @@ class AllReduceDistributedDataParallel(nn.Module):  # old way of DDP
         return scatter_kwargs(inputs, kwargs, device_ids, dim=self.dim)
 
     def forward(self, *inputs, **kwargs):
+        if self.reducer is not None and self.training and torch.is_grad_enabled():
+            self.reducer.prepare()
         if DEVICE_MODE == "gpu":
             inputs, kwargs = self.scatter(inputs, kwargs,
                                         [torch.cuda.current_device()])
@@ -11,18 +11,25 @@ import models.hrnet_base as hrb
 import models.transformer as transformer
 from utils import distributed as udist
 from utils.config import DEVICE_MODE
-from utils.secure_profiling_prediction_powerful import *
+from utils.secure_profiling_prediction import DEFAULT_PROFILE, get_profile_predictor
+from utils.secure_profiling_prediction import conv_features, linear_features, relu_features, bn_features, avgpool_features, maxpool_features
+from utils.secure_profiling_prediction import mha_features, softmax_features, layernorm_features, upsample_features, pad_features, numel
+from utils.profiling_cache import get_profiling_cache, module_key, model_key, encode_shapes, decode_shapes
+from utils import mpc_cost
 
 import warnings
 warnings.filterwarnings("ignore")
 
 model_profiling_hooks = []
 model_profiling_speed_hooks = []
+model_profiling_calls = []
 
 name_space = 95
 params_space = 15
 macs_space = 15
 seconds_space = 15
+rounds_space = 10
+bytes_space = 17
 
 
 # class Timer(object):
@@ -73,18 +80,132 @@ def conv_module_name_filter(name):
     return name
 
 
-def module_profiling(self, input, output, num_forwards, verbose):
+def shape_only(x):
+    """Replace tensors by storage-free stand-ins, profiling only reads shapes."""
+    if isinstance(x, torch.Tensor):
+        return torch.empty(x.size(), device='meta')
+    elif isinstance(x, (list, tuple)):
+        return type(x)(shape_only(val) for val in x)
+    return x
+
+
+def latency_request(self, input, output):
+    """Get `(op, features)` for the latency of a module call.
+
+    Only the latency not covered by hooked submodules is requested, e.g. the
+    functional ReLU of a transformer layer. Returns `None` for modules without
+    own latency.
+    """
+    if not input or isinstance(input[0], list) or isinstance(output, list):
+        return None
+    if isinstance(self, (nn.Conv2d, nn.ConvTranspose2d)):
+        return 'conv', conv_features(input[0].size(), output.size(), self.kernel_size)
+    elif isinstance(self, nn.Linear):
+        return 'fc', linear_features(input[0].size(), output.size())
+    elif isinstance(self, nn.ReLU):
+        return 'relu', relu_features(input[0].size(), output.size())
+    elif isinstance(self, nn.BatchNorm2d):
+        return 'bn', bn_features(input[0].size(), output.size())
+    elif isinstance(self, nn.AvgPool2d):
+        return 'ap', avgpool_features(input[0].size(), output.size(), self.kernel_size)
+    elif isinstance(self, nn.MaxPool2d):
+        return 'mp', maxpool_features(input[0].size(), output.size(), self.kernel_size)
+    elif isinstance(self, nn.MultiheadAttention):
+        # query: [L, N, E], key: [S, N, E]
+        return 'mha', mha_features(input[0].size(0), input[1].size(0),
+                                   input[0].size(2), self.num_heads, input[0].size(1))
+    elif isinstance(self, nn.Softmax):
+        return 'softmax', softmax_features(input[0].size(), -1 if self.dim is None else self.dim)
+    elif isinstance(self, nn.LayerNorm):
+        return 'ln', layernorm_features(input[0].size(), self.normalized_shape)
+    elif isinstance(self, nn.Upsample):
+        return 'up', upsample_features(input[0].size(), output.size())
+    elif isinstance(self, nn.ZeroPad2d):
+        return 'pad', pad_features(input[0].size(), output.size())
+    elif isinstance(self, (transformer.TransformerEncoderLayer, transformer.TransformerDecoderLayer)):
+        # functional activation between linear1 and linear2
+        return 'relu', relu_features([1, output.numel() // output.size(-1) * self.linear1.out_features, 1, 1], None)
+    elif isinstance(self, transformer.MHAttentionMap):
+        # functional softmax over the flattened attention map, output: [N, Q, H, h, w]
+        return 'softmax', softmax_features([output.size(0), output.size(1), numel(output.size()[2:])])
+    return None
+
+
+def communication_cost(self, input, output):
+    """Get `[rounds, bytes]` of the MPC communication of a module call.
+
+    Like `latency_request`, only the cost not covered by hooked submodules is
+    returned, see `utils.mpc_cost`.
+    """
+    if not input or isinstance(input[0], list) or isinstance(output, list):
+        return mpc_cost.ZERO
+    if isinstance(self, (nn.Conv2d, nn.ConvTranspose2d)):
+        return mpc_cost.conv_cost(input[0].size(), output.size(), self.kernel_size, self.groups)
+    elif isinstance(self, nn.Linear):
+        return mpc_cost.linear_cost(input[0].size(), output.size())
+    elif isinstance(self, nn.ReLU):
+        return mpc_cost.relu_cost(input[0].numel())
+    elif isinstance(self, nn.BatchNorm2d):
+        return mpc_cost.bn_cost(input[0].size())
+    elif isinstance(self, (nn.AvgPool2d, nn.AdaptiveAvgPool2d)):
+        return mpc_cost.avgpool_cost(output.size())
+    elif isinstance(self, nn.MaxPool2d):
+        return mpc_cost.maxpool_cost(output.size(), self.kernel_size)
+    elif isinstance(self, nn.MultiheadAttention):
+        # query: [L, N, E], key: [S, N, E]
+        return mpc_cost.mha_cost(input[0].size(0), input[1].size(0), input[0].size(2),
+                                 self.num_heads, input[0].size(1))
+    elif isinstance(self, nn.Softmax):
+        return mpc_cost.softmax_cost(input[0].size(), -1 if self.dim is None else self.dim)
+    elif isinstance(self, nn.LayerNorm):
+        return mpc_cost.layernorm_cost(input[0].size(), self.normalized_shape)
+    elif isinstance(self, (transformer.TransformerEncoderLayer, transformer.TransformerDecoderLayer)):
+        # functional activation between linear1 and linear2
+        return mpc_cost.relu_cost(output.numel() // output.size(-1) * self.linear1.out_features)
+    elif isinstance(self, transformer.MHAttentionMap):
+        # functional softmax over the flattened attention map, output: [N, Q, H, h, w]
+        return mpc_cost.softmax_cost([output.size(0), output.size(1), numel(output.size()[2:])])
+    # Sigmoid, SiLU etc. are not modelled, upsampling and padding are local.
+    return mpc_cost.ZERO
+
+
+def hook_inputs(self, args, kwargs):
+    """Positional inputs of a module call, `nn.MultiheadAttention` is mostly called with keywords."""
+    if isinstance(self, nn.MultiheadAttention):
+        args = tuple(args) + tuple(kwargs[k] for k in ['query', 'key', 'value'][len(args):] if k in kwargs)
+    return args
+
+
+def module_profiling(self, input, output, num_forwards, verbose, n_seconds=None):
+    """Profile one module call.
+
+    `n_seconds` is the predicted latency of the call as requested by
+    `latency_request`, if already known. Otherwise it is predicted here layer
+    by layer.
+    """
     def add_sub(m, sub_op):
         m.n_macs += getattr(sub_op, 'n_macs', 0)
         m.n_params += getattr(sub_op, 'n_params', 0)
         m.n_seconds += getattr(sub_op, 'n_seconds', 0)
+        m.n_rounds += getattr(sub_op, 'n_rounds', 0)
+        m.n_bytes += getattr(sub_op, 'n_bytes', 0)
+
+    if n_seconds is None:
+        request = latency_request(self, input, output)
+        n_seconds = 0 if request is None else \
+            get_profile_predictor(DEFAULT_PROFILE).predict_one(*request)
 
     # _run_forward = functools.partial(run_forward, num_forwards=num_forwards)
     # if isinstance(self, (hr.ParallelModule, hr.FuseModule, hr.HeadModule)) \
     #     or (isinstance(self, nn.Sequential) and isinstance(self[0], hr.ParallelModule)):
     if not input:
         return
-    if isinstance(self, nn.MultiheadAttention) or isinstance(input[0], list) or isinstance(output, list):
+    # Own communication, submodules are added on top by `add_sub`.
+    self.n_rounds, self.n_bytes = communication_cost(self, input, output)
+    if isinstance(self, nn.MultiheadAttention):
+        # query, key and value, see `utils.prune.get_mpc_latencies`
+        self._profiling_input_sizes = [x.size() for x in input]
+    elif isinstance(input[0], list) or isinstance(output, list):
         pass
     else:
         ins = input[0].size()
@@ -99,7 +220,7 @@ def module_profiling(self, input, output, num_forwards, verbose):
                        self.kernel_size[1] * outs[2] * outs[3] //
                        self.groups) * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = conv_time_cal(ins, outs, self.kernel_size) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = conv_module_name_filter(self.__repr__())
         
     elif isinstance(self, nn.ConvTranspose2d):
@@ -107,33 +228,39 @@ def module_profiling(self, input, output, num_forwards, verbose):
                       self.kernel_size[1] * outs[2] * outs[3] //
                       self.groups) * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = conv_time_cal(ins, outs, self.kernel_size) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = conv_module_name_filter(self.__repr__())
     
     elif isinstance(self, nn.Linear):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = linear_time_cal(ins, outs) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = self.__repr__()
         
     elif isinstance(self, nn.ReLU):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = relu_time_cal(ins, outs) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = self.__repr__()
         
     elif isinstance(self, nn.BatchNorm2d):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = bn_time_cal(ins, outs) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = self.__repr__()
         
     elif isinstance(self, nn.AvgPool2d):
         self.n_macs = ins[1] * ins[2] * ins[3] * ins[0]
         self.n_params = 0
-        self.n_seconds = avgpool_time_cal(ins, outs, self.kernel_size) # calculated in ms 
+        self.n_seconds = n_seconds # calculated in ms
         self.name = self.__repr__()
         
+    elif isinstance(self, (nn.MaxPool2d, nn.Softmax, nn.LayerNorm, nn.Upsample, nn.ZeroPad2d)):
+        self.n_macs = 0
+        self.n_params = get_params(self)
+        self.n_seconds = n_seconds # calculated in ms
+        self.name = self.__repr__()
+
     elif isinstance(self, nn.AdaptiveAvgPool2d):
         self.n_macs = ins[1] * ins[2] * ins[3] * ins[0]
         self.n_params = 0
@@ -211,30 +338,47 @@ def module_profiling(self, input, output, num_forwards, verbose):
         add_sub(self, self.reverse_proj)
         add_sub(self, self.encoder)
         add_sub(self, self.decoder)
+        # MPC cost only, n_macs are kept as before
+        for m in [self.input_norm, self.reverse_norm] + \
+                ([self.attention, self.att_proj] if self.attention_for_seg else []):
+            self.n_seconds += getattr(m, 'n_seconds', 0)
+            self.n_rounds += getattr(m, 'n_rounds', 0)
+            self.n_bytes += getattr(m, 'n_bytes', 0)
         self.name = self.__repr__()
 
     elif isinstance(self, transformer.TransformerEncoderLayer):
         self.n_macs = 0
         self.n_params = 0
-        self.n_seconds = 0
+        self.n_seconds = n_seconds
         add_sub(self, self.self_attn)
         add_sub(self, self.linear1)
         add_sub(self, self.linear2)
+        add_sub(self, self.norm1)
+        add_sub(self, self.norm2)
         self.name = self.__repr__()
 
     elif isinstance(self, transformer.TransformerDecoderLayer):
         self.n_macs = 0
         self.n_params = 0
-        self.n_seconds = 0
+        self.n_seconds = n_seconds
         add_sub(self, self.multihead_attn)
         add_sub(self, self.linear1)
         add_sub(self, self.linear2)
+        add_sub(self, self.norm1)
+        add_sub(self, self.norm2)
+        self.name = self.__repr__()
+
+    elif isinstance(self, transformer.MHAttentionMap):
+        self.n_macs = 0
+        self.n_params = 0
+        self.n_seconds = n_seconds
+        add_sub(self, self.q_linear)
         self.name = self.__repr__()
 
     elif isinstance(self, nn.MultiheadAttention):
         self.n_macs = 0
         self.n_params = 0
-        self.n_seconds = 0
+        self.n_seconds = n_seconds
         add_sub(self, self.out_proj)
         self.n_macs += 2 * input[0].shape[0] * input[1].shape[0] * input[0].shape[2] + \
            4 * input[0].shape[0] * input[0].shape[2] * input[0].shape[2]
@@ -280,6 +424,8 @@ def module_profiling(self, input, output, num_forwards, verbose):
             self.n_macs += getattr(m, 'n_macs', 0)
             self.n_params += getattr(m, 'n_params', 0)
             self.n_seconds += getattr(m, 'n_seconds', 0)
+            self.n_rounds += getattr(m, 'n_rounds', 0)
+            self.n_bytes += getattr(m, 'n_bytes', 0)
             num_children += 1
         ignore_zeros_t = [
             nn.BatchNorm2d,
@@ -308,22 +454,99 @@ def module_profiling(self, input, output, num_forwards, verbose):
                 self.name.ljust(name_space, ' ') +
                 '{:,}'.format(self.n_params).rjust(params_space, ' ') +
                 '{:,}'.format(self.n_macs).rjust(macs_space, ' ') +
-                '{:,}'.format(self.n_seconds).rjust(seconds_space, ' '))
+                '{:,}'.format(self.n_seconds).rjust(seconds_space, ' ') +
+                '{:,}'.format(self.n_rounds).rjust(rounds_space, ' ') +
+                '{:,}'.format(self.n_bytes).rjust(bytes_space, ' '))
     return
 
 
 def add_profiling_hooks(m, num_forwards, verbose):
+    # Calls are only recorded here, see `profile_recorded_calls`.
     global model_profiling_hooks
     model_profiling_hooks.append(
-        m.register_forward_hook(lambda m, input, output: module_profiling(
-            m, input, output, num_forwards, verbose=verbose)))
+        m.register_forward_hook(lambda m, args, kwargs, output: model_profiling_calls.append(
+            (m, shape_only(hook_inputs(m, args, kwargs)), shape_only(output))), with_kwargs=True))
 
 
 def remove_profiling_hooks():
     global model_profiling_hooks
+    global model_profiling_calls
     for h in model_profiling_hooks:
         h.remove()
     model_profiling_hooks = []
+    model_profiling_calls = []
+
+
+def load_recorded_calls(model, cache, key):
+    """Restore the calls of a forward pass from `cache`, `False` on a miss."""
+    global model_profiling_calls
+    calls = cache.get_calls(key)
+    if calls is None:
+        return False
+    modules = dict(model.named_modules())
+    model_profiling_calls = [(modules[name], decode_shapes(input), decode_shapes(output))
+                             for name, input, output in calls]
+    return True
+
+
+def save_recorded_calls(model, cache, key):
+    names = {id(m): name for name, m in model.named_modules()}
+    cache.put_calls(key, [[names[id(m)], encode_shapes(input), encode_shapes(output)]
+                          for m, input, output in model_profiling_calls])
+
+
+def profile_recorded_calls(num_forwards, verbose, profiles, cache=None):
+    """Profile recorded module calls in execution order.
+
+    Latencies of all modules are predicted up front with one `predict`
+    per op type, instead of one model load and `predict` per layer.
+
+    The aggregation is replayed once per profile. Every module ends up with
+    `n_seconds_profiles`, a dict from profile to its latency, and with
+    `n_seconds` of the first profile.
+
+    If a `ProfilingCache` is given, only calls whose module and shapes are
+    not in it yet are predicted.
+    """
+    requests = []
+    indices = []
+    for i, (m, input, output) in enumerate(model_profiling_calls):
+        request = latency_request(m, input, output)
+        if request is not None:
+            requests.append(request)
+            indices.append(i)
+    if cache is not None:
+        keys = [module_key(model_profiling_calls[i][0], model_profiling_calls[i][1],
+                           model_profiling_calls[i][2]) for i in indices]
+    modules = list({id(m): m for m, _, _ in model_profiling_calls}.values())
+    for m in modules:
+        m.n_seconds_profiles = {}
+    # Primary profile last, so that it sets `n_seconds` and is the only one logged.
+    for profile in reversed(profiles):
+        seconds = [0] * len(model_profiling_calls)
+        predictor = get_profile_predictor(profile)
+        misses = list(range(len(requests)))
+        if cache is not None:
+            namespace = 'mpc/{}@{}'.format(profile, predictor.version())
+            misses = []
+            for j, (i, key) in enumerate(zip(indices, keys)):
+                entry = cache.get(namespace, key)
+                if entry is None:
+                    misses.append(j)
+                else:
+                    seconds[i] = entry['n_seconds']
+        predicted = predictor.predict_many([requests[j] for j in misses])
+        for j, n_seconds in zip(misses, predicted):
+            seconds[indices[j]] = n_seconds
+        to_put = {indices[j]: keys[j] for j in misses} if cache is not None else {}
+        for i, ((m, input, output), n_seconds) in enumerate(zip(model_profiling_calls, seconds)):
+            module_profiling(m, input, output, num_forwards,
+                             verbose and profile == profiles[0],
+                             n_seconds=n_seconds)
+            if i in to_put:
+                cache.put(namespace, to_put[i], m.n_macs, m.n_params, n_seconds)
+        for m in modules:
+            m.n_seconds_profiles[profile] = getattr(m, 'n_seconds', 0)
 
 
 def model_profiling(model,
@@ -334,10 +557,15 @@ def model_profiling(model,
                     use_cuda=True,
                     num_forwards=10,
                     verbose=True,
-                    encrypt=False):
+                    encrypt=False,
+                    profiles=None,
+                    cache_path=None,
+                    networks=None):
     """ Pytorch model profiling with input image size
     (batch, channel, height, width).
-    The function exams the number of multiply-accumulates (n_macs).
+    The function exams the number of multiply-accumulates (n_macs), the
+    predicted MPC latency (n_seconds) and the MPC communication (n_rounds and
+    n_bytes, see `utils.mpc_cost`).
 
     Args:
         model: pytorch model
@@ -347,12 +575,21 @@ def model_profiling(model,
         channel: int
         use_cuda: bool
         encrypt: bool - If True, encrypts the input tensor to a CrypTensor first.
+        profiles: list - Latency profiles under `utils/LR_model` to score the
+            model against, `n_seconds` is taken from the first one.
+        cache_path: str - If given, a JSON `ProfilingCache` of the module
+            calls and per-module latencies. The forward pass is skipped if
+            the model and its shapes are in it, only modules with new shapes
+            are predicted.
+        networks: list - `[bandwidth_mbps, rtt_ms]` pairs, the communication
+            latency of the model is logged for each of them.
 
     Returns:
         macs: int
         params: int
 
     """
+    profiles = list(profiles or [DEFAULT_PROFILE])
     model.eval()
     data = torch.rand(batch, channel, height, width)
 
@@ -362,23 +599,49 @@ def model_profiling(model,
     device = torch.device("cuda" if use_cuda else "cpu")
     model = model.to(device)
     data = data.to(device)
-    model.apply(lambda m: add_profiling_hooks(m, num_forwards, verbose=verbose))
+    cache = get_profiling_cache(cache_path)
+    if cache is not None:
+        cache.reset_stats()
     if verbose:
         logging.info('Item'.ljust(name_space, ' ') +
                      'params'.rjust(macs_space, ' ') +
                      'macs'.rjust(macs_space, ' ') +
-                     'nanosecs'.rjust(seconds_space, ' '))
+                     'nanosecs'.rjust(seconds_space, ' ') +
+                     'rounds'.rjust(rounds_space, ' ') +
+                     'bytes'.rjust(bytes_space, ' '))
         logging.info(''.center(
-            name_space + params_space + macs_space + seconds_space, '-'))
-    with torch.no_grad():
-        model(data)
+            name_space + params_space + macs_space + seconds_space +
+            rounds_space + bytes_space, '-'))
+    key = None if cache is None else model_key(model, data)
+    if key is None or not load_recorded_calls(model, cache, key):
+        model.apply(lambda m: add_profiling_hooks(m, num_forwards, verbose=verbose))
+        with torch.no_grad():
+            model(data)
+        if key is not None:
+            save_recorded_calls(model, cache, key)
+    profile_recorded_calls(num_forwards, verbose, profiles, cache)
+    if cache is not None and udist.is_master():
+        logging.info('Profiling cache: {} hits, {} misses.'.format(
+            cache.hits, cache.misses))
+        cache.save()
     if verbose:
         logging.info(''.center(
             name_space + seconds_space, '-')) #name_space + params_space + macs_space + seconds_space, '-'))
         logging.info('Total'.ljust(name_space, ' ') +
                      '{:,}'.format(model.n_params).rjust(params_space, ' ') +
                      '{:,}'.format(model.n_macs).rjust(macs_space, ' ') +
-                     '{:,}'.format(model.n_seconds).rjust(seconds_space, ' '))
+                     '{:,}'.format(model.n_seconds).rjust(seconds_space, ' ') +
+                     '{:,}'.format(model.n_rounds).rjust(rounds_space, ' ') +
+                     '{:,}'.format(model.n_bytes).rjust(bytes_space, ' '))
+        for profile in profiles[1:]:
+            logging.info('Total ({})'.format(profile).ljust(name_space, ' ') +
+                         ''.rjust(params_space + macs_space, ' ') +
+                         '{:,}'.format(model.n_seconds_profiles[profile]).rjust(seconds_space, ' '))
+        for bandwidth_mbps, rtt_ms in networks or []:
+            logging.info('Communication ({} Mbit/s, {} ms RTT)'.format(bandwidth_mbps, rtt_ms).ljust(name_space, ' ') +
+                         ''.rjust(params_space + macs_space, ' ') +
+                         '{:,}'.format(int(mpc_cost.communication_latency(
+                             model.n_rounds, model.n_bytes, bandwidth_mbps, rtt_ms))).rjust(seconds_space, ' '))
     remove_profiling_hooks()
     model = model.to(origin_device)
     return model.n_seconds, model.n_macs, model.n_params
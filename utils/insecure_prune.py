@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import models.mobilenet_base as mb
 from utils import distributed as udist
+from utils.prune import BNL1Loss
 
 
 class PruneInfoTransformer(object):
@@ -16,6 +17,8 @@ class PruneInfoTransformer(object):
         """Init property for weights to be selected."""
         assert len(names) == len(penalties)
         self.norm_factor = norm_factor
+        # Bumped whenever the penalties change, see `BNL1Loss`.
+        self.version = 0
         self._info = collections.OrderedDict((k, {
             'compress_masked': False,
             'penalty': v
@@ -32,6 +35,7 @@ class PruneInfoTransformer(object):
         return [v[name] for v in self._info.values()]
 
     def update_penalty(self):
+        self.version += 1
         for item in self._info.values():
             print("### START UPDATE PENALTY (DAPHNEE'S VOICE) ###")
             print(f"Number of seconds: {item['nsecs']}")
@@ -65,6 +69,8 @@ class PruneInfo(object):
     def __init__(self, names, penalties):
         """Init property for weights to be selected."""
         assert len(names) == len(penalties)
+        # Bumped whenever the weights change, see `BNL1Loss`.
+        self.version = 0
         self._info = collections.OrderedDict((k, {
             'compress_masked': False,
             'penalty': v
@@ -102,6 +108,7 @@ class PruneInfo(object):
                     prune_info.compress_drop(*args, **kwargs)
             ```
         """
+        self.version += 1
         for val in self._info.values():
             val['compress_masked'] = False
 
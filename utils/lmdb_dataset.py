@@ -4,27 +4,110 @@
 Usage:
     To generate lmdb dataset from raw dataset, run
     `python utils/lmdb_dataset.py --src_dir ${src_dir} --dst_dir ${dst_dir}`
+    Add `--max_short_side 256` to store downscaled images, run the same
+    command again to resume an interrupted conversion.
 """
 
+import io
+import multiprocessing
 import os
 import pickle
-import six
+import struct
 from PIL import Image
 
 import lmdb
+import numpy as np
 from tqdm import tqdm
 
 import torch
 from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
 from torchvision.datasets import ImageFolder
 
 # Must import after torch, may due to C++ ABI issue
 import pyarrow as pa
 
 
+INDEX_KEY = b'__index__'
+PROGRESS_KEY = b'__progress__'
+# Record layout: magic, label, height and width, followed by the image file.
+RECORD_HEADER = struct.Struct('<4sqII')
+RECORD_MAGIC = b'IMG0'
+
+
+def dumps_index(keys, labels):
+    """Serialize the index of a dataset.
+
+    Keys are concatenated into one uint8 array with offsets, so that the index
+    is a handful of NumPy arrays instead of millions of Python objects, which
+    every DataLoader worker would touch (and copy) through reference counting.
+    """
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(key) for key in keys])
+    buf = io.BytesIO()
+    np.savez(buf,
+             keys=np.frombuffer(b''.join(keys), dtype=np.uint8),
+             key_offsets=offsets,
+             labels=np.asarray(labels, dtype=np.int64))
+    return buf.getvalue()
+
+
+def loads_index(byteflow):
+    """Deserialize the index of `dumps_index` into `(keys, key_offsets, labels)`."""
+    with np.load(io.BytesIO(byteflow)) as index:
+        return index['keys'], index['key_offsets'], index['labels']
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only file object over a buffer, e.g. a `memoryview` into LMDB.
+
+    Unlike `io.BytesIO`, the buffer is not copied up front.
+    """
+
+    def __init__(self, buf):
+        super(BufferReader, self).__init__()
+        self._buf = memoryview(buf).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._buf) + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
 class ImageFolderLMDB(Dataset):
-    """Lmdb dataset."""
+    """Lmdb dataset.
+
+    Records are a `RECORD_HEADER` followed by the image file, labels and keys
+    live in a NumPy index (see `dumps_index`). Each process opens its own environment with one
+    long-lived read-only transaction on first access, i.e. after the
+    DataLoader workers are forked, and decodes the images straight from the
+    memory-mapped records.
+
+    Datasets of older `folder2lmdb` versions, with pickled `(bytes, label)`
+    records and a pickled `__keys__` list, are still readable.
+    """
 
     def __init__(self, db_path, transform=None, target_transform=None):
         # Fix the path to something absolute
@@ -32,38 +115,65 @@ class ImageFolderLMDB(Dataset):
              db_path = os.path.join(os.getcwd(), db_path)
 
         self.db_path = db_path
-        self.env = lmdb.open(db_path,
-                             subdir=os.path.isdir(db_path),
-                             readonly=True,
-                             lock=False,
-                             readahead=False,
-                             meminit=False)
-        with self.env.begin(write=False) as txn:
-            # self.length = pa.deserialize(txn.get(b'__len__'))
-            # self.keys = pa.deserialize(txn.get(b'__keys__'))
-            self.length = pickle.loads(txn.get(b'__len__'))
-            self.keys = pickle.loads(txn.get(b'__keys__'))
+        env = self._open()
+        with env.begin(write=False) as txn:
+            byteflow = txn.get(INDEX_KEY)
+            if byteflow is not None:
+                self.keys, self.key_offsets, self.labels = loads_index(byteflow)
+                self.legacy = False
+            else:
+                keys = pickle.loads(txn.get(b'__keys__'))
+                self.keys, self.key_offsets, _ = loads_index(dumps_index(keys, []))
+                self.labels = None
+                self.legacy = True
+        env.close()
+        self.length = len(self.key_offsets) - 1
+        self._env = None
+        self._txn = None
+        self._pid = None
 
         self.transform = transform
         self.target_transform = target_transform
 
+    def _open(self):
+        return lmdb.open(self.db_path,
+                         subdir=os.path.isdir(self.db_path),
+                         readonly=True,
+                         lock=False,
+                         readahead=False,
+                         meminit=False)
+
+    def __getstate__(self):
+        # Environments must not cross process boundaries.
+        state = self.__dict__.copy()
+        state['_env'] = None
+        state['_txn'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_txn(self):
+        if self._pid != os.getpid():
+            # Opened lazily in every (forked) worker. With `buffers=True` the
+            # values are memoryviews into the map, valid while the
+            # transaction lives.
+            self._env = self._open()
+            self._txn = self._env.begin(write=False, buffers=True)
+            self._pid = os.getpid()
+        return self._txn
+
+    def get_key(self, index):
+        begin, end = self.key_offsets[index], self.key_offsets[index + 1]
+        return self.keys[begin:end].tobytes()
+
     def __getitem__(self, index):
-        img, target = None, None
-        env = self.env
-        with env.begin(write=False) as txn:
-            byteflow = txn.get(self.keys[index])
-        # unpacked = pa.deserialize(byteflow)
-        unpacked = pickle.loads(byteflow)
+        byteflow = self._get_txn().get(self.get_key(index))
+        if self.legacy:
+            imgbuf, target = pickle.loads(byteflow)
+        else:
+            imgbuf, target = byteflow[RECORD_HEADER.size:], int(self.labels[index])
 
         # load image
-        imgbuf = unpacked[0]
-        buf = six.BytesIO()
-        buf.write(imgbuf)
-        buf.seek(0)
-        img = Image.open(buf).convert('RGB')
-
-        # load label
-        target = unpacked[1]
+        img = Image.open(BufferReader(imgbuf)).convert('RGB')
 
         if self.transform is not None:
             img = self.transform(img)
@@ -98,15 +208,47 @@ def dumps_pyarrow(obj):
     return pickle.dumps(obj)
 
 
-def folder2lmdb(src_dir, dst_dir, name="train", write_frequency=5000):
-    """Convert torchvision's `ImageFolder` to lmdb dataset."""
+def encode_record(path, label, max_short_side=None, quality=95):
+    """Encode an image file as a record, see `RECORD_HEADER`.
+
+    Images whose short side exceeds `max_short_side` are resized and
+    re-encoded as JPEG, all others are stored as is.
+    """
+    image = raw_reader(path)
+    img = Image.open(io.BytesIO(image))
+    width, height = img.size
+    if max_short_side is not None and min(width, height) > max_short_side:
+        scale = max_short_side / min(width, height)
+        width, height = round(width * scale), round(height * scale)
+        img = img.convert('RGB').resize((width, height), Image.BICUBIC)
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=quality)
+        image = buf.getvalue()
+    return RECORD_HEADER.pack(RECORD_MAGIC, label, height, width) + image
+
+
+def _encode_chunk(args):
+    chunk_idx, begin, samples, max_short_side = args
+    return chunk_idx, [(u'{}'.format(begin + i).encode('ascii'),
+                        encode_record(path, label, max_short_side))
+                       for i, (path, label) in enumerate(samples)]
+
+
+def folder2lmdb(src_dir, dst_dir, name="train", num_workers=16,
+                chunk_size=1000, max_short_side=None):
+    """Convert torchvision's `ImageFolder` to lmdb dataset.
+
+    Images are encoded by `num_workers` processes in chunks of `chunk_size`
+    and written by this one, LMDB allows a single writer. Every chunk is
+    committed together with the number of chunks done, so an interrupted
+    conversion resumes from the last committed chunk when run again.
+    """
     directory = os.path.expanduser(os.path.join(src_dir, name))
     print("Loading dataset from %s" % directory)
-    dataset = ImageFolder(directory, loader=raw_reader)
-    data_loader = DataLoader(dataset, num_workers=16, collate_fn=lambda x: x)
+    samples = ImageFolder(directory).samples
 
     lmdb_path = os.path.join(dst_dir, name)
-    os.makedirs(lmdb_path)
+    os.makedirs(lmdb_path, exist_ok=True)
     isdir = os.path.isdir(lmdb_path)
 
     print("Generate LMDB to %s" % lmdb_path)
@@ -117,20 +259,35 @@ def folder2lmdb(src_dir, dst_dir, name="train", write_frequency=5000):
                    meminit=False,
                    map_async=True)
 
-    txn = db.begin(write=True)
-    for idx, data in enumerate(tqdm(data_loader)):
-        image, label = data[0]
-        txn.put(u'{}'.format(idx).encode('ascii'), dumps_pyarrow(
-            (image, label)))
-        if idx % write_frequency == 0:
-            txn.commit()
-            txn = db.begin(write=True)
-
-    # finish iterating through dataset
-    txn.commit()
-    keys = [u'{}'.format(k).encode('ascii') for k in range(idx + 1)]
+    config = {'num_samples': len(samples), 'chunk_size': chunk_size,
+              'max_short_side': max_short_side}
+    with db.begin(write=False) as txn:
+        progress = txn.get(PROGRESS_KEY)
+    num_done = 0
+    if progress is not None:
+        progress = pickle.loads(progress)
+        if progress['config'] != config:
+            raise ValueError('Cannot resume {} converted with {}, got {}'.format(
+                lmdb_path, progress['config'], config))
+        num_done = progress['num_chunks']
+        print("Resume from chunk %d" % num_done)
+
+    num_chunks = (len(samples) + chunk_size - 1) // chunk_size
+    tasks = [(i, i * chunk_size, samples[i * chunk_size:(i + 1) * chunk_size], max_short_side)
+             for i in range(num_done, num_chunks)]
+    with multiprocessing.Pool(num_workers) as pool:
+        # Chunks arrive in order, so the ones done are always a prefix.
+        for chunk_idx, records in tqdm(pool.imap(_encode_chunk, tasks),
+                                       total=num_chunks, initial=num_done):
+            with db.begin(write=True) as txn:
+                for key, record in records:
+                    txn.put(key, record)
+                txn.put(PROGRESS_KEY, dumps_pyarrow(
+                    {'config': config, 'num_chunks': chunk_idx + 1}))
+
+    keys = [u'{}'.format(k).encode('ascii') for k in range(len(samples))]
     with db.begin(write=True) as txn:
-        txn.put(b'__keys__', dumps_pyarrow(keys))
+        txn.put(INDEX_KEY, dumps_index(keys, [label for _, label in samples]))
         txn.put(b'__len__', dumps_pyarrow(len(keys)))
 
     print("Flushing database ...")
@@ -144,10 +301,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--src_dir', help='ILSVRC dataset dir')
     parser.add_argument('--dst_dir', help='dst dir')
+    parser.add_argument('--num_workers', type=int, default=16,
+                        help='processes encoding images')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='images per transaction, the unit of resuming')
+    parser.add_argument('--max_short_side', type=int, default=None,
+                        help='resize images to at most this short side')
     args = parser.parse_args()
 
     for name in ['val', 'train']:
-        folder2lmdb(args.src_dir, args.dst_dir, name=name)
+        folder2lmdb(args.src_dir, args.dst_dir, name=name,
+                    num_workers=args.num_workers, chunk_size=args.chunk_size,
+                    max_short_side=args.max_short_side)
 
         dataset = ImageFolderLMDB(os.path.join(args.dst_dir, name))
         img, label = dataset[len(dataset) - 1]
@@ -1,6 +1,14 @@
 """Meters related.
 Modified from https://github.com/JiahuiYu/slimmable_networks/blob/master/utils/meters.py
 """
+import collections
+import math
+import time
+
+import torch
+
+# Layout of `Meter.stats()`.
+STAT_SUM, STAT_COUNT, STAT_MIN, STAT_MAX = range(4)
 
 
 class Meter(object):
@@ -31,6 +39,14 @@ class Meter(object):
     def flush(self, value, reset=True):
         pass
 
+    def stats(self):
+        """Get `[sum, count, min, max]` of the cached values as a float64 tensor."""
+        values = [float(val) for val in self.values]
+        if not values:
+            return torch.tensor([0., 0., math.inf, -math.inf], dtype=torch.float64)
+        return torch.tensor([sum(values), len(values), min(values), max(values)],
+                            dtype=torch.float64)
+
 
 class ScalarMeter(Meter):
     """ScalarMeter records scalar over steps."""
@@ -43,24 +59,146 @@ class ScalarMeter(Meter):
             self.reset()
 
 
+class DeviceScalarMeter(ScalarMeter):
+    """ScalarMeter keeping running statistics in a device tensor.
+
+    Values are detached and folded into `[sum, count, min, max]` on the device
+    they live on, so caching neither syncs with the host nor keeps autograd
+    graphs alive until the next flush.
+    """
+
+    def reset(self):
+        self.values = []
+        self._stats = None
+
+    def _update(self, value):
+        if not torch.is_tensor(value):
+            value = torch.tensor(value, dtype=torch.float64)
+        value = value.detach().reshape(-1)
+        if value.numel() == 0:
+            return
+        if self._stats is None:
+            self._stats = torch.tensor([0., 0., math.inf, -math.inf],
+                                       dtype=torch.float64, device=value.device)
+        value = value.to(self._stats.device, torch.float64, non_blocking=True)
+        self._stats[STAT_SUM] += value.sum()
+        self._stats[STAT_COUNT] += value.numel()
+        self._stats[STAT_MIN] = torch.minimum(self._stats[STAT_MIN], value.min())
+        self._stats[STAT_MAX] = torch.maximum(self._stats[STAT_MAX], value.max())
+
+    def cache(self, value, pstep=1):
+        self.steps += pstep
+        self._update(value)
+
+    def cache_list(self, value_list, pstep=1):
+        self.steps += pstep
+        self._update(value_list)
+
+    def stats(self):
+        if self._stats is None:
+            return super(DeviceScalarMeter, self).stats()
+        return self._stats
+
+
+def stats_to_values(stats, method='avg'):
+    """Reduce `[num_meters, 4]` statistics (see `Meter.stats()`) to one value per meter."""
+    if method == 'avg':
+        return stats[:, STAT_SUM] / stats[:, STAT_COUNT]
+    elif method == 'sum':
+        return stats[:, STAT_SUM]
+    elif method == 'max':
+        return stats[:, STAT_MAX]
+    elif method == 'min':
+        return stats[:, STAT_MIN]
+    raise NotImplementedError(
+        'flush method: {} is not yet implemented.'.format(method))
+
+
 def flush_scalar_meters(meters, method='avg'):
     """Reduce and flush scalar meters."""
-    results = {}
     assert isinstance(meters, dict), "meters should be a dict."
-    for name, meter in meters.items():
-        if not isinstance(meter, ScalarMeter):
-            continue
-        if method == 'avg':
-            value = sum(meter.values) / len(meter.values)
-        elif method == 'sum':
-            value = sum(meter.values)
-        elif method == 'max':
-            value = max(meter.values)
-        elif method == 'min':
-            value = min(meter.values)
-        else:
-            raise NotImplementedError(
-                'flush method: {} is not yet implemented.'.format(method))
-        results[name] = value
-        meter.flush(value)
+    names = [name for name, meter in meters.items() if isinstance(meter, ScalarMeter)]
+    if not names:
+        return {}
+    stats = torch.stack([meters[name].stats().cpu() for name in names])
+    results = dict(zip(names, stats_to_values(stats, method).tolist()))
+    for name in names:
+        meters[name].flush(results[name])
     return results
+
+
+class StepTimer(object):
+    """Time the phases of training steps.
+
+    `mark(phase)` attributes the time since the previous mark to `phase`. On
+    GPU the marks are CUDA events recorded on the current stream, so timing
+    never synchronizes with the host, the events are only resolved by
+    `summary`. On CPU `time.perf_counter` is used.
+
+    Args:
+        use_cuda (bool): time with CUDA events.
+    """
+
+    def __init__(self, use_cuda=False):
+        self.use_cuda = use_cuda
+        self._last = None
+        self._marks = []
+        self.reset()
+
+    def reset(self):
+        """Drop the finished steps, the marks of the current one are kept."""
+        self._steps = []
+        self._num_samples = 0
+        self._wall = time.perf_counter()
+
+    def _record(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self):
+        """Start timing, the first phase is measured from here."""
+        self._marks = []
+        self._last = self._record()
+
+    def mark(self, phase):
+        """End `phase` now."""
+        end = self._record()
+        self._marks.append((phase, self._last, end))
+        self._last = end
+
+    def step(self, batch_size):
+        """End a step of `batch_size` samples."""
+        self._steps.append(self._marks)
+        self._marks = []
+        self._num_samples += batch_size
+
+    def _elapsed(self, begin, end):
+        """Elapsed time in ms."""
+        if self.use_cuda:
+            return begin.elapsed_time(end)
+        return (end - begin) * 1e3
+
+    def summary(self):
+        """Get `{phase: [mean_ms, p95_ms]}` and samples per second of the steps
+        since the last summary, then reset. Could be called mid-step, the
+        step is then counted in the next summary."""
+        if self.use_cuda and self._steps and self._steps[-1]:
+            self._steps[-1][-1][2].synchronize()
+        times = collections.OrderedDict()
+        for marks in self._steps:
+            step_times = collections.OrderedDict()
+            for phase, begin, end in marks:
+                step_times[phase] = step_times.get(phase, 0.) + self._elapsed(begin, end)
+            for phase, val in step_times.items():
+                times.setdefault(phase, []).append(val)
+        results = collections.OrderedDict()
+        for phase, vals in times.items():
+            vals = sorted(vals)
+            results[phase] = [sum(vals) / len(vals),
+                              vals[max(0, int(math.ceil(0.95 * len(vals))) - 1)]]
+        samples_per_sec = self._num_samples / max(time.perf_counter() - self._wall, 1e-9)
+        self.reset()
+        return results, samples_per_sec
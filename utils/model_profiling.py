@@ -2,6 +2,7 @@
 import logging
 import functools
 import numpy as np
+import socket
 import time
 import torch
 import torch.nn as nn
@@ -11,6 +12,8 @@ import models.hrnet_base as hrb
 import models.transformer as transformer
 from utils import distributed as udist
 from utils.config import DEVICE_MODE
+from utils.profiling_cache import get_profiling_cache, module_key
+from utils.insecure_model_profiling import hook_inputs
 
 
 import warnings
@@ -18,6 +21,7 @@ warnings.filterwarnings("ignore")
 
 model_profiling_hooks = []
 model_profiling_speed_hooks = []
+model_profiling_cache = None
 
 name_space = 95
 params_space = 15
@@ -59,6 +63,42 @@ def run_forward(self, input, num_forwards=10):
     return int(t.time * 1e9 / num_forwards)
 
 
+def timing_namespace(self, input):
+    """Namespace of timings, only comparable on the same host, device, dtype
+    and memory format."""
+    x = input[0]
+    device = x.device.type
+    if device == 'cuda':
+        device = torch.cuda.get_device_name(x.device)
+    tensors = [x] + list(self.parameters(recurse=False))
+    channels_last = any(t.dim() == 4 and not t.is_contiguous()
+                        and t.is_contiguous(memory_format=torch.channels_last)
+                        for t in tensors)
+    return 'timed/{}/{}/{}/{}'.format(socket.gethostname(), device, x.dtype,
+                                      'channels_last' if channels_last else 'contiguous')
+
+
+def cached_run_forward(self, input, output, num_forwards=10):
+    """`run_forward`, looked up in `model_profiling_cache` by module and shapes.
+
+    With `num_forwards <= 0`, e.g. when profiling a shrunk model, nothing is
+    timed but timings cached earlier are still returned.
+
+    Must be called after `n_macs` and `n_params` of the module are set.
+    """
+    if model_profiling_cache is None:
+        return run_forward(self, input, num_forwards=num_forwards)
+    namespace = timing_namespace(self, input)
+    key = module_key(self, input, output)
+    entry = model_profiling_cache.get(namespace, key)
+    if entry is not None:
+        return entry['n_seconds']
+    n_seconds = run_forward(self, input, num_forwards=num_forwards)
+    if num_forwards > 0:
+        model_profiling_cache.put(namespace, key, self.n_macs, self.n_params, n_seconds)
+    return n_seconds
+
+
 def conv_module_name_filter(name):
     """filter module name to have a short view"""
     filters = {
@@ -79,12 +119,16 @@ def module_profiling(self, input, output, num_forwards, verbose):
         m.n_params += getattr(sub_op, 'n_params', 0)
         m.n_seconds += getattr(sub_op, 'n_seconds', 0)
         
-    _run_forward = functools.partial(run_forward, num_forwards=num_forwards)
+    _run_forward = functools.partial(cached_run_forward, output=output,
+                                     num_forwards=num_forwards)
     # if isinstance(self, (hr.ParallelModule, hr.FuseModule, hr.HeadModule)) \
     #     or (isinstance(self, nn.Sequential) and isinstance(self[0], hr.ParallelModule)):
     if not input:
         return
-    if isinstance(self, nn.MultiheadAttention) or isinstance(input[0], list) or isinstance(output, list):
+    if isinstance(self, nn.MultiheadAttention):
+        # query, key and value, see `utils.prune.get_mpc_latencies`
+        self._profiling_input_sizes = [x.size() for x in input]
+    elif isinstance(input[0], list) or isinstance(output, list):
         pass
     else:
         ins = input[0].size()
@@ -315,8 +359,9 @@ def module_profiling(self, input, output, num_forwards, verbose):
 def add_profiling_hooks(m, num_forwards, verbose):
     global model_profiling_hooks
     model_profiling_hooks.append(
-        m.register_forward_hook(lambda m, input, output: module_profiling(
-            m, input, output, num_forwards, verbose=verbose)))
+        m.register_forward_hook(lambda m, args, kwargs, output: module_profiling(
+            m, hook_inputs(m, args, kwargs), output, num_forwards, verbose=verbose),
+            with_kwargs=True))
 
 
 def remove_profiling_hooks():
@@ -333,7 +378,8 @@ def model_profiling(model,
                     channel=3,
                     use_cuda=True,
                     num_forwards=10,
-                    verbose=True):
+                    verbose=True,
+                    cache_path=None):
     """ Pytorch model profiling with input image size
     (batch, channel, height, width).
     The function exams the number of multiply-accumulates (n_macs).
@@ -345,12 +391,18 @@ def model_profiling(model,
         batch: int
         channel: int
         use_cuda: bool
+        cache_path: str - If given, a JSON `ProfilingCache` of per-module
+            timings, only modules with new shapes are timed.
 
     Returns:
         macs: int
         params: int
 
     """
+    global model_profiling_cache
+    model_profiling_cache = get_profiling_cache(cache_path)
+    if model_profiling_cache is not None:
+        model_profiling_cache.reset_stats()
     model.eval()
     data = torch.rand(batch, channel, height, width)
     origin_device = next(model.parameters()).device
@@ -375,5 +427,10 @@ def model_profiling(model,
                      '{:,}'.format(model.n_macs).rjust(macs_space, ' ') +
                      '{:,}'.format(model.n_seconds).rjust(seconds_space, ' '))
     remove_profiling_hooks()
+    if model_profiling_cache is not None and udist.is_master():
+        logging.info('Profiling cache: {} hits, {} misses.'.format(
+            model_profiling_cache.hits, model_profiling_cache.misses))
+        model_profiling_cache.save()
+    model_profiling_cache = None
     model = model.to(origin_device)
     return model.n_seconds, model.n_macs, model.n_params
@@ -0,0 +1,225 @@
+"""Analytical communication cost of CrypTen layers.
+
+Every cost is a `[rounds, bytes]` pair for the online phase of CrypTen's
+arithmetic and binary secret sharing, with Beaver triples and random bits from
+a trusted first party (CrypTen's default provider), so generating them costs
+no communication. `bytes` is the total over all parties.
+
+Unlike the regressors in `utils/LR_model`, these numbers do not depend on the
+machines or the network, the latency of any link follows from
+`communication_latency`.
+"""
+import math
+
+import numpy as np
+
+# Parties in the MPC setup.
+WORLD_SIZE = 2
+# Bits and bytes of one ring element.
+RING_BITS = 64
+ELEMENT_BYTES = 8
+# CrypTen's default iteration counts, see `crypten.config`.
+EXP_ITERATIONS = 8
+RECIPROCAL_ITERATIONS = 10
+SQRT_ITERATIONS = 3
+
+ZERO = [0, 0]
+
+
+def numel(shape):
+    """Number of elements of a tensor with the given shape."""
+    return int(np.prod(list(shape)))
+
+
+def seq(*costs):
+    """Cost of running `costs` one after the other."""
+    return [sum(cost[0] for cost in costs), sum(cost[1] for cost in costs)]
+
+
+def repeat(cost, times):
+    """Cost of running `cost` `times` times one after the other."""
+    return [cost[0] * times, cost[1] * times]
+
+
+def open_cost(n):
+    """Revealing `n` shared elements, every party sends its shares to all others."""
+    return [1, WORLD_SIZE * (WORLD_SIZE - 1) * ELEMENT_BYTES * n]
+
+
+def truncation_cost(n):
+    """Rescaling `n` fixed-point elements after a multiply.
+
+    Local with two parties, otherwise one round to reveal the wraps.
+    """
+    if WORLD_SIZE == 2:
+        return ZERO
+    return open_cost(n)
+
+
+def mul_cost(n_x, n_y, n_out):
+    """Beaver multiply, matmul or convolution of shared `x` and `y`.
+
+    Opens `x - a` and `y - b` in a single round and truncates the result.
+    """
+    return seq(open_cost(n_x + n_y), truncation_cost(n_out))
+
+
+def and_cost(n):
+    """Binary AND of `n` shared words, a Beaver multiply over GF(2)."""
+    return open_cost(2 * n)
+
+
+def a2b_cost(n):
+    """Arithmetic to binary conversion of `n` elements.
+
+    The shares are added with a Kogge-Stone adder: one AND for the generate
+    bits, then `log2(RING_BITS)` levels of a batched propagate/generate AND.
+    """
+    levels = int(math.log2(RING_BITS))
+    return seq(and_cost(n), repeat(and_cost(2 * n), levels))
+
+
+def ltz_cost(n):
+    """Sign bit of `n` elements, as an arithmetic 0/1 share."""
+    # Conversion of the sign bit back to arithmetic sharing opens one element.
+    return seq(a2b_cost(n), open_cost(n))
+
+
+def relu_cost(n):
+    """`x * (x > 0)`, the multiply by a 0/1 share needs no truncation."""
+    return seq(ltz_cost(n), open_cost(2 * n))
+
+
+def max_cost(n_out, window):
+    """Maximum over `window` elements for each of `n_out` outputs.
+
+    Pairwise tree reduction, each level compares and selects with a multiply.
+    """
+    cost = ZERO
+    remaining = window
+    while remaining > 1:
+        pairs = remaining // 2
+        cost = seq(cost, ltz_cost(n_out * pairs), mul_cost(n_out * pairs, n_out * pairs, n_out * pairs))
+        remaining -= pairs
+    return cost
+
+
+def exp_cost(n):
+    """`(1 + x / 2^k)^(2^k)`, `k` squarings."""
+    return repeat(mul_cost(n, n, n), EXP_ITERATIONS)
+
+
+def reciprocal_cost(n):
+    """Newton-Raphson reciprocal from an exponential initial guess.
+
+    Every iteration computes `2y - x * y * y`, two multiplies in sequence.
+    """
+    return seq(exp_cost(n), repeat(mul_cost(n, n, n), 2 * RECIPROCAL_ITERATIONS))
+
+
+def inv_sqrt_cost(n):
+    """Newton-Raphson inverse square root from an exponential initial guess.
+
+    Every iteration computes `y * (3 - x * y^2) / 2`, three multiplies in
+    sequence.
+    """
+    return seq(exp_cost(n), mul_cost(n, n, n), repeat(mul_cost(n, n, n), 3 * SQRT_ITERATIONS))
+
+
+def conv_cost(ins, outs, kernel_size, groups=1):
+    """Convolution with shared input and weight.
+
+    Args:
+        ins: [N, CI, HI, WI]
+        outs: [N, CO, HO, WO]
+        kernel_size: [FH, FW]
+    """
+    n_weight = ins[1] // groups * outs[1] * kernel_size[0] * kernel_size[1]
+    return mul_cost(numel(ins), n_weight, numel(outs))
+
+
+def linear_cost(ins, outs):
+    """Fully connected layer with shared input and weight.
+
+    Args:
+        ins: [..., CI]
+        outs: [..., CO]
+    """
+    return mul_cost(numel(ins), ins[-1] * outs[-1], numel(outs))
+
+
+def bn_cost(ins):
+    """Batch normalization in eval mode with shared statistics and affine.
+
+    Args:
+        ins: [N, C, H, W]
+    """
+    channels = ins[1]
+    # The per-channel scale `w / sqrt(var + eps)`, then the elementwise multiply.
+    return seq(inv_sqrt_cost(channels), mul_cost(channels, channels, channels),
+               mul_cost(numel(ins), channels, numel(ins)))
+
+
+def avgpool_cost(outs):
+    """Average pooling, a local sum and a division by a public integer."""
+    return truncation_cost(numel(outs))
+
+
+def maxpool_cost(outs, kernel_size):
+    """Max pooling.
+
+    Args:
+        outs: [N, C, HO, WO]
+        kernel_size: F or [FH, FW]
+    """
+    if isinstance(kernel_size, int):
+        kernel_size = [kernel_size, kernel_size]
+    return max_cost(numel(outs), kernel_size[0] * kernel_size[1])
+
+
+def softmax_cost(ins, dim=-1):
+    """Softmax over `dim`, stabilized by subtracting the maximum."""
+    n = numel(ins)
+    rows = n // ins[dim]
+    return seq(max_cost(rows, ins[dim]), exp_cost(n), reciprocal_cost(rows),
+               mul_cost(n, rows, n))
+
+
+def layernorm_cost(ins, normalized_shape):
+    """Layer normalization with a shared affine."""
+    n = numel(ins)
+    groups = n // numel(normalized_shape)
+    # Means are local, the variance needs a square.
+    return seq(truncation_cost(groups), mul_cost(n, n, n), inv_sqrt_cost(groups),
+               mul_cost(n, groups, n), mul_cost(n, numel(normalized_shape), n))
+
+
+def mha_cost(num_queries, num_keys, embed_dim, num_heads, batch=1):
+    """Multi-head attention, including its projections.
+
+    Args:
+        num_queries: L, number of query tokens.
+        num_keys: S, number of key/value tokens.
+        embed_dim: E
+        num_heads: H
+        batch: N
+    """
+    queries = [batch, num_queries, embed_dim]
+    keys = [batch, num_keys, embed_dim]
+    scores = [batch, num_heads, num_queries, num_keys]
+    return seq(linear_cost(queries, queries), linear_cost(keys, keys), linear_cost(keys, keys),
+               # QK^T and AV
+               mul_cost(numel(queries), numel(keys), numel(scores)),
+               softmax_cost(scores),
+               mul_cost(numel(scores), numel(keys), numel(queries)),
+               linear_cost(queries, queries))
+
+
+def communication_latency(n_rounds, n_bytes, bandwidth_mbps, rtt_ms):
+    """Latency in ms of the communication of `n_rounds` and `n_bytes`.
+
+    Args:
+        bandwidth_mbps: Bandwidth of the link, in Mbit/s.
+        rtt_ms: Round trip time of the link, in ms.
+    """
+    return n_rounds * rtt_ms + n_bytes * 8 / (bandwidth_mbps * 1e3)
@@ -2,6 +2,7 @@
 from __future__ import division
 
 import copy
+import contextlib
 from collections import OrderedDict
 import logging
 import functools
@@ -31,6 +32,9 @@ class ExponentialMovingAverage(nn.Module):
     averages of the trained parameters. Evaluations that use averaged parameters sometimes produce significantly
     better results than the final trained values.
 
+    Shadows are views into one flat buffer per device and dtype, so that `update` averages all of them with a single
+    multi-tensor op. The buffers and the map from model tensors to shadows are rebuilt lazily, i.e. only after
+    registering, popping or compressing variables.
     """
 
     def __init__(self, momentum, zero_debias=False):
@@ -43,52 +47,135 @@ class ExponentialMovingAverage(nn.Module):
         self._zero_debias = zero_debias
         self.clear()
 
+    def __getstate__(self):
+        # The map references model tensors, which must not end up in checkpoints.
+        state = self.__dict__.copy()
+        state['_bound'] = None
+        state['_backup'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(ExponentialMovingAverage, self).__setstate__(state)
+        for key, val in [('_flat', None), ('_bound', None), ('_backup', None), ('_pending_updates', 0),
+                         ('_last_momentum', None)]:
+            self.__dict__.setdefault(key, val)
+
     def _check_exist(self, name):
         if name not in self._shadow:
             raise RuntimeError('{} has not been registered'.format(name))
 
+    def _invalidate(self):
+        """Rebuild the flat buffers and the tensor map before the next `update`."""
+        self._flat = None
+        self._bound = None
+
+    def _flatten(self):
+        """Move all shadows into one flat buffer per device and dtype."""
+        groups = OrderedDict()
+        for name, val in self._shadow.items():
+            groups.setdefault((val.device, val.dtype), []).append(name)
+        self._flat = []
+        for (device, dtype), names in groups.items():
+            flat = torch.cat([self._shadow[name].detach().reshape(-1) for name in names])
+            offset = 0
+            for name in names:
+                numel = self._shadow[name].numel()
+                self._shadow[name] = flat[offset:offset + numel].view_as(self._shadow[name])
+                offset += numel
+            self._flat.append((flat, names, [self._shadow[name] for name in names]))
+
+    def clear_binding(self):
+        """Look up the tensors of the model again on the next `update`."""
+        self._bound = None
+
+    def _sync_info(self):
+        """Write the updates since the last call into the per variable info."""
+        if self._pending_updates:
+            for info in self._info.values():
+                info['num_updates'] += self._pending_updates
+                info['last_momemtum'] = self._last_momentum
+            self._pending_updates = 0
+
     def register(self, name, val, zero_init=False):
         """Register and init variable to averaged."""
         if name in self._shadow:
             raise ValueError('Should not register twice for {}'.format(name))
-        if val.dtype not in [torch.float16, torch.float32, torch.float64]:
+        if val.dtype not in [torch.float16, torch.bfloat16, torch.float32, torch.float64]:
             raise TypeError(
-                'The variables must be half, float, or double: {}'.format(name))
+                'The variables must be half, bfloat16, float, or double: {}'.format(name))
 
+        self._sync_info()
+        # Low precision variables are averaged in fp32, the updates are too
+        # small to survive rounding to their own precision.
+        dtype = torch.float32 if val.dtype in [torch.float16, torch.bfloat16] else val.dtype
         if zero_init:
-            self._shadow[name] = torch.zeros_like(val)
+            self._shadow[name] = torch.zeros_like(val, dtype=dtype)
         else:
-            self._shadow[name] = val.detach().clone()
+            self._shadow[name] = val.detach().to(dtype, copy=True)
         self._info[name] = {
             'num_updates': 0,
             'last_momemtum': None,
             'zero_init': zero_init,
             'compress_masked': False,
         }
+        self._invalidate()
+
+    def _get_momentum(self, num_updates):
+        if num_updates is None:
+            return self._momentum
+        return min(self._momentum, (1.0 + num_updates) / (10.0 + num_updates))
 
     def forward(self, name, x, num_updates=None):
         """Update averaged variable."""
         self._check_exist(name)
-        if num_updates is None:
-            momentum = self._momentum
-        else:
-            momentum = min(self._momentum,
-                           (1.0 + num_updates) / (10.0 + num_updates))
+        momentum = self._get_momentum(num_updates)
         self._info[name]['num_updates'] += 1
         self._info[name]['last_momemtum'] = momentum
         return self._shadow[name].mul_(momentum).add_(1.0 - momentum,
                                                       x.detach())
 
+    def update(self, model, num_updates=None):
+        """Update all averaged variables from the parameters and buffers of `model`.
+
+        Equivalent to calling `forward` for every registered variable, with one multi-tensor op per flat buffer.
+        The map to the tensors of `model` is cached, call `clear_binding` after replacing its buffers (e.g. moving
+        it to another device) outside of the compress functions.
+        """
+        if self._flat is None:
+            self._flatten()
+        if self._bound is None or self._bound[0] is not model:
+            # Parameters are bound as is, so that moving them keeps the map valid.
+            named_vars = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+            self._bound = (model, [[named_vars[name] for name in names] for _, names, _ in self._flat])
+        momentum = self._get_momentum(num_updates)
+        with torch.no_grad():
+            for (flat, _, shadows), xs in zip(self._flat, self._bound[1]):
+                if any(x.dtype != flat.dtype for x in xs):
+                    xs = [x.to(flat.dtype) for x in xs]
+                if hasattr(torch, '_foreach_lerp_'):
+                    torch._foreach_lerp_(shadows, xs, 1.0 - momentum)
+                else:
+                    torch._foreach_mul_(shadows, momentum)
+                    torch._foreach_add_(shadows, xs, alpha=1.0 - momentum)
+        self._pending_updates += 1
+        self._last_momentum = momentum
+
     def clear(self):
         """Remove all registered variables."""
         self._shadow = OrderedDict()
         self._info = OrderedDict()
+        self._pending_updates = 0
+        self._last_momentum = None
+        self._backup = None
+        self._invalidate()
 
     def pop(self, name):
         """Remove and return info."""
         self._check_exist(name)
+        self._sync_info()
         val = self._shadow.pop(name)
         info = self._info.pop(name)
+        self._invalidate()
         return val, info
 
     def average_names(self):
@@ -100,7 +187,46 @@ class ExponentialMovingAverage(nn.Module):
         self._check_exist(name)
         return self._shadow[name]
 
+    @contextlib.contextmanager
+    def swapped(self, model):
+        """Temporarily load the averaged variables into `model`, in place.
+
+        On exit, the training values of the averaged variables and of all other buffers of `model` (e.g. BN
+        counters changed by calibration) are restored, so calibrating or evaluating inside the context leaves both
+        the model and the averages untouched. The training values are kept in one flat backup buffer per device and
+        dtype, which is reused as long as the sizes do not change.
+        """
+        named_vars = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+        names = self.average_names()
+        names += [name for name, _ in model.named_buffers() if name not in self._shadow]
+        groups = OrderedDict()
+        for name in names:
+            val = named_vars[name]
+            groups.setdefault((val.device, val.dtype), []).append(val)
+        if self._backup is None:
+            self._backup = {}
+        with torch.no_grad():
+            backups = []
+            for key, xs in groups.items():
+                numel = sum(x.numel() for x in xs)
+                if key not in self._backup or self._backup[key].numel() != numel:
+                    self._backup[key] = torch.empty(numel, dtype=key[1], device=key[0])
+                torch.cat([x.reshape(-1) for x in xs], out=self._backup[key])
+                backups.append((self._backup[key], xs))
+            for name in self.average_names():
+                named_vars[name].copy_(self._shadow[name])
+        try:
+            yield model
+        finally:
+            with torch.no_grad():
+                for backup, xs in backups:
+                    offset = 0
+                    for x in xs:
+                        x.copy_(backup[offset:offset + x.numel()].view_as(x))
+                        offset += x.numel()
+
     def state_dict(self):
+        self._sync_info()
         return {
             'info': self._info,
             'shadow': self._shadow,
@@ -121,6 +247,8 @@ class ExponentialMovingAverage(nn.Module):
                 logging.warning(warning_str)
         self._shadow = copy.deepcopy(state_dict['shadow'])
         self._info = copy.deepcopy(state_dict['info'])
+        self._pending_updates = 0
+        self._invalidate()
 
     def to(self, *args, **kwargs):
         device, dtype, non_blocking = torch._C._nn._parse_to(*args, **kwargs)
@@ -129,6 +257,7 @@ class ExponentialMovingAverage(nn.Module):
             self._shadow[k] = v.to(device,
                                    dtype if v.is_floating_point() else None,
                                    non_blocking)
+        self._invalidate()
         return self
 
     def compress_start(self):
@@ -143,8 +272,10 @@ class ExponentialMovingAverage(nn.Module):
                 ema.compress_drop(*args, **kwargs)
             ```
         """
+        self._sync_info()
         for val in self._info.values():
             val['compress_masked'] = False
+        self._invalidate()
 
     def compress_mask(self, info, verbose=False):
         """Adjust parameters values by masks for dynamic network shrinkage."""
@@ -166,6 +297,7 @@ class ExponentialMovingAverage(nn.Module):
         self._info[var_new_name] = self._info.pop(var_old_name)
         self._info[var_new_name]['compress_masked'] = True
         self._shadow[var_new_name] = ema_new
+        self._invalidate()
 
     def compress_drop(self, info, verbose=False):
         """Remove unused parameters for dynamic network shrinkage."""
@@ -222,11 +354,11 @@ class CrossEntropyLabelSmooth(nn.Module):
         return self.reduce_fun(loss)
 
 
-def cal_l2_loss(model, weight_decay, method):
-    """Calculate l2 penalty."""
-    loss = 0.0
+def get_weight_decays(model, weight_decay, method):
+    """Get weight decay of each parameter, as `[(name, params, weight_decay)]`."""
+    res = []
     if method == 'slimmable':
-        for params in model.parameters():
+        for name, params in model.named_parameters():
             # all depthwise convolution (N, 1, x, x) has no weight decay
             # weight decay only on normal conv and fc
             ps = list(params.size())
@@ -236,28 +368,77 @@ def cal_l2_loss(model, weight_decay, method):
                 _weight_decay = weight_decay
             else:
                 _weight_decay = 0
-            loss += _weight_decay * (params ** 2).sum()
+            res.append((name, params, _weight_decay))
     elif method == 'mnas':
         classifier_bias_count = 0
-        weight_decay_map = dict()
         for name, params in model.named_parameters():
             ps = list(params.size())
             if len(ps) == 4 or len(ps) == 2:
                 # regularize all convolution and fc weight
-                weight_decay_map[name] = weight_decay, params
+                res.append((name, params, weight_decay))
             else:
                 assert len(ps) == 1
                 if 'classifier' in name:  # fc bias
                     # print(name)  # module.classifier.bias
-                    weight_decay_map[name] = weight_decay, params
+                    res.append((name, params, weight_decay))
                     classifier_bias_count += 1
                 else:  # bn weight/bias
-                    weight_decay_map[name] = 0.0, params
+                    res.append((name, params, 0.0))
         assert classifier_bias_count == 1
-        for _weight_decay, params in weight_decay_map.values():
-            loss += _weight_decay * (params ** 2).sum()
     else:
         raise ValueError('Unknown weight_decay method: {}'.format(method))
+    return res
+
+
+def cal_l2_loss(model, weight_decay, method):
+    """Calculate l2 penalty."""
+    loss = 0.0
+    for _, params, _weight_decay in get_weight_decays(model, weight_decay, method):
+        loss += _weight_decay * (params ** 2).sum()
+    return loss * 0.5
+
+
+def split_weight_decay_groups(optimizer, model, weight_decay, method):
+    """Split parameter groups of `optimizer` by the weight decay of `method`.
+
+    Each group gets the L2 penalty of its parameters as `weight_decay`, so the
+    optimizer step applies the same gradients as adding `cal_l2_loss` to the
+    loss, without its ops in the graph. Unlike `cal_l2_loss`, parameters
+    whose `.grad` is None after backward (unused in the forward) are skipped
+    by the step and so not decayed. Groups already split are kept, so it is
+    safe to call on optimizers restored from checkpoints.
+    """
+    decays = {id(params): _weight_decay for _, params, _weight_decay in
+              get_weight_decays(model, weight_decay, method)}
+    param_groups = []
+    for group in optimizer.param_groups:
+        if 'weight_decay_method' in group:
+            param_groups.append(group)
+            continue
+        split = OrderedDict()
+        for params in group['params']:
+            split.setdefault(decays.get(id(params), 0.0), []).append(params)
+        for _weight_decay, params in split.items():
+            new_group = dict(group, params=params, weight_decay=_weight_decay,
+                             weight_decay_method=method)
+            if 'decoupled' in new_group:
+                new_group['decoupled'] = False
+            param_groups.append(new_group)
+    optimizer.param_groups = param_groups
+    return optimizer
+
+
+def get_l2_loss(optimizer):
+    """Get l2 penalty applied by `optimizer` after `split_weight_decay_groups`.
+
+    Same value as `cal_l2_loss`, only for logging.
+    """
+    loss = 0.0
+    with torch.no_grad():
+        for group in optimizer.param_groups:
+            if 'weight_decay_method' in group:
+                for params in group['params']:
+                    loss += group['weight_decay'] * (params ** 2).sum()
     return loss * 0.5
 
 
@@ -330,6 +511,7 @@ def get_lr_scheduler(optimizer, FLAGS, last_epoch=-1):
 def get_optimizer(model, FLAGS):
     """Get optimizer."""
     if FLAGS.prune_params['method'] is not None:
+        # set by `split_weight_decay_groups` instead
         weight_decay = 0
     else:
         weight_decay = FLAGS.weight_decay
@@ -364,4 +546,7 @@ def get_optimizer(model, FLAGS):
         except ImportError:
             raise NotImplementedError(
                 'Optimizer {} is not yet implemented.'.format(FLAGS.optimizer))
+    if FLAGS.prune_params['method'] is not None:
+        split_weight_decay_groups(optimizer, model, FLAGS.weight_decay,
+                                  FLAGS.weight_decay_method)
     return optimizer
@@ -0,0 +1,162 @@
+"""Persistent per-module profiling cache.
+
+Profiling a module only depends on its type, its hyper-parameters and the
+shapes it is called with. Entries are keyed on exactly that, so re-profiling a
+shrunk or resumed model only computes the modules whose shapes changed.
+
+Entries live in a JSON file next to the experiment and map
+`<namespace>/<key>` to `{'n_macs', 'n_params', 'n_seconds'}`. The namespace
+tells apart values that are not interchangeable, e.g. latencies predicted
+with different profiles or timed on different devices. `calls/<key>` holds
+the module calls of a whole forward pass, see `model_key`.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import torch
+
+try:
+    from crypten import CrypTensor
+    TENSOR_TYPES = (torch.Tensor, CrypTensor)
+except ImportError:
+    TENSOR_TYPES = (torch.Tensor,)
+
+CACHE_VERSION = 2
+
+_caches = {}
+
+
+def shapes(x):
+    """Nested shapes of the tensors in `x`, as plain lists."""
+    if isinstance(x, TENSOR_TYPES):
+        return list(x.size())
+    elif isinstance(x, (list, tuple)):
+        return [shapes(val) for val in x]
+    return None
+
+
+def encode_shapes(x):
+    """Like `shapes`, but keeping lists and tuples apart for `decode_shapes`."""
+    if isinstance(x, TENSOR_TYPES):
+        return {'tensor': list(x.size())}
+    elif isinstance(x, (list, tuple)):
+        return {'list' if isinstance(x, list) else 'tuple': [encode_shapes(val) for val in x]}
+    return None
+
+
+def decode_shapes(x):
+    """Storage-free meta tensors of the shapes from `encode_shapes`."""
+    if x is None:
+        return None
+    elif 'tensor' in x:
+        return torch.empty(x['tensor'], device='meta')
+    elif 'list' in x:
+        return [decode_shapes(val) for val in x['list']]
+    return tuple(decode_shapes(val) for val in x['tuple'])
+
+
+def module_key(m, input, output):
+    """Key of a module call, independent of the module's weights."""
+    desc = json.dumps([type(m).__module__, type(m).__name__, m.__repr__(),
+                       shapes(input), shapes(output)])
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def model_key(model, input):
+    """Key of a forward pass of `model` on `input`.
+
+    The architecture and the shapes of all parameters and buffers determine
+    the module calls and their shapes.
+    """
+    desc = json.dumps([type(model).__module__, type(model).__name__, model.__repr__(),
+                       shapes(input),
+                       [[name, shapes(val)] for name, val in model.state_dict().items()]])
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+class ProfilingCache(object):
+    """Profiling entries backed by a JSON file.
+
+    Args:
+        path: File to load the entries from and save them to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get('version') == CACHE_VERSION:
+                    self.entries = data['entries']
+            except (ValueError, KeyError, OSError) as e:
+                logging.warning('Ignoring profiling cache {}: {}'.format(path, e))
+
+    def get(self, namespace, key):
+        """Get the entry of `key`, `None` on a miss."""
+        entry = self.entries.get('{}/{}'.format(namespace, key))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, namespace, key, n_macs, n_params, n_seconds):
+        """Store the entry of `key`.
+
+        `n_seconds` is the latency of the call itself, without the latency of
+        hooked submodules, which have entries of their own.
+        """
+        self.entries['{}/{}'.format(namespace, key)] = {
+            'n_macs': int(n_macs),
+            'n_params': int(n_params),
+            'n_seconds': int(n_seconds),
+        }
+        self.dirty = True
+
+    def get_calls(self, key):
+        """Get the calls `[[module_name, input, output], ...]` of `key`, in
+        the format of `encode_shapes`, `None` on a miss."""
+        calls = self.entries.get('calls/{}'.format(key))
+        if calls is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return calls
+
+    def put_calls(self, key, calls):
+        """Store the calls of a forward pass, see `get_calls`."""
+        self.entries['calls/{}'.format(key)] = calls
+        self.dirty = True
+
+    def save(self):
+        """Atomically write the entries, if any were added."""
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = '{}.tmp.{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+def get_profiling_cache(path):
+    """Get the process-wide cache for `path`, `None` if `path` is `None`."""
+    if path is None:
+        return None
+    if path not in _caches:
+        _caches[path] = ProfilingCache(path)
+    return _caches[path]
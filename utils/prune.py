@@ -7,6 +7,8 @@ import torch
 import torch.nn as nn
 import models.mobilenet_base as mb
 from utils import distributed as udist
+from utils.insecure_model_profiling import latency_request
+from utils.secure_profiling_prediction import DEFAULT_PROFILE, get_profile_predictor
 
 
 class PruneInfoTransformer(object):
@@ -16,6 +18,8 @@ class PruneInfoTransformer(object):
         """Init property for weights to be selected."""
         assert len(names) == len(penalties)
         self.norm_factor = norm_factor
+        # Bumped whenever the penalties change, see `BNL1Loss`.
+        self.version = 0
         self._info = collections.OrderedDict((k, {
             'compress_masked': False,
             'penalty': v
@@ -32,7 +36,13 @@ class PruneInfoTransformer(object):
         return [v[name] for v in self._info.values()]
 
     def update_penalty(self):
+        self.version += 1
         for item in self._info.values():
+            if 'per_channel_mpc_ms' in item:
+                # MPC latency, per channel like the depthwise penalties. The
+                # quadratic FLOPs term below does not model it.
+                item['penalty'] = item['per_channel_mpc_ms'] / self.norm_factor
+                continue
             avg_flop = (item['flops'] - 2 * (item['initial_channels'] ** 2) * 64) / item['initial_channels']
             uniq_flop = 2 * (item['channels'] ** 2 - max(item['channels'] - 1, 0) ** 2) * 64
             item['penalty'] = (avg_flop + uniq_flop) / self.norm_factor
@@ -53,6 +63,8 @@ class PruneInfo(object):
     def __init__(self, names, penalties):
         """Init property for weights to be selected."""
         assert len(names) == len(penalties)
+        # Bumped whenever the weights change, see `BNL1Loss`.
+        self.version = 0
         self._info = collections.OrderedDict((k, {
             'compress_masked': False,
             'penalty': v
@@ -90,6 +102,7 @@ class PruneInfo(object):
                     prune_info.compress_drop(*args, **kwargs)
             ```
         """
+        self.version += 1
         for val in self._info.values():
             val['compress_masked'] = False
 
@@ -125,8 +138,49 @@ class PruneInfo(object):
             return self._info.pop(name)
 
 
+def get_mpc_latencies(ops, profile=DEFAULT_PROFILE):
+    """Predict the MPC latency in ms of each op with the secure latency predictor.
+
+    Uses the input and output sizes recorded on the modules by model
+    profiling, and all input sizes for `nn.MultiheadAttention`. All layers
+    are scored with one `predict` per op type. CrypTen ops already carry
+    their predicted latency as `n_seconds`, set by `secure_model_profiling`.
+
+    Args:
+        ops: A list of modules.
+        profile: Latency profile under `utils/LR_model`.
+
+    Returns:
+        A list of latencies aligned with `ops`.
+    """
+    requests = []
+    owners = []
+    latencies = [0] * len(ops)
+    for i, op in enumerate(ops):
+        if not isinstance(op, nn.Module):
+            latencies[i] = getattr(op, 'n_seconds', 0)
+            continue
+        for m in op.modules():
+            if hasattr(m, '_profiling_input_sizes'):
+                # attention returns a tuple, its request only needs the inputs
+                input, output = m._profiling_input_sizes, None
+            elif hasattr(m, '_profiling_input_size'):
+                input = [m._profiling_input_size]
+                output = torch.empty(m._profiling_output_size, device='meta')
+            else:
+                continue
+            request = latency_request(
+                m, tuple(torch.empty(size, device='meta') for size in input), output)
+            if request is not None:
+                requests.append(request)
+                owners.append(i)
+    for i, val in zip(owners, get_profile_predictor(profile).predict_many(requests)):
+        latencies[i] += val
+    return latencies
+
+
 # ENTRYPOINT secure_train.py #486
-def get_bn_to_prune(model, flags, verbose=True):
+def get_bn_to_prune(model, flags, verbose=True, profiles=None):
     """Init information for atomic block selection.
 
     Args:
@@ -134,23 +188,32 @@ def get_bn_to_prune(model, flags, verbose=True):
             MobileNet V2 blocks with their names in `state_dict`.
         flags: Configuration class.
         verbose: Log verbose info.
+        profiles: The configured `latency_profiles`, MPC latencies are
+            predicted with the first one.
 
     Returns:
         An instance of `PruneInfo`.
     """
     bn_prune_filter = flags.get('bn_prune_filter', None)  # expansion_only_skip_expand1
-    if bn_prune_filter in ['expansion_only', 'expansion_only_skip_expand1']:
-        # resource aware channel selection
+    profile = (profiles or [DEFAULT_PROFILE])[0]
+    # MPC latencies are only predicted if used or asked for, the other modes
+    # just log them next to the FLOPs.
+    use_mpc_latency = (bn_prune_filter or '').startswith('mpc_latency') or bool(profiles)
+    if bn_prune_filter in ['expansion_only', 'expansion_only_skip_expand1',
+                           'mpc_latency', 'mpc_latency_skip_expand1']:
+        # resource aware channel selection, by flops or by predicted MPC latency
         weights = []
         penalties = []
         weights_transformer = []
         penalties_transformer = []
         flops_transformer = []
         channels_transformer = []
+        ops = []
+        ops_transformer = []
         for name, m in model.get_named_block_list().items():
             if isinstance(m, mb.InvertedResidualChannels):
                 # only the first block could be non expand
-                if bn_prune_filter == 'expansion_only_skip_expand1' and not m.expand:
+                if bn_prune_filter.endswith('skip_expand1') and not m.expand:
                     continue
 
                 for op, (bn_name, bn) in zip(
@@ -161,6 +224,7 @@ def get_bn_to_prune(model, flags, verbose=True):
                     penalties.append(
                         (hidden_channel, op.n_macs / hidden_channel))
                     weights.append('{}.weight'.format(bn_name))
+                    ops.append(op)
                 if (m.use_transformer and m.use_res_connect) or \
                         (m.use_transformer and m.downsampling_transformer and not m.use_res_connect):
                     op = m.transformer
@@ -172,23 +236,43 @@ def get_bn_to_prune(model, flags, verbose=True):
                     weights_transformer.append('{}.weight'.format(bn_name))
                     flops_transformer.append(op.n_macs)
                     channels_transformer.append(hidden_channel)
+                    ops_transformer.append(op)
+        if use_mpc_latency:
+            latencies = get_mpc_latencies(ops + ops_transformer, profile)
+        else:
+            latencies = [0] * len(ops + ops_transformer)
+        mpc_ms_transformer = latencies[len(ops):]
+        per_channel_mpc_ms = [ms / numel for ms, (numel, _) in zip(latencies, penalties)]
+        per_channel_mpc_ms_transformer = [ms / numel for ms, (numel, _) in zip(
+            mpc_ms_transformer, penalties_transformer)]
         per_channel_flops = [val[1] for val in penalties]
+        per_channel_flops_transformer = [val[1] for val in penalties_transformer]
+        if bn_prune_filter.startswith('mpc_latency'):
+            penalties = [(numel, val) for (numel, _), val in zip(penalties, per_channel_mpc_ms)]
+            penalties_transformer = [(numel, val) for (numel, _), val in zip(
+                penalties_transformer, per_channel_mpc_ms_transformer)]
         numel_total = sum(val[0] for val in penalties)
         if flags.use_transformer == True:
-            per_channel_flops_transformer = [val[1] for val in penalties_transformer]
             numel_total_transformer = sum(val[0] for val in penalties_transformer)
             penalty_normalizer = sum([numel * val for numel, val in penalties + penalties_transformer
                                       ]) / (numel_total + numel_total_transformer + 1e-5)
-            penalties_transformer = [val / penalty_normalizer for (_, val) in penalties_transformer]
         else:
             penalty_normalizer = sum([numel * val for numel, val in penalties
                                       ]) / (numel_total + 1e-5)
+        if penalty_normalizer == 0:
+            raise ValueError(
+                'All penalties of bn_prune_filter {} are zero, does the latency '
+                'profile {} have regressors?'.format(bn_prune_filter, profile))
+        if flags.use_transformer == True:
+            penalties_transformer = [val / penalty_normalizer for (_, val) in penalties_transformer]
         penalties = [val / penalty_normalizer for (_, val) in penalties]
     elif bn_prune_filter in ['equal_penalty_skip_expand1']:
         # baseline for table 2, network slimming like
         weights = []
         penalties = []
         per_channel_flops = []
+        ops = []
+        hidden_channels = []
         for name, m in model.get_named_block_list().items():
             if isinstance(m, mb.InvertedResidualChannels):
                 if bn_prune_filter == 'equal_penalty_skip_expand1' and not m.expand:
@@ -201,15 +285,24 @@ def get_bn_to_prune(model, flags, verbose=True):
                     weights.append('{}.weight'.format(bn_name))
                     penalties.append(1)
                     per_channel_flops.append(op.n_macs / hidden_channel)
+                    ops.append(op)
+                    hidden_channels.append(hidden_channel)
+        if use_mpc_latency:
+            per_channel_mpc_ms = [ms / numel for ms, numel in zip(
+                get_mpc_latencies(ops, profile), hidden_channels)]
+        else:
+            per_channel_mpc_ms = [0] * len(ops)
     elif bn_prune_filter is None:
         # do nothing
         weights, penalties = [], []
         per_channel_flops = []
+        per_channel_mpc_ms = []
     else:
         raise NotImplementedError()
 
     prune_info = PruneInfo(weights, penalties)
     prune_info.add_info_list('per_channel_flops', per_channel_flops)
+    prune_info.add_info_list('per_channel_mpc_ms', per_channel_mpc_ms)
 
     if verbose and udist.is_master():
         for name, penal in zip(prune_info.weight, prune_info.penalty):
@@ -227,6 +320,8 @@ def get_bn_to_prune(model, flags, verbose=True):
         prune_info_transformer.add_info_list('flops', flops_transformer)
         prune_info_transformer.add_info_list('channels', channels_transformer)
         prune_info_transformer.add_info_list('initial_channels', channels_transformer)
+        if bn_prune_filter.startswith('mpc_latency'):
+            prune_info_transformer.add_info_list('per_channel_mpc_ms', per_channel_mpc_ms_transformer)
         prune_info_transformer.update_penalty()
         if verbose and udist.is_master():
             for name, penal in zip(prune_info_transformer.weight, prune_info_transformer.penalty):
@@ -250,6 +345,48 @@ def cal_bn_l1_loss(bn_weights, penalties, rho):
     return loss
 
 
+class BNL1Loss(object):
+    """Vectorised `cal_bn_l1_loss` over the weights of a `PruneInfo`.
+
+    The weights are looked up by name once and the penalties are expanded to
+    one value per element, so every step is a single concatenation and dot
+    product instead of one reduction per BN. Both are cached until the
+    `version` of the `PruneInfo` changes, i.e. when `shrink_model` compresses
+    the model or the penalties are updated.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._weights = []
+        self._penalties = None
+
+    def reset(self):
+        """Drop the cached weights and penalties."""
+        self._key = None
+
+    def weights(self, model, prune_info):
+        """Get the (cached) weights of `prune_info` in `model`."""
+        key = (id(model), id(prune_info), getattr(prune_info, 'version', 0))
+        if key != self._key:
+            named_parameters = dict(model.named_parameters())
+            self._weights = [named_parameters[name] for name in prune_info.weight]
+            if self._weights:
+                numels = torch.tensor([weight.numel() for weight in self._weights])
+                penalties = torch.tensor(prune_info.penalty, dtype=self._weights[0].dtype)
+                self._penalties = torch.repeat_interleave(penalties, numels).to(
+                    self._weights[0].device)
+            self._key = key
+        return self._weights
+
+    def __call__(self, model, prune_info, rho):
+        """Calculate l1 loss of the weights of `prune_info` in (unwrapped) `model`."""
+        weights = self.weights(model, prune_info)
+        if not weights:
+            return 0.0
+        flat = torch.cat([weight.view(-1) for weight in weights])
+        return rho * torch.dot(flat.abs(), self._penalties)
+
+
 ### UNUSED ###
 # def cal_mask_network_slimming_by_flops(weights,
 #                                        prune_info,
@@ -283,17 +420,24 @@ def cal_mask_network_slimming_by_threshold(weights, threshold):
 
 # ENTRYPOINT secure_train.py #530
 def cal_pruned_flops(prune_info):
-    """Calculate total FLOPS for dead atomic blocks."""
+    """Calculate total FLOPS for dead atomic blocks.
+
+    Returns:
+        The pruned FLOPS and a list of `[name, total channels, pruned channels,
+        total flops, pruned flops, total MPC ms, pruned MPC ms, pruned rate]`.
+    """
     info = []
     pruned_flops = 0
-    for name, per_channel_flops, mask in zip(
+    for name, per_channel_flops, per_channel_mpc_ms, mask in zip(
             prune_info.weight, prune_info.get_info_list('per_channel_flops'),
+            prune_info.get_info_list('per_channel_mpc_ms'),
             prune_info.get_info_list('mask')):
         num_pruned = (~mask.detach()).sum().item()
         num_total = mask.numel()
         info.append([
             name, num_total, num_pruned, num_total * per_channel_flops,
-            num_pruned * per_channel_flops, num_pruned / num_total
+            num_pruned * per_channel_flops, num_total * per_channel_mpc_ms,
+            num_pruned * per_channel_mpc_ms, num_pruned / num_total
         ])
         pruned_flops += num_pruned * per_channel_flops
     return pruned_flops, info
@@ -4,6 +4,7 @@ import torch
 from torch.optim.optimizer import Optimizer
 from utils.common import index_tensor_in
 from utils.common import check_tensor_in
+from utils.common import foreach_add
 
 
 class RMSprop(Optimizer):
@@ -27,7 +28,8 @@ class RMSprop(Optimizer):
             (default: False)
         centered (bool, optional) : if ``True``, compute the centered RMSProp,
             the gradient is normalized by an estimation of its variance
-        weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        weight_decay (float, optional): weight decay (L2 penalty) (default: 0),
+            added to the gradients of a group with one multi-tensor op
 
     """
 
@@ -79,10 +81,12 @@ class RMSprop(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
+            params = [p for p in group['params'] if p.grad is not None]
+            grads = [p.grad.data for p in params]
+            if group['weight_decay'] != 0:
+                grads = foreach_add(grads, [p.data for p in params],
+                                    alpha=group['weight_decay'])
+            for p, grad in zip(params, grads):
                 if grad.is_sparse:
                     raise RuntimeError(
                         'RMSprop does not support sparse gradients')
@@ -102,9 +106,6 @@ class RMSprop(Optimizer):
 
                 state['step'] += 1
 
-                if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], p.data)
-
                 square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
 
                 if group['centered']:
@@ -179,4 +180,5 @@ class RMSprop(Optimizer):
                 if check_tensor_in(var_old, self.state):
                     self.state.pop(var_old)
                 del group['params'][index]
+                break
         assert found, 'Var: {} not in RMSProp'.format(info['var_old_name'])
@@ -0,0 +1,131 @@
+"""Cache of decoded samples for evaluation and BN calibration.
+
+Validation decodes, resizes and crops the same images every time. `SampleCache`
+runs the PIL part of a transform once and stores its uint8 output in
+memory-mapped NumPy files, later epochs only page them in. `ToTensor` and
+`Normalize` are applied on device by the prefetcher instead, see
+`utils.dataflow.DataPrefetcher`.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+
+class ToUint8Tensor(object):
+    """Convert a PIL image to a `[C, H, W]` uint8 tensor, unlike `ToTensor`
+    without scaling."""
+
+    def __call__(self, img):
+        return torch.from_numpy(np.array(img, dtype=np.uint8).transpose(2, 0, 1).copy())
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+def split_transform(transform):
+    """Split `Compose([..., ToTensor(), Normalize(mean, std)])`.
+
+    Returns:
+        `(Compose([..., ToUint8Tensor()]), (mean, std))`, or `None` if
+        `transform` does not end like that.
+    """
+    if not isinstance(transform, transforms.Compose) or len(transform.transforms) < 2:
+        return None
+    to_tensor, normalize = transform.transforms[-2:]
+    if not (isinstance(to_tensor, transforms.ToTensor)
+            and isinstance(normalize, transforms.Normalize)):
+        return None
+    return (transforms.Compose(transform.transforms[:-2] + [ToUint8Tensor()]),
+            (list(normalize.mean), list(normalize.std)))
+
+
+class SampleCache(Dataset):
+    """Samples of `dataset` stored as uint8 in memory-mapped files.
+
+    The files `<path>.images.npy` and `<path>.labels.npy` are built on first
+    use by the first process of every node, with `num_workers` loader
+    workers, and reused as long as `<path>.json` matches. Random transforms
+    are frozen, e.g. a calibration subset keeps the augmentation it was
+    cached with.
+
+    Args:
+        dataset: Map-style dataset returning `(uint8 tensor, label)`.
+        path: Path prefix of the cache files.
+        indices: Optional subset of `dataset` to cache.
+        normalize: `(mean, std)` for the prefetcher to apply on device.
+    """
+
+    def __init__(self, dataset, path, indices=None, normalize=None, num_workers=0):
+        self.path = path
+        self.normalize = normalize
+        meta = {'num_samples': len(dataset), 'dataset': repr(dataset),
+                'transform': repr(getattr(dataset, 'transform', None)),
+                'indices': None if indices is None else [int(i) for i in indices]}
+        if indices is not None:
+            dataset = torch.utils.data.Subset(dataset, list(indices))
+        if int(os.environ.get('LOCAL_RANK', 0)) == 0 and self._load_meta() != meta:
+            self._build(dataset, meta, num_workers)
+        if dist.is_initialized():
+            dist.barrier()
+        self.images = None
+        self.labels = np.load(path + '.labels.npy')
+
+    def __getstate__(self):
+        # Workers map the file themselves instead of receiving a copy.
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def _load_meta(self):
+        try:
+            with open(self.path + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _build(self, dataset, meta, num_workers):
+        logging.info('Building sample cache {} of {} samples.'.format(
+            self.path, len(dataset)))
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=64, shuffle=False,
+                                             num_workers=num_workers)
+        tmp = '.tmp.{}.npy'.format(os.getpid())
+        images, labels = None, np.zeros(len(dataset), dtype=np.int64)
+        offset = 0
+        for input, target in loader:
+            if images is None:
+                images = np.lib.format.open_memmap(
+                    self.path + '.images' + tmp, mode='w+', dtype=np.uint8,
+                    shape=(len(dataset),) + tuple(input.shape[1:]))
+            images[offset:offset + len(input)] = input.numpy()
+            labels[offset:offset + len(input)] = target.numpy()
+            offset += len(input)
+        images.flush()
+        del images
+        np.save(self.path + '.labels' + tmp, labels)
+        os.replace(self.path + '.images' + tmp, self.path + '.images.npy')
+        os.replace(self.path + '.labels' + tmp, self.path + '.labels.npy')
+        # Written last, marks the cache complete.
+        with open(self.path + '.json' + tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.path + '.json' + tmp, self.path + '.json')
+
+    def __getitem__(self, index):
+        if self.images is None:
+            # Copy-on-write, so that tensors can be made from the pages.
+            self.images = np.load(self.path + '.images.npy', mmap_mode='c')
+        return torch.from_numpy(self.images[index]), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.path + ')'
@@ -23,6 +23,9 @@ class AdamW(Optimizer):
         eps (float, optional): term added to the denominator to improve
             numerical stability (default: 1e-8)
         weight_decay (float, optional): weight decay coefficient (default: 1e-2)
+        decoupled (boolean, optional): if ``False``, apply `weight_decay` as an
+            L2 penalty added to the gradients instead, as Adam does
+            (default: True)
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
@@ -36,7 +39,7 @@ class AdamW(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=1e-2, amsgrad=False):
+                 weight_decay=1e-2, amsgrad=False, decoupled=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -48,13 +51,15 @@ class AdamW(Optimizer):
         if not 0.0 <= weight_decay:
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad,
+                        decoupled=decoupled)
         super(AdamW, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(AdamW, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('decoupled', True)
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -77,11 +82,14 @@ class AdamW(Optimizer):
                     if p.grad is None:
                         continue
 
-                    # Perform stepweight decay
-                    p.mul_(1 - group['lr'] * group['weight_decay'])
+                    grad = p.grad
+                    if group['decoupled']:
+                        # Perform stepweight decay
+                        p.mul_(1 - group['lr'] * group['weight_decay'])
+                    elif group['weight_decay'] != 0:
+                        grad = grad.add(p, alpha=group['weight_decay'])
 
                     # Perform optimization step
-                    grad = p.grad
                     if grad.is_sparse:
                         raise RuntimeError('AdamW does not support sparse gradients')
                     amsgrad = group['amsgrad']
@@ -173,4 +181,5 @@ class AdamW(Optimizer):
                 if check_tensor_in(var_old, self.state):
                     self.state.pop(var_old)
                 del group['params'][index]
+                break
         assert found, 'Var: {} not in RMSProp'.format(info['var_old_name'])
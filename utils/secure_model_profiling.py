@@ -12,19 +12,23 @@ import models.secure_hrnet_base as hrb
 from models.secure_padding import ZeroPad2d
 from models.secure_multi_head_attention import MultiHeadAttention
 from models.secure_layernorm import LayerNorm
+from models.secure_upsample import UpsampleNearest
 import models.secure_transformer as transformer
 from utils import distributed as udist
 from utils.config import DEVICE_MODE
+from utils.profiling_cache import get_profiling_cache, module_key
 
-"""Change here for analytical model of different settings"""
-from utils.secure_profiling_prediction_weak import *
-# from utils.secure_profiling_prediction_powerful import *
+from utils.secure_profiling_prediction import DEFAULT_PROFILE, get_profile_predictor
+from utils.secure_profiling_prediction import conv_features, linear_features, relu_features, bn_features, avgpool_features, maxpool_features
+from utils.secure_profiling_prediction import mha_features, softmax_features, layernorm_features, upsample_features, pad_features, numel
 
 import warnings
 warnings.filterwarnings("ignore") 
 
 model_profiling_hooks = []
 model_profiling_speed_hooks = []
+model_profiling_calls = []
+model_profiling_cache = None
 
 name_space = 95
 params_space = 15
@@ -80,7 +84,7 @@ def conv_module_name_filter(name):
     return name
 
 
-def module_profiling(self, input, output, num_forwards, verbose):
+def module_profiling(self, input, output, num_forwards, verbose, profile=DEFAULT_PROFILE):
     def add_sub(m, sub_op):
         m.n_macs += getattr(sub_op, 'n_macs', 0)
         m.n_params += getattr(sub_op, 'n_params', 0)
@@ -92,6 +96,22 @@ def module_profiling(self, input, output, num_forwards, verbose):
     #     or (isinstance(self, nn.Sequential) and isinstance(self[0], hr.ParallelModule)):
     if not input:
         return
+    predictor = get_profile_predictor(profile)
+
+    def predict(op, row):
+        # Looked up in `model_profiling_cache` by module and shapes, a module
+        # call makes at most one prediction.
+        if model_profiling_cache is None:
+            return predictor.predict_one(op, row)
+        namespace = 'mpc/{}@{}'.format(profile, predictor.version())
+        key = module_key(self, input, output)
+        entry = model_profiling_cache.get(namespace, key)
+        if entry is not None:
+            return entry['n_seconds']
+        n_seconds = predictor.predict_one(op, row)
+        model_profiling_cache.put(namespace, key, getattr(self, 'n_macs', 0),
+                                  getattr(self, 'n_params', 0), n_seconds)
+        return n_seconds
     if isinstance(self, MultiHeadAttention) or isinstance(input[0], list) or isinstance(output, list):
         pass
     else:
@@ -107,7 +127,7 @@ def module_profiling(self, input, output, num_forwards, verbose):
                        self.kernel_size[1] * outs[2] * outs[3] //
                        self.groups) * outs[0]
         self.n_params = get_params(self)
-        self.n_seconds = conv_time_cal(ins, outs, self.kernel_size) # calculated in ms
+        self.n_seconds = predict('conv', conv_features(ins, outs, self.kernel_size)) # calculated in ms
         self.name = conv_module_name_filter(self.__repr__())
         
         # logging.info("******* CONV n_seconds: %s *******", self.n_seconds)
@@ -123,21 +143,21 @@ def module_profiling(self, input, output, num_forwards, verbose):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
 
-        self.n_seconds = linear_time_cal(ins, outs)
+        self.n_seconds = predict('fc', linear_features(ins, outs))
         self.name = self.__repr__()
         
     elif isinstance(self, cnn.ReLU):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
         
-        self.n_seconds = relu_time_cal(ins, outs)
+        self.n_seconds = predict('relu', relu_features(ins, outs))
         self.name = self.__repr__()
         
     elif isinstance(self, cnn.BatchNorm2d):
         self.n_macs = ins[1] * outs[1] * outs[0]
         self.n_params = get_params(self)
         
-        self.n_seconds = bn_time_cal(ins, outs)
+        self.n_seconds = predict('bn', bn_features(ins, outs))
         self.name = self.__repr__()
         
     elif isinstance(self, cnn.AvgPool2d):
@@ -145,7 +165,13 @@ def module_profiling(self, input, output, num_forwards, verbose):
         self.n_macs = ins[1] * ins[2] * ins[3] * ins[0]
         self.n_params = 0
 
-        self.n_seconds = avgpool_time_cal(ins, outs, self.kernel_size)
+        self.n_seconds = predict('ap', avgpool_features(ins, outs, self.kernel_size))
+        self.name = self.__repr__()
+
+    elif isinstance(self, cnn.MaxPool2d):
+        self.n_macs = 0
+        self.n_params = 0
+        self.n_seconds = predict('mp', maxpool_features(ins, outs, self.kernel_size))
         self.name = self.__repr__()
         
     elif isinstance(self, cnn.AdaptiveAvgPool2d):
@@ -223,7 +249,8 @@ def module_profiling(self, input, output, num_forwards, verbose):
         add_sub(self, self.input_proj)
         add_sub(self, self.reverse_proj)
         add_sub(self, self.encoder)
-        add_sub(self, self.decoder)
+        add_sub(self, getattr(self, 'decoder', None))
+        add_sub(self, getattr(self, 'attention', None))
         self.name = self.__repr__()
     elif isinstance(self, transformer.TransformerEncoderLayer):
         self.n_macs = 0
@@ -246,13 +273,52 @@ def module_profiling(self, input, output, num_forwards, verbose):
     # TODO cryptenify
     elif isinstance(self, MultiHeadAttention):
         self.n_macs = 0
-        self.n_params = 0
+        self.n_params = get_params(self)
 
-        self.n_seconds = 0
-        add_sub(self, self.out_proj)
+        # q: [N, L, E], k: [N, S, E]
+        batch, num_queries, embed_dim = input[0].shape
+        num_keys = input[1].shape[1]
+        if predictor.has_model('mha'):
+            # projections and the softmax included
+            self.n_seconds = predict('mha', mha_features(
+                num_queries, num_keys, embed_dim, self.num_heads, batch))
+        else:
+            # Sum of the parts: the projections are hooked `cnn.Linear`s, the
+            # softmax of `scaled_dot_product_attention` is not a submodule.
+            self.n_seconds = predict('softmax', softmax_features(
+                [batch, self.num_heads, num_queries, num_keys]))
+            for op in [self.Wq, self.Wk, self.Wv, self.dense]:
+                self.n_seconds += getattr(op, 'n_seconds', 0)
         self.n_macs += 2 * input[0].shape[0] * input[1].shape[0] * input[0].shape[2] + \
            4 * input[0].shape[0] * input[0].shape[2] * input[0].shape[2]
         self.name = self.__repr__()
+
+    elif isinstance(self, transformer.MHAttentionMap):
+        self.n_macs = 0
+        self.n_params = get_params(self)
+        # functional softmax over the flattened attention map, output: [N, Q, H, h, w]
+        self.n_seconds = predict('softmax', softmax_features(
+            [outs[0], outs[1], numel(outs[2:])]))
+        add_sub(self, self.q_linear)
+        self.name = self.__repr__()
+
+    elif isinstance(self, LayerNorm):
+        self.n_macs = 0
+        self.n_params = get_params(self)
+        self.n_seconds = predict('ln', layernorm_features(ins, self.normalized_shape))
+        self.name = self.__repr__()
+
+    elif isinstance(self, UpsampleNearest):
+        self.n_macs = 0
+        self.n_params = 0
+        self.n_seconds = predict('up', upsample_features(ins, outs))
+        self.name = self.__repr__()
+
+    elif isinstance(self, ZeroPad2d):
+        self.n_macs = 0
+        self.n_params = 0
+        self.n_seconds = predict('pad', pad_features(ins, outs))
+        self.name = self.__repr__()
     elif isinstance(self, hrb.HighResolutionModule):
         self.n_macs = 0
         self.n_params = 0
@@ -326,17 +392,38 @@ def module_profiling(self, input, output, num_forwards, verbose):
 
 
 def add_profiling_hooks(m, num_forwards, verbose):
+    # Only record the calls, they are profiled by `profile_recorded_calls`.
     global model_profiling_hooks
     model_profiling_hooks.append(
-        m.register_forward_hook(lambda m, input, output: module_profiling(
-            m, input, output, num_forwards, verbose=verbose)))
+        m.register_forward_hook(lambda m, input, output: model_profiling_calls.append(
+            (m, input, output))))
 
 
 def remove_profiling_hooks():
     global model_profiling_hooks
+    global model_profiling_calls
     for h in model_profiling_hooks:
         h.remove()
     model_profiling_hooks = []
+    model_profiling_calls = []
+
+
+def profile_recorded_calls(num_forwards, verbose, profiles):
+    """Profile recorded module calls in execution order, once per profile.
+
+    Every module ends up with `n_seconds_profiles`, a dict from profile to
+    its latency, and with `n_seconds` of the first profile.
+    """
+    modules = list({id(m): m for m, _, _ in model_profiling_calls}.values())
+    for m in modules:
+        m.n_seconds_profiles = {}
+    # Primary profile last, so that it sets `n_seconds` and is the only one logged.
+    for profile in reversed(profiles):
+        for m, input, output in model_profiling_calls:
+            module_profiling(m, input, output, num_forwards,
+                             verbose and profile == profiles[0], profile=profile)
+        for m in modules:
+            m.n_seconds_profiles[profile] = getattr(m, 'n_seconds', 0)
 
 
 def model_profiling(model,
@@ -347,7 +434,9 @@ def model_profiling(model,
                     use_cuda=True,
                     num_forwards=10,
                     verbose=True,
-                    encrypt=False):
+                    encrypt=False,
+                    profiles=None,
+                    cache_path=None):
     """ Pytorch model profiling with input image size
     (batch, channel, height, width).
     The function exams the number of multiply-accumulates (n_macs).
@@ -360,12 +449,21 @@ def model_profiling(model,
         channel: int
         use_cuda: bool
         encrypt: bool - If True, encrypts the input tensor to a CrypTensor first.
+        profiles: list - Latency profiles under `utils/LR_model` to score the
+            model against, `n_seconds` is taken from the first one.
+        cache_path: str - If given, a JSON `ProfilingCache` of per-module
+            latencies, only modules with new shapes are predicted.
 
     Returns:
         macs: int
         params: int
 
     """
+    global model_profiling_cache
+    model_profiling_cache = get_profiling_cache(cache_path)
+    if model_profiling_cache is not None:
+        model_profiling_cache.reset_stats()
+    profiles = list(profiles or [DEFAULT_PROFILE])
     model.eval()
     data = torch.rand(batch, channel, height, width)
 
@@ -387,6 +485,7 @@ def model_profiling(model,
     with torch.no_grad():
         with crypten.no_grad():
             model(data)
+    profile_recorded_calls(num_forwards, verbose, profiles)
     if verbose:
         logging.info(''.center(
             name_space + seconds_space, '-')) #name_space + params_space + macs_space + seconds_space, '-'))
@@ -394,6 +493,15 @@ def model_profiling(model,
                      '{:,}'.format(model.n_params).rjust(params_space, ' ') +
                      '{:,}'.format(model.n_macs).rjust(macs_space, ' ') +
                      '{:,}'.format(model.n_seconds).rjust(seconds_space, ' '))
+        for profile in profiles[1:]:
+            logging.info('Total ({})'.format(profile).ljust(name_space, ' ') +
+                         ''.rjust(params_space + macs_space, ' ') +
+                         '{:,}'.format(model.n_seconds_profiles[profile]).rjust(seconds_space, ' '))
     remove_profiling_hooks()
+    if model_profiling_cache is not None and udist.is_master():
+        logging.info('Profiling cache: {} hits, {} misses.'.format(
+            model_profiling_cache.hits, model_profiling_cache.misses))
+        model_profiling_cache.save()
+    model_profiling_cache = None
     model = model.to(origin_device)
     return model.n_seconds, model.n_macs, model.n_params
@@ -33,6 +33,9 @@ class ExponentialMovingAverage(cnn.Module):
     averages of the trained parameters. Evaluations that use averaged parameters sometimes produce significantly
     better results than the final trained values.
 
+    Plaintext shadows are views into one flat buffer per device and dtype, so that `update` averages all of them with
+    a single multi-tensor op. Encrypted shadows are updated one by one. The buffers and the map from model tensors to
+    shadows are rebuilt lazily, i.e. only after registering, popping or compressing variables.
     """
 
     def __init__(self, momentum, zero_debias=False):
@@ -45,10 +48,59 @@ class ExponentialMovingAverage(cnn.Module):
         self._zero_debias = zero_debias
         self.clear()
 
+    def __getstate__(self):
+        # The map references model tensors, which must not end up in checkpoints.
+        state = self.__dict__.copy()
+        state['_bound'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key, val in [('_flat', None), ('_loose', None), ('_bound', None), ('_pending_updates', 0),
+                         ('_last_momentum', None)]:
+            self.__dict__.setdefault(key, val)
+
     def _check_exist(self, name):
         if name not in self._shadow:
             raise RuntimeError('{} has not been registered'.format(name))
 
+    def _invalidate(self):
+        """Rebuild the flat buffers and the tensor map before the next `update`."""
+        self._flat = None
+        self._loose = None
+        self._bound = None
+
+    def _flatten(self):
+        """Move all plaintext shadows into one flat buffer per device and dtype."""
+        groups = OrderedDict()
+        self._loose = []
+        for name, val in self._shadow.items():
+            if isinstance(val, CrypTensor):
+                self._loose.append(name)
+            else:
+                groups.setdefault((val.device, val.dtype), []).append(name)
+        self._flat = []
+        for (device, dtype), names in groups.items():
+            flat = torch.cat([self._shadow[name].detach().reshape(-1) for name in names])
+            offset = 0
+            for name in names:
+                numel = self._shadow[name].numel()
+                self._shadow[name] = flat[offset:offset + numel].view_as(self._shadow[name])
+                offset += numel
+            self._flat.append((flat, names, [self._shadow[name] for name in names]))
+
+    def clear_binding(self):
+        """Look up the tensors of the model again on the next `update`."""
+        self._bound = None
+
+    def _sync_info(self):
+        """Write the updates since the last call into the per variable info."""
+        if self._pending_updates:
+            for info in self._info.values():
+                info['num_updates'] += self._pending_updates
+                info['last_momemtum'] = self._last_momentum
+            self._pending_updates = 0
+
     def register(self, name, val, zero_init=False):
         """Register and init variable to averaged."""
         if name in self._shadow:
@@ -57,6 +109,7 @@ class ExponentialMovingAverage(cnn.Module):
             raise TypeError(
                 'The variables must be half, float, or double: {}'.format(name))
 
+        self._sync_info()
         if zero_init:
             tensor = torch.zeros_like(val)
             if isinstance(val, CrypTensor): tensor = crypten.cryptensor(tensor)
@@ -69,30 +122,64 @@ class ExponentialMovingAverage(cnn.Module):
             'zero_init': zero_init,
             'compress_masked': False,
         }
+        self._invalidate()
+
+    def _get_momentum(self, num_updates):
+        if num_updates is None:
+            return self._momentum
+        return min(self._momentum, (1.0 + num_updates) / (10.0 + num_updates))
 
     def forward(self, name, x, num_updates=None):
         """Update averaged variable."""
         self._check_exist(name)
-        if num_updates is None:
-            momentum = self._momentum
-        else:
-            momentum = min(self._momentum,
-                           (1.0 + num_updates) / (10.0 + num_updates))
+        momentum = self._get_momentum(num_updates)
         self._info[name]['num_updates'] += 1
         self._info[name]['last_momemtum'] = momentum
         return self._shadow[name].mul_(momentum).add_(1.0 - momentum,
                                                       x.detach())
 
+    def update(self, model, num_updates=None):
+        """Update all averaged variables from the parameters and buffers of `model`.
+
+        Equivalent to calling `forward` for every registered variable, with one multi-tensor op per flat buffer.
+        The map to the tensors of `model` is cached, call `clear_binding` after replacing its buffers (e.g. moving
+        it to another device) outside of the compress functions.
+        """
+        if self._flat is None:
+            self._flatten()
+        if self._bound is None or self._bound[0] is not model:
+            # Parameters are bound as is, so that moving them keeps the map valid.
+            named_vars = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+            self._bound = (model, [[named_vars[name] for name in names] for _, names, _ in self._flat],
+                           [named_vars[name] for name in self._loose])
+        momentum = self._get_momentum(num_updates)
+        with torch.no_grad():
+            for (_, _, shadows), xs in zip(self._flat, self._bound[1]):
+                if hasattr(torch, '_foreach_lerp_'):
+                    torch._foreach_lerp_(shadows, xs, 1.0 - momentum)
+                else:
+                    torch._foreach_mul_(shadows, momentum)
+                    torch._foreach_add_(shadows, xs, alpha=1.0 - momentum)
+        for name, x in zip(self._loose, self._bound[2]):
+            self._shadow[name].mul_(momentum).add_(x.detach().mul(1.0 - momentum))
+        self._pending_updates += 1
+        self._last_momentum = momentum
+
     def clear(self):
         """Remove all registered variables."""
         self._shadow = OrderedDict()
         self._info = OrderedDict()
+        self._pending_updates = 0
+        self._last_momentum = None
+        self._invalidate()
 
     def pop(self, name):
         """Remove and return info."""
         self._check_exist(name)
+        self._sync_info()
         val = self._shadow.pop(name)
         info = self._info.pop(name)
+        self._invalidate()
         return val, info
 
     def average_names(self):
@@ -105,6 +192,7 @@ class ExponentialMovingAverage(cnn.Module):
         return self._shadow[name]
 
     def state_dict(self):
+        self._sync_info()
         return {
             'info': self._info,
             'shadow': self._shadow,
@@ -125,6 +213,8 @@ class ExponentialMovingAverage(cnn.Module):
                 logging.warning(warning_str)
         self._shadow = copy.deepcopy(state_dict['shadow'])
         self._info = copy.deepcopy(state_dict['info'])
+        self._pending_updates = 0
+        self._invalidate()
 
     def to(self, *args, **kwargs):
         # TODO cryptenify?
@@ -134,6 +224,7 @@ class ExponentialMovingAverage(cnn.Module):
             self._shadow[k] = v.to(device,
                                    dtype if v.is_floating_point() else None,
                                    non_blocking)
+        self._invalidate()
         return self
 
     def compress_start(self):
@@ -148,8 +239,10 @@ class ExponentialMovingAverage(cnn.Module):
                 ema.compress_drop(*args, **kwargs)
             ```
         """
+        self._sync_info()
         for val in self._info.values():
             val['compress_masked'] = False
+        self._invalidate()
 
     def compress_mask(self, info, verbose=False):
         """Adjust parameters values by masks for dynamic network shrinkage."""
@@ -172,6 +265,7 @@ class ExponentialMovingAverage(cnn.Module):
         self._info[var_new_name] = self._info.pop(var_old_name)
         self._info[var_new_name]['compress_masked'] = True
         self._shadow[var_new_name] = ema_new
+        self._invalidate()
 
     def compress_drop(self, info, verbose=False):
         """Remove unused parameters for dynamic network shrinkage."""
@@ -229,11 +323,11 @@ class CrossEntropyLabelSmooth(cnn.Module):
         return self.reduce_fun(loss)
 
 
-def cal_l2_loss(model, weight_decay, method):
-    """Calculate l2 penalty."""
-    loss = 0.0
+def get_weight_decays(model, weight_decay, method):
+    """Get weight decay of each parameter, as `[(name, params, weight_decay)]`."""
+    res = []
     if method == 'slimmable':
-        for params in model.parameters():
+        for name, params in model.named_parameters():
             # all depthwise convolution (N, 1, x, x) has no weight decay
             # weight decay only on normal conv and fc
             ps = list(params.size())
@@ -243,28 +337,77 @@ def cal_l2_loss(model, weight_decay, method):
                 _weight_decay = weight_decay
             else:
                 _weight_decay = 0
-            loss += _weight_decay * (params ** 2).sum()
+            res.append((name, params, _weight_decay))
     elif method == 'mnas':
         classifier_bias_count = 0
-        weight_decay_map = dict()
         for name, params in model.named_parameters():
             ps = list(params.size())
             if len(ps) == 4 or len(ps) == 2:
                 # regularize all convolution and fc weight
-                weight_decay_map[name] = weight_decay, params
+                res.append((name, params, weight_decay))
             else:
                 assert len(ps) == 1
                 if 'classifier' in name:  # fc bias
                     # print(name)  # module.classifier.bias
-                    weight_decay_map[name] = weight_decay, params
+                    res.append((name, params, weight_decay))
                     classifier_bias_count += 1
                 else:  # bn weight/bias
-                    weight_decay_map[name] = 0.0, params
+                    res.append((name, params, 0.0))
         assert classifier_bias_count == 1
-        for _weight_decay, params in weight_decay_map.values():
-            loss += _weight_decay * (params ** 2).sum()
     else:
         raise ValueError('Unknown weight_decay method: {}'.format(method))
+    return res
+
+
+def cal_l2_loss(model, weight_decay, method):
+    """Calculate l2 penalty."""
+    loss = 0.0
+    for _, params, _weight_decay in get_weight_decays(model, weight_decay, method):
+        loss += _weight_decay * (params ** 2).sum()
+    return loss * 0.5
+
+
+def split_weight_decay_groups(optimizer, model, weight_decay, method):
+    """Split parameter groups of `optimizer` by the weight decay of `method`.
+
+    Each group gets the L2 penalty of its parameters as `weight_decay`, so the
+    optimizer step applies the same gradients as adding `cal_l2_loss` to the
+    loss, without its ops in the graph. Unlike `cal_l2_loss`, parameters
+    whose `.grad` is None after backward (unused in the forward) are skipped
+    by the step and so not decayed. Groups already split are kept, so it is
+    safe to call on optimizers restored from checkpoints.
+    """
+    decays = {id(params): _weight_decay for _, params, _weight_decay in
+              get_weight_decays(model, weight_decay, method)}
+    param_groups = []
+    for group in optimizer.param_groups:
+        if 'weight_decay_method' in group:
+            param_groups.append(group)
+            continue
+        split = OrderedDict()
+        for params in group['params']:
+            split.setdefault(decays.get(id(params), 0.0), []).append(params)
+        for _weight_decay, params in split.items():
+            new_group = dict(group, params=params, weight_decay=_weight_decay,
+                             weight_decay_method=method)
+            if 'decoupled' in new_group:
+                new_group['decoupled'] = False
+            param_groups.append(new_group)
+    optimizer.param_groups = param_groups
+    return optimizer
+
+
+def get_l2_loss(optimizer):
+    """Get l2 penalty applied by `optimizer` after `split_weight_decay_groups`.
+
+    Same value as `cal_l2_loss`, only for logging.
+    """
+    loss = 0.0
+    with crypten.no_grad():
+        for group in optimizer.param_groups:
+            if 'weight_decay_method' in group:
+                for params in group['params']:
+                    loss += group['weight_decay'] * (params ** 2).sum()
     return loss * 0.5
 
 
@@ -337,6 +480,7 @@ def get_lr_scheduler(optimizer, FLAGS, last_epoch=-1):
 def get_optimizer(model, FLAGS):
     """Get optimizer."""
     if FLAGS.prune_params['method'] is not None:
+        # set by `split_weight_decay_groups` instead
         weight_decay = 0
     else:
         weight_decay = FLAGS.weight_decay
@@ -391,4 +535,7 @@ def get_optimizer(model, FLAGS):
         except ImportError:
             raise NotImplementedError(
                 'Optimizer {} is not yet implemented.'.format(FLAGS.optimizer))
+    if FLAGS.prune_params['method'] is not None:
+        split_weight_decay_groups(optimizer, model, FLAGS.weight_decay,
+                                  FLAGS.weight_decay_method)
     return optimizer
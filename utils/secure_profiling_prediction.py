@@ -0,0 +1,332 @@
+"""Batched MPC latency prediction with the regression models in `utils/LR_model`.
+
+Every op type has a feature function that maps `(ins, outs, ...)` to one row
+of features, in the same column order the regressors were fitted with. The
+`LatencyPredictor` loads each regressor and scaler once per process and scores
+all rows of one op type with a single `predict` call.
+
+Every sub directory of `utils/LR_model` holding `*_LR_model.joblib` files is a
+hardware profile. Profiles are referred to as `<profile>` (client side) or
+`<profile>/<party>`, e.g. `weak` or `powerful/server`.
+"""
+import glob
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from joblib import load
+
+LR_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'LR_model')
+DEFAULT_PROFILE = 'powerful'
+
+# Column order for each op, must match the one used when fitting the models.
+OP_FEATURES = {
+    'conv': ['FLOPs', 'IN_MACs', 'PAR_MACs', 'OUT_MACs'],
+    'fc': ['FLOPs', 'IN_MACs', 'PAR_MACs', 'OUT_MACs'],
+    'relu': ['FLOPs'],
+    'bn': ['FLOPs', 'IN_MACs', 'PAR_MACs', 'OUT_MACs'],
+    'ap': ['FLOPs', 'IN_MACs', 'OUT_MACs'],
+    'mp': ['FLOPs', 'IN_MACs', 'OUT_MACs'],
+    # Fitted by `tools/calibrate_latency.py`, not shipped with every profile.
+    'mha': ['FLOPs', 'SOFTMAX', 'IN_MACs', 'OUT_MACs'],
+    'softmax': ['FLOPs', 'ROWS'],
+    'ln': ['FLOPs', 'PAR_MACs'],
+    'up': ['IN_MACs', 'OUT_MACs'],
+    'pad': ['IN_MACs', 'OUT_MACs'],
+}
+
+
+def numel(shape):
+    """Number of elements of a tensor with the given shape."""
+    return int(np.prod(list(shape)))
+
+
+def conv_features(ins, outs, kernel_size):
+    """Features of a convolution.
+
+    Args:
+        ins: [N, CI, HI, WI]
+        outs: [N, CO, HO, WO]
+        kernel_size: [FH, FW]
+    """
+    return [
+        # flops: 2 * FH * FW * CI * HO * WO * CO
+        (2 * kernel_size[0] * kernel_size[1] * ins[1]) * outs[2] * outs[3] * outs[1],
+        # In_macs: HI * WI * CI
+        (ins[2] * ins[3] * ins[1]) * 8,
+        # Par_macs: CI * FH * FW * CO
+        (ins[1] * kernel_size[0] * kernel_size[1] * outs[1]) * 8,
+        # Out_macs: HO * WO * CO
+        (outs[2] * outs[3] * outs[1]) * 8,
+    ]
+
+
+def linear_features(ins, outs):
+    """Features of a fully connected layer.
+
+    Args:
+        ins: [N, CI]
+        outs: [N, CO]
+    """
+    return [
+        # flops: (2 * CI * CO) + CO
+        (2 * ins[1] * outs[1]) + outs[1],
+        # In_macs: CI * 8
+        ins[1] * 8,
+        # Par_macs: (CI + 1) * CO * 8
+        (ins[1] + 1) * outs[1] * 8,
+        # Out_macs: CO * 8
+        outs[1] * 8,
+    ]
+
+
+def relu_features(ins, outs):
+    """Features of a ReLU.
+
+    Args:
+        ins: [N, CI, HI, WI]
+        outs: [N, CO, HO, WO]
+    """
+    # flops: N * HI * WI * CI
+    return [ins[0] * ins[1] * ins[2] * ins[3]]
+
+
+def bn_features(ins, outs):
+    """Features of a batch normalization.
+
+    Args:
+        ins: [N, CI, HI, WI]
+        outs: [N, CO, HO, WO]
+    """
+    return [
+        # flops: CI * HI * WI
+        ins[1] * ins[2] * ins[3],
+        # In_macs: CI * HI * WI
+        ins[1] * ins[2] * ins[3],
+        # Par_macs: CI
+        ins[1],
+        # Out_macs: CI * HI * WI
+        ins[1] * ins[2] * ins[3],
+    ]
+
+
+def avgpool_features(ins, outs, kernel_size):
+    """Features of an average pooling.
+
+    Args:
+        ins: [N, CI, HI, WI]
+        outs: [N, CO, HO, WO]
+        kernel_size: F
+    """
+    return [
+        # flops: F * F * HO * WO * CO
+        (kernel_size * kernel_size) * (outs[2] * outs[3]) * outs[1],
+        # In_macs: HI * WI * CI * 8
+        (ins[2] * ins[3]) * ins[1] * 8,
+        # Out_macs: HO * WO * CO * 8
+        (outs[2] * outs[3]) * outs[1] * 8,
+    ]
+
+
+def maxpool_features(ins, outs, kernel_size):
+    """Features of a max pooling, same as `avgpool_features`."""
+    return avgpool_features(ins, outs, kernel_size)
+
+
+def mha_features(num_queries, num_keys, embed_dim, num_heads, batch=1):
+    """Features of a multi-head attention, including its projections.
+
+    Args:
+        num_queries: L, number of query tokens.
+        num_keys: S, number of key/value tokens.
+        embed_dim: E
+        num_heads: H
+        batch: N
+    """
+    return [
+        # flops: q/k/v/out projections plus QK^T and AV
+        2 * batch * (2 * num_queries + 2 * num_keys) * embed_dim * embed_dim
+        + 4 * batch * num_queries * num_keys * embed_dim,
+        # softmax inputs: N * H * L * S
+        batch * num_heads * num_queries * num_keys,
+        # In_macs: N * (L + 2 * S) * E * 8
+        batch * (num_queries + 2 * num_keys) * embed_dim * 8,
+        # Out_macs: N * L * E * 8
+        batch * num_queries * embed_dim * 8,
+    ]
+
+
+def softmax_features(ins, dim=-1):
+    """Features of a softmax over `dim` of a tensor of shape `ins`."""
+    return [
+        # flops: number of exponentials
+        numel(ins),
+        # rows: number of max/normalization reductions
+        numel(ins) // ins[dim],
+    ]
+
+
+def layernorm_features(ins, normalized_shape):
+    """Features of a layer normalization.
+
+    Args:
+        ins: Input shape.
+        normalized_shape: Trailing shape normalized over, also the shape of
+            the affine parameters.
+    """
+    return [
+        # flops: number of normalized elements
+        numel(ins),
+        # Par_macs: elements per normalization
+        numel(normalized_shape),
+    ]
+
+
+def upsample_features(ins, outs):
+    """Features of a nearest upsampling."""
+    return [numel(ins) * 8, numel(outs) * 8]
+
+
+def pad_features(ins, outs):
+    """Features of a zero padding."""
+    return [numel(ins) * 8, numel(outs) * 8]
+
+
+class LatencyPredictor(object):
+    """Latency predictor backed by the regressors in one profile directory.
+
+    Args:
+        folderpath: Directory holding `<op>_<name>_LR_model.joblib` and
+            `<op>_<name>_scaler.joblib` files.
+        name: Party to predict for, only `client` models are shipped.
+    """
+
+    def __init__(self, folderpath, name='client'):
+        self.folderpath = folderpath
+        self.name = name
+        self._models = {}
+        self._missing = set()
+
+    def has_model(self, op):
+        """Whether the profile has a regressor for `op`."""
+        return os.path.exists('{}{}_{}_LR_model.joblib'.format(
+            self.folderpath, op, self.name))
+
+    def version(self):
+        """Last modification time of the profile's regressors, changes when
+        they are refitted."""
+        paths = glob.glob('{}*_{}_*.joblib'.format(self.folderpath, self.name))
+        return int(max([os.path.getmtime(path) for path in paths] or [0]))
+
+    def _load(self, op):
+        if op not in self._models:
+            prefix = '{}{}_{}'.format(self.folderpath, op, self.name)
+            self._models[op] = (load(prefix + '_LR_model.joblib'),
+                                load(prefix + '_scaler.joblib'))
+        return self._models[op]
+
+    def predict(self, op, features):
+        """Predict latency in ms for a batch of feature rows of one op type.
+
+        Args:
+            op: One of the keys of `OP_FEATURES`.
+            features: Array-like of shape `[num_layers, len(OP_FEATURES[op])]`.
+
+        Returns:
+            An int64 numpy array of length `num_layers`. All zeros if the
+            profile has no regressor for `op`.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        if features.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        if not self.has_model(op):
+            if op not in self._missing:
+                self._missing.add(op)
+                logging.warning('No latency model for {} in {}, counted as 0. '
+                                'Fit one with tools/calibrate_latency.py.'.format(
+                                    op, self.folderpath))
+            return np.zeros(features.shape[0], dtype=np.int64)
+        features = pd.DataFrame(features.reshape(-1, len(OP_FEATURES[op])),
+                                columns=OP_FEATURES[op])
+        reg, scaler = self._load(op)
+        predicted_time = reg.predict(scaler.transform(features))
+        return np.maximum(np.rint(predicted_time), 0).astype(np.int64)
+
+    def predict_one(self, op, row):
+        """Predict latency in ms for a single layer."""
+        return int(self.predict(op, [row])[0])
+
+    def predict_many(self, requests):
+        """Predict latency for layers of mixed op types.
+
+        Args:
+            requests: A list of `(op, row)` pairs.
+
+        Returns:
+            A list of ints aligned with `requests`, one `predict` call is made
+            per op type.
+        """
+        rows = {}
+        for i, (op, row) in enumerate(requests):
+            rows.setdefault(op, ([], []))
+            rows[op][0].append(i)
+            rows[op][1].append(row)
+        res = [0] * len(requests)
+        for op, (indices, features) in rows.items():
+            for i, val in zip(indices, self.predict(op, features)):
+                res[i] = int(val)
+        return res
+
+
+_predictors = {}
+_profile_predictors = {}
+
+
+def get_predictor(folderpath, name='client'):
+    """Get the process-wide predictor for a profile directory."""
+    key = (folderpath, name)
+    if key not in _predictors:
+        _predictors[key] = LatencyPredictor(folderpath, name)
+    return _predictors[key]
+
+
+def list_profiles(root=LR_MODEL_DIR):
+    """List all profiles found under `root`, as `<profile>/<party>`."""
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(root, '*', '*_LR_model.joblib'))):
+        profile = os.path.basename(os.path.dirname(path))
+        party = os.path.basename(path)[:-len('_LR_model.joblib')].split('_', 1)[1]
+        if '{}/{}'.format(profile, party) not in profiles:
+            profiles.append('{}/{}'.format(profile, party))
+    return profiles
+
+
+def parse_profile(profile):
+    """Split `<profile>[/<party>]` into the profile directory and party."""
+    if '/' in profile:
+        profile, name = profile.split('/', 1)
+    else:
+        name = 'client'
+    return profile, name
+
+
+def get_profile_path(profile, root=LR_MODEL_DIR):
+    """Get the directory of a profile, independent of the working directory."""
+    profile, _ = parse_profile(profile)
+    return os.path.join(root, profile) + os.sep
+
+
+def get_profile_predictor(profile, root=LR_MODEL_DIR):
+    """Get the process-wide predictor for `<profile>[/<party>]`.
+
+    The profile is validated against `list_profiles` once per process.
+    """
+    profile_dir, name = parse_profile(profile)
+    key = (root, profile_dir, name)
+    if key not in _profile_predictors:
+        if '{}/{}'.format(profile_dir, name) not in list_profiles(root):
+            raise ValueError('Unknown latency profile: {}, available: {}'.format(
+                profile, list_profiles(root)))
+        _profile_predictors[key] = get_predictor(get_profile_path(profile_dir, root), name)
+    return _profile_predictors[key]
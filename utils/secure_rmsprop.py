@@ -180,4 +180,5 @@ class RMSprop(Optimizer):
                 if check_tensor_in(var_old, self.state):
                     self.state.pop(var_old)
                 del group['params'][index]
+                break
         assert found, 'Var: {} not in RMSProp'.format(info['var_old_name'])
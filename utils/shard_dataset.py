@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Sequential record shards, for training from network filesystems.
+
+A dataset directory holds `shard-%05d.rec` files, an `index.npz` and the
+`config.json` of the conversion. Every
+shard is a sequence of `[uint32 length][record]`, with records as written by
+`utils.lmdb_dataset.encode_record`. Samples are shuffled once when converting,
+so that every shard mixes all classes.
+
+`ShardStream` reads whole shards sequentially and shuffles within a bounded
+buffer, `ShardedImageFolder` reads single records by offset for evaluation.
+
+Usage:
+    To generate shards from raw dataset, run
+    `python -m utils.shard_dataset --src_dir ${src_dir} --dst_dir ${dst_dir}`
+    Run the same command again to resume an interrupted conversion.
+"""
+
+import copy
+import json
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+from torchvision.datasets import ImageFolder
+
+from utils.lmdb_dataset import BufferReader
+from utils.lmdb_dataset import RECORD_HEADER
+from utils.lmdb_dataset import encode_record
+
+INDEX_NAME = 'index.npz'
+CONFIG_NAME = 'config.json'
+LENGTH = struct.Struct('<I')
+# Sequential reads, large enough for NFS and object-store FUSE mounts.
+READ_BUFFER_SIZE = 8 << 20
+
+
+def shard_name(shard):
+    return 'shard-{:05d}.rec'.format(shard)
+
+
+def load_index(path):
+    """Load `{'shards', 'offsets', 'lengths', 'labels'}` of the dataset at `path`.
+
+    `shards[i]`, `offsets[i]` and `lengths[i]` locate the record of sample `i`.
+    """
+    with np.load(os.path.join(path, INDEX_NAME)) as index:
+        return {key: index[key] for key in ['shards', 'offsets', 'lengths', 'labels']}
+
+
+def decode_record(record, transform=None, target_transform=None):
+    """Decode a record into a transformed `(img, target)`."""
+    _, target, _, _ = RECORD_HEADER.unpack_from(record)
+    img = Image.open(BufferReader(memoryview(record)[RECORD_HEADER.size:])).convert('RGB')
+    if transform is not None:
+        img = transform(img)
+    if target_transform is not None:
+        target = target_transform(target)
+    return img, target
+
+
+def read_shard(path):
+    """Iterate over the records of a shard, reading it sequentially."""
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        while True:
+            length = f.read(LENGTH.size)
+            if not length:
+                return
+            yield f.read(LENGTH.unpack(length)[0])
+
+
+def worker_quota(num_samples, batch_size, num_workers, worker_id, drop_last):
+    """Number of samples `worker_id` yields.
+
+    The DataLoader takes batches from its workers in turn, so worker `w`
+    builds batches `w, w + num_workers, ...` of the `num_samples` of a rank.
+    """
+    num_batches = num_samples // batch_size if drop_last else -(-num_samples // batch_size)
+    return sum(min(batch_size, num_samples - k * batch_size)
+               for k in range(worker_id, num_batches, num_workers))
+
+
+class ShardStream(IterableDataset):
+    """Stream shards sequentially, shuffled within a bounded buffer.
+
+    Every epoch the shards are permuted with the same seed on all ranks, then
+    dealt to the `world_size * num_workers` readers. Every rank yields the
+    same number of samples, so that all ranks run the same number of steps,
+    readers short of records start over their shards. Call `with_loader`
+    before building a DataLoader, and `set_epoch` before each epoch.
+
+    Args:
+        path: Directory of the shards and `index.npz`.
+        shuffle: Permute shards and shuffle samples.
+        shuffle_buffer: Number of records shuffled in memory by each reader.
+        seed: Base seed of the permutations.
+    """
+
+    def __init__(self, path, transform=None, target_transform=None,
+                 shuffle=True, shuffle_buffer=1000, seed=0):
+        self.path = path
+        shards = load_index(path)['shards']
+        self.num_samples = len(shards)
+        self.num_shards = int(shards.max()) + 1 if len(shards) else 0
+        self.transform = transform
+        self.target_transform = target_transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = 1
+        self.drop_last = False
+        self.rank = 0
+        self.world_size = 1
+
+    def with_loader(self, batch_size, drop_last=False):
+        """Copy for a DataLoader of `batch_size`, on the current rank."""
+        res = copy.copy(self)
+        res.batch_size = batch_size
+        res.drop_last = drop_last
+        if dist.is_initialized():
+            res.rank, res.world_size = dist.get_rank(), dist.get_world_size()
+        return res
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_samples = self.num_samples // self.world_size
+        if self.drop_last:
+            num_samples -= num_samples % self.batch_size
+        return num_samples
+
+    def _records(self, reader, num_readers):
+        """Endless records of `reader`."""
+        order = np.arange(self.num_shards)
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(order)
+        if self.num_shards >= num_readers:
+            shards, stride, offset = order[reader::num_readers], 1, 0
+        else:
+            # Too few shards, every reader reads all of them and keeps its part.
+            shards, stride, offset = order, num_readers, reader
+        while True:
+            i = 0
+            for shard in shards:
+                for record in read_shard(os.path.join(self.path, shard_name(shard))):
+                    if i % stride == offset:
+                        yield record
+                    i += 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker_id = 1, 0
+        if worker_info is not None:
+            num_workers, worker_id = worker_info.num_workers, worker_info.id
+        reader = self.rank * num_workers + worker_id
+        quota = worker_quota(len(self), self.batch_size, num_workers, worker_id,
+                             self.drop_last)
+        records = self._records(reader, self.world_size * num_workers)
+        rng = np.random.RandomState([self.seed, self.epoch, reader])
+        buf = []
+        for _ in range(quota):
+            if not self.shuffle:
+                record = next(records)
+            else:
+                while len(buf) < self.shuffle_buffer:
+                    buf.append(next(records))
+                i = rng.randint(len(buf))
+                record, buf[i] = buf[i], buf[-1]
+                buf.pop()
+            yield decode_record(record, self.transform, self.target_transform)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.path + ')'
+
+
+class ShardedImageFolder(Dataset):
+    """Random access to the records of shards, e.g. for evaluation."""
+
+    def __init__(self, path, transform=None, target_transform=None):
+        self.path = path
+        index = load_index(path)
+        self.shards = index['shards']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.labels = index['labels']
+        self.transform = transform
+        self.target_transform = target_transform
+        self._fds = {}
+        self._pid = None
+
+    def __getstate__(self):
+        # File descriptors must not cross process boundaries.
+        state = self.__dict__.copy()
+        state['_fds'] = {}
+        state['_pid'] = None
+        return state
+
+    def _get_fd(self, shard):
+        if self._pid != os.getpid():
+            self._fds = {}
+            self._pid = os.getpid()
+        if shard not in self._fds:
+            self._fds[shard] = os.open(os.path.join(self.path, shard_name(shard)), os.O_RDONLY)
+        return self._fds[shard]
+
+    def __getitem__(self, index):
+        record = os.pread(self._get_fd(int(self.shards[index])), int(self.lengths[index]),
+                          int(self.offsets[index]))
+        return decode_record(record, self.transform, self.target_transform)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.path + ')'
+
+
+def _write_shard(args):
+    """Write one shard unless it exists, return the offsets and lengths of its records."""
+    path, samples, max_short_side = args
+    if not os.path.exists(path):
+        tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            for sample_path, label in samples:
+                record = encode_record(sample_path, label, max_short_side)
+                f.write(LENGTH.pack(len(record)))
+                f.write(record)
+        os.replace(tmp_path, path)
+    offsets, lengths = [], []
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            length = f.read(LENGTH.size)
+            if not length:
+                break
+            length = LENGTH.unpack(length)[0]
+            offsets.append(offset + LENGTH.size)
+            lengths.append(length)
+            offset += LENGTH.size + length
+            f.seek(offset)
+    return path, offsets, lengths
+
+
+def folder2shards(src_dir, dst_dir, name="train", num_workers=16,
+                  shard_size=1000, max_short_side=None, seed=0):
+    """Convert torchvision's `ImageFolder` to shards.
+
+    Every shard is written by one of `num_workers` processes to a temporary
+    file and renamed when complete, existing shards are kept, so running
+    again resumes an interrupted conversion. The config of the conversion is
+    stored along, shards of a different config are not resumed.
+    """
+    directory = os.path.expanduser(os.path.join(src_dir, name))
+    print("Loading dataset from %s" % directory)
+    samples = ImageFolder(directory).samples
+    order = np.random.RandomState(seed).permutation(len(samples))
+    samples = [samples[i] for i in order]
+
+    shard_dir = os.path.join(dst_dir, name)
+    os.makedirs(shard_dir, exist_ok=True)
+    print("Generate shards to %s" % shard_dir)
+
+    config = {'num_samples': len(samples), 'shard_size': shard_size,
+              'max_short_side': max_short_side, 'seed': seed}
+    config_path = os.path.join(shard_dir, CONFIG_NAME)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            progress_config = json.load(f)
+        if progress_config != config:
+            raise ValueError('Cannot resume {} converted with {}, got {}'.format(
+                shard_dir, progress_config, config))
+        print("Resume from existing shards")
+    else:
+        tmp_path = '{}.tmp.{}'.format(config_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(config, f)
+        os.replace(tmp_path, config_path)
+    num_shards = (len(samples) + shard_size - 1) // shard_size
+    tasks = [(os.path.join(shard_dir, shard_name(i)),
+              samples[i * shard_size:(i + 1) * shard_size], max_short_side)
+             for i in range(num_shards)]
+    results = {}
+    with multiprocessing.Pool(num_workers) as pool:
+        for path, offsets, lengths in tqdm(pool.imap_unordered(_write_shard, tasks),
+                                           total=num_shards):
+            results[path] = (offsets, lengths)
+
+    shards, offsets, lengths = [], [], []
+    for i, (path, _, _) in enumerate(tasks):
+        shards += [i] * len(results[path][0])
+        offsets += results[path][0]
+        lengths += results[path][1]
+    index_path = os.path.join(shard_dir, INDEX_NAME)
+    tmp_path = '{}.tmp.{}.npz'.format(index_path, os.getpid())
+    np.savez(tmp_path,
+             shards=np.asarray(shards, dtype=np.int64),
+             offsets=np.asarray(offsets, dtype=np.int64),
+             lengths=np.asarray(lengths, dtype=np.int64),
+             labels=np.asarray([label for _, label in samples], dtype=np.int64))
+    os.replace(tmp_path, index_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src_dir', help='ILSVRC dataset dir')
+    parser.add_argument('--dst_dir', help='dst dir')
+    parser.add_argument('--num_workers', type=int, default=16,
+                        help='processes writing shards')
+    parser.add_argument('--shard_size', type=int, default=1000,
+                        help='images per shard')
+    parser.add_argument('--max_short_side', type=int, default=None,
+                        help='resize images to at most this short side')
+    args = parser.parse_args()
+
+    for name in ['val', 'train']:
+        folder2shards(args.src_dir, args.dst_dir, name=name,
+                      num_workers=args.num_workers, shard_size=args.shard_size,
+                      max_short_side=args.max_short_side)
+
+        dataset = ShardedImageFolder(os.path.join(args.dst_dir, name))
+        img, label = dataset[len(dataset) - 1]
+        print('Test {} with len {}'.format(name, len(dataset)))
+        print(img.size, label)
@@ -3,6 +3,7 @@ import math
 import random
 import numpy as np
 from PIL import Image
+import torch
 import torchvision.transforms.functional as F
 from torchvision import transforms
 
@@ -175,3 +176,99 @@ class RandomResizedCropPadding(object):
         format_string += ', interpolation={0})'.format(self.interpolation)
         format_string += ', crop_padding={0})'.format(self.crop_padding)
         return format_string
+
+
+# Batched transforms, on float `[N, C, H, W]` tensors with values in [0, 255],
+# e.g. uint8 batches moved to the training device. Random parameters are drawn
+# per sample.
+
+
+def batch_grayscale(x):
+    """ITU-R 601-2 luma, as PIL's `convert('L')`, with shape `[N, 1, H, W]`."""
+    return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+
+def batch_blend(x, degenerate, factor):
+    """`degenerate + factor * (x - degenerate)` per sample, as `PIL.ImageEnhance`."""
+    factor = factor.view(-1, 1, 1, 1)
+    return (degenerate + factor * (x - degenerate)).clamp_(0, 255)
+
+
+def batch_brightness(x, factor):
+    return batch_blend(x, torch.zeros_like(x), factor)
+
+
+def batch_contrast(x, factor):
+    mean = batch_grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+    return batch_blend(x, mean.expand_as(x), factor)
+
+
+def batch_saturation(x, factor):
+    return batch_blend(x, batch_grayscale(x).expand_as(x), factor)
+
+
+def _uniform_factor(x, param):
+    return torch.empty(x.size(0), device=x.device).uniform_(1 - param, 1 + param)
+
+
+class BatchColorJitter(object):
+    """Batched `transforms.ColorJitter` without hue.
+
+    Brightness, contrast and saturation are applied in this order, instead
+    of a random one.
+    """
+
+    def __init__(self, brightness=0., contrast=0., saturation=0.):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    def __call__(self, x):
+        if self.brightness > 0:
+            x = batch_brightness(x, _uniform_factor(x, self.brightness))
+        if self.contrast > 0:
+            x = batch_contrast(x, _uniform_factor(x, self.contrast))
+        if self.saturation > 0:
+            x = batch_saturation(x, _uniform_factor(x, self.saturation))
+        return x
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(brightness={}, contrast={}, saturation={})'.format(
+            self.brightness, self.contrast, self.saturation)
+
+
+class BatchLighting(object):
+    """Batched `Lighting`."""
+
+    def __init__(self,
+                 alphastd,
+                 eigval=imagenet_pca['eigval'],
+                 eigvec=imagenet_pca['eigvec']):
+        self.alphastd = alphastd
+        self.eigval = torch.tensor(eigval, dtype=torch.float32)
+        self.eigvec = torch.tensor(eigvec, dtype=torch.float32)
+
+    def __call__(self, x):
+        if self.alphastd == 0.:
+            return x
+        eigval, eigvec = self.eigval.to(x.device), self.eigvec.to(x.device)
+        alpha = torch.randn(x.size(0), 3, device=x.device) * self.alphastd
+        inc = (alpha * eigval) @ eigvec.t()
+        return (x + inc.view(-1, 3, 1, 1)).clamp_(0, 255)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+class BatchRandomHorizontalFlip(object):
+    """Batched `transforms.RandomHorizontalFlip`."""
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = torch.rand(x.size(0), device=x.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
@@ -32,15 +32,11 @@ def run_one_epoch(epoch,
     if phase == 'bn_calibration':
         model.apply(bn_calibration)
 
-    if FLAGS.use_distributed:
-        loader.sampler.set_epoch(epoch)
+    dataflow.set_epoch(loader, epoch)
 
     data_iterator = iter(loader)
-    if FLAGS.use_distributed:
-        data_fetcher = dataflow.DataPrefetcher(data_iterator)
-    else:
-        logging.warning('Not use prefetcher')
-        data_fetcher = data_iterator
+    data_fetcher = dataflow.get_prefetcher(data_iterator, FLAGS,
+                                           dataset=loader.dataset)
     for batch_idx, (input, target) in enumerate(data_fetcher):
         # used for bn calibration
         if max_iter is not None:
@@ -50,7 +46,10 @@ def run_one_epoch(epoch,
 
         if DEVICE_MODE == "gpu":
             target = target.cuda(non_blocking=True)
-        mc.forward_loss(model, criterion, input, target, meters)
+        with mc.autocast():
+            mc.forward_loss(model, criterion, input, target, meters)
+    data_fetcher.close()
+
 
     results = mc.reduce_and_flush_meters(meters)
     if udist.is_master():
@@ -100,16 +99,16 @@ def val():
         logging.info('Start testing.')
     FLAGS._global_step = 0
     test_meters = mc.get_meters('test')
-    validate(0, calib_loader, test_loader, criterion, test_meters,
-             model_wrapper, ema, 'test')
+    with mc.ema_model(ema, model_wrapper) as model_eval_wrapper:
+        validate(0, calib_loader, test_loader, criterion, test_meters,
+                 model_eval_wrapper, 'test')
     return
 
 
 def validate(epoch, calib_loader, val_loader, criterion, val_meters,
-             model_wrapper, ema, phase):
+             model_eval_wrapper, phase):
     """Calibrate and validate."""
     assert phase in ['test', 'val']
-    model_eval_wrapper = mc.get_ema_model(ema, model_wrapper)
 
     # bn_calibration
     if FLAGS.get('bn_calibration', False):